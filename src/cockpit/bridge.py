@@ -26,7 +26,7 @@ from ._version import __version__
 from .channel import ChannelRoutingRule
 from .channels import CHANNEL_TYPES
 from .config import Config, Environment
-from .internal_endpoints import EXPORTS
+from .internal_endpoints import EXPORTS, cockpit_Stats
 from .jsonutil import JsonError, JsonObject, JsonValue, get_dict
 from .packages import BridgeConfig, Packages, PackagesListener
 from .peer import PeersRoutingRule
@@ -108,6 +108,8 @@ class Bridge(Router, PackagesListener):
             self.peers_rule,
         ], session_timeout=session_timeout)
 
+        self.internal_bus.export('/stats', cockpit_Stats(self.stats))
+
     def info(self) -> JsonObject:
         pw = pwd.getpwuid(os.getuid())
 
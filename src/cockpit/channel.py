@@ -5,13 +5,15 @@
 
 import asyncio
 import codecs
+import collections
 import json
 import logging
+import time
 import traceback
 import typing
 from typing import BinaryIO, Callable, ClassVar, Collection, Generator, Mapping, Sequence, Type
 
-from .jsonutil import JsonError, JsonObject, JsonValue, create_object, get_bool, get_enum, get_str
+from .jsonutil import JsonError, JsonObject, JsonValue, create_object, get_bool, get_enum, get_int, get_str
 from .protocol import CockpitProblem
 from .router import Endpoint, Router, RoutingRule
 
@@ -93,12 +95,30 @@ class Channel(Endpoint):
     BLOCK_SIZE = 16 * 1024
     SEND_WINDOW = 2 * 1024 * 1024
 
+    # The window starts out at SEND_WINDOW and is then sized according to the
+    # bandwidth-delay product measured from ping/pong round trips, within
+    # these bounds.  The minimum needs to be at least one block, so that there
+    # is always a ping in flight when we're blocked.
+    SEND_WINDOW_MIN: ClassVar[int] = 16 * BLOCK_SIZE
+    SEND_WINDOW_MAX: ClassVar[int] = 32 * 1024 * 1024
+    # How long we trust the minimum round trip time we've seen
+    MIN_RTT_LIFETIME: ClassVar[float] = 10.0
+
     # Flow control book-keeping
     _send_pings: bool = False
     _out_sequence: int = 0
     _out_window: int = SEND_WINDOW
+    _send_window: int = SEND_WINDOW
     _ack_bytes: bool
 
+    # Round trip measurements: (sequence, time) of unanswered pings, the
+    # smoothed and minimum round trip times, and the start of the current
+    # delivery rate sample
+    _pings_in_flight: 'collections.deque[tuple[int, float]]'
+    _rtt: 'float | None' = None
+    _min_rtt: 'tuple[float, float] | None' = None
+    _rate_sample: 'tuple[int, float] | None' = None
+
     # Task management
     _tasks: 'set[asyncio.Task]'
     _close_args: 'JsonObject | None' = None
@@ -124,6 +144,7 @@ class Channel(Endpoint):
             self.channel = get_str(message, 'channel')
             if get_bool(message, 'flow-control', default=False):
                 self._send_pings = True
+                self._pings_in_flight = collections.deque()
             self._ack_bytes = get_enum(message, 'send-acks', ['bytes'], None) is not None
             self.group = get_str(message, 'group', 'default')
             self.is_binary = get_enum(message, 'binary', ['raw'], None) is not None
@@ -221,7 +242,7 @@ class Channel(Endpoint):
         self.thaw_endpoint()
         self.send_control(command='ready', **kwargs)
 
-    def __decode_frame(self, data: bytes, *, final: bool = False) -> str:
+    def __decode_frame(self, data: 'bytes | memoryview', *, final: bool = False) -> str:
         assert self.decoder is not None
         try:
             return self.decoder.decode(data, final=final)
@@ -277,7 +298,7 @@ class Channel(Endpoint):
         if not self._tasks:
             self._close_now()
 
-    def send_bytes(self, data: bytes) -> bool:
+    def send_bytes(self, data: 'bytes | memoryview') -> bool:
         """Send binary data and handle book-keeping for flow control.
 
         The flow control is "advisory".  The data is sent immediately, even if
@@ -298,11 +319,12 @@ class Channel(Endpoint):
             out_sequence = self._out_sequence + len(data)
             if self._out_sequence // Channel.BLOCK_SIZE != out_sequence // Channel.BLOCK_SIZE:
                 self.send_control(command='ping', sequence=out_sequence)
+                self._pings_in_flight.append((out_sequence, time.monotonic()))
             self._out_sequence = out_sequence
 
         return self._out_sequence < self._out_window
 
-    def send_data(self, data: bytes) -> bool:
+    def send_data(self, data: 'bytes | memoryview') -> bool:
         """Send data and transparently handle UTF-8 for text channels
 
         Use this for channels which can be text, but are not guaranteed to get
@@ -330,15 +352,83 @@ class Channel(Endpoint):
         pretty = self.json_encoder.encode(create_object(msg, kwargs)) + '\n'
         return self.send_text(pretty)
 
-    def do_pong(self, message):
+    def do_pong(self, message: JsonObject) -> None:
         if not self._send_pings:  # huh?
             logger.warning("Got wild pong on channel %s", self.channel)
             return
 
-        self._out_window = message['sequence'] + Channel.SEND_WINDOW
+        sequence = get_int(message, 'sequence')
+        now = time.monotonic()
+
+        # Find the matching ping, dropping any older ones which went unanswered
+        sent = None
+        while self._pings_in_flight and self._pings_in_flight[0][0] <= sequence:
+            ping_sequence, ping_time = self._pings_in_flight.popleft()
+            if ping_sequence == sequence:
+                sent = ping_time
+
+        if sent is not None:
+            self._update_rtt(now - sent, now)
+
+        self._update_window(sequence, now)
+
+        self._out_window = sequence + self._send_window
         if self._out_sequence < self._out_window:
             self.do_resume_send()
 
+    def _update_rtt(self, sample: float, now: float) -> None:
+        # Same smoothing as TCP (RFC 6298)
+        self._rtt = sample if self._rtt is None else 0.875 * self._rtt + 0.125 * sample
+
+        # The smoothed value includes the time spent queued behind our own
+        # data, so the bandwidth-delay product is based on the minimum.
+        if self._min_rtt is None or sample <= self._min_rtt[0] or now - self._min_rtt[1] > self.MIN_RTT_LIFETIME:
+            self._min_rtt = (sample, now)
+
+    def _update_window(self, sequence: int, now: float) -> None:
+        # Measure the delivery rate over (at least) one round trip, and size
+        # the window to twice the resulting bandwidth-delay product.  If the
+        # window is what limits us, the measured rate is about window / RTT, so
+        # this doubles the window each round trip until something else becomes
+        # the bottleneck: the network, the receiver, or the channel itself.
+        if self._rtt is None or self._min_rtt is None:
+            return
+
+        if self._rate_sample is None:
+            self._rate_sample = (sequence, now)
+            return
+
+        start_sequence, start_time = self._rate_sample
+        if now - start_time < self._rtt or sequence <= start_sequence:
+            return
+        self._rate_sample = (sequence, now)
+
+        rate = (sequence - start_sequence) / (now - start_time)
+        window = int(2 * rate * self._min_rtt[0])
+        window = max(self.SEND_WINDOW_MIN, min(window, self.SEND_WINDOW_MAX))
+
+        if window != self._send_window:
+            logger.debug('channel %s: send window %d -> %d (%.1f MB/s, rtt %.1fms, min %.1fms)',
+                         self.channel, self._send_window, window, rate / 1e6,
+                         self._rtt * 1000, self._min_rtt[0] * 1000)
+            self._send_window = window
+
+    @property
+    def send_window(self) -> int:
+        """The current size of the flow control window, in bytes"""
+        return self._send_window
+
+    @property
+    def round_trip_time(self) -> 'float | None':
+        """The smoothed ping/pong round trip time in seconds, if measured yet"""
+        return self._rtt
+
+    def get_channel_stats(self, channel: str) -> 'dict[str, int | float]':
+        stats: 'dict[str, int | float]' = {'send-window': self._send_window}
+        if self._rtt is not None:
+            stats['round-trip-time'] = self._rtt
+        return stats
+
     def do_resume_send(self) -> None:
         """Called to indicate that the channel may start sending again."""
         # change to `raise NotImplementedError` after everyone implements it
@@ -367,6 +457,7 @@ class ProtocolChannel(Channel, asyncio.Protocol):
     """
     _transport: 'asyncio.Transport | None' = None
     _send_pongs: bool = True
+    _send_blocked: bool = False
     _last_ping: 'JsonObject | None' = None
     _create_transport_task: 'asyncio.Task[asyncio.Transport] | None' = None
     _ready_info: 'JsonObject | None' = None
@@ -408,6 +499,8 @@ class ProtocolChannel(Channel, asyncio.Protocol):
     def connection_made(self, transport: asyncio.BaseTransport) -> None:
         assert isinstance(transport, asyncio.Transport)
         self._transport = transport
+        if self.router.output_paused:
+            self._update_reading()
 
     def _get_close_args(self) -> JsonObject:
         return {}
@@ -432,13 +525,31 @@ class ProtocolChannel(Channel, asyncio.Protocol):
         assert self._transport is not None
         try:
             if not self.send_data(data):
+                self._send_blocked = True
                 self._transport.pause_reading()
         except ChannelError as exc:
             self.close(exc.get_attrs())
 
+    def _update_reading(self) -> None:
+        # We read from the transport if neither our send window nor the
+        # router's output buffer is full.
+        if self._transport is None:
+            return
+        if self._send_blocked or self.router.output_paused:
+            self._transport.pause_reading()
+        else:
+            self._transport.resume_reading()
+
     def do_resume_send(self) -> None:
         assert self._transport is not None
-        self._transport.resume_reading()
+        self._send_blocked = False
+        self._update_reading()
+
+    def do_pause_output(self) -> None:
+        self._update_reading()
+
+    def do_resume_output(self) -> None:
+        self._update_reading()
 
     def close_on_eof(self) -> None:
         """Mark the channel to be closed on EOF.
@@ -497,6 +608,8 @@ class AsyncChannel(Channel):
     On the receiving side, the channel will respond to flow control pings to
     indicate that it has received the data, but only after it has been consumed
     by `read()`.
+    Data which is queued but not yet consumed counts against the memory budget
+    of the router, which stops reading input while too much is queued.
 
     On the sending side, write() will block if the channel backs up.
     """
@@ -505,6 +618,7 @@ class AsyncChannel(Channel):
     # to pings as we dequeue them.  EOF is None.  This is a buffer: since we
     # need to handle do_data() without blocking, we have no choice.
     receive_queue: 'asyncio.Queue[bytes | JsonObject | None]'
+    _queued_bytes: int = 0
     loop: asyncio.AbstractEventLoop
 
     # Send-side flow control
@@ -526,6 +640,22 @@ class AsyncChannel(Channel):
         except BaseException:
             self.close({'problem': 'internal-error', 'cause': traceback.format_exc()})
             raise
+        finally:
+            # Nobody is going to read whatever is left in the queue
+            self._dequeued(self._queued_bytes)
+
+    @property
+    def queued_bytes(self) -> int:
+        """The number of received bytes waiting to be read()"""
+        return self._queued_bytes
+
+    def get_channel_stats(self, channel: str) -> 'dict[str, int | float]':
+        return {**super().get_channel_stats(channel), 'queued-bytes': self._queued_bytes}
+
+    def _dequeued(self, size: int) -> None:
+        if size:
+            self._queued_bytes -= size
+            self.router.update_queued_bytes(-size)
 
     async def read(self) -> 'bytes | None':
         # Three possibilities for what we'll find:
@@ -539,13 +669,21 @@ class AsyncChannel(Channel):
             if isinstance(item, Mapping):
                 self.send_pong(item)
             else:
+                self._dequeued(len(item))
                 self.send_ack(item)
                 return item
 
     async def write(self, data: bytes) -> None:
         if not self.send_data(data):
-            self.write_waiter = self.loop.create_future()
-            await self.write_waiter
+            await self.wait_for_window()
+
+    async def write_text(self, data: str) -> None:
+        if not self.send_text(data):
+            await self.wait_for_window()
+
+    async def wait_for_window(self) -> None:
+        self.write_waiter = self.loop.create_future()
+        await self.write_waiter
 
     async def in_thread(self, fn: 'Callable[_P, _T]', *args: '_P.args', **kwargs: '_P.kwargs') -> '_T':
         return await self.loop.run_in_executor(None, fn, *args, **kwargs)
@@ -581,6 +719,9 @@ class AsyncChannel(Channel):
 
     def do_data(self, data: bytes) -> bool:
         self.receive_queue.put_nowait(data)
+        if data:
+            self._queued_bytes += len(data)
+            self.router.update_queued_bytes(len(data))
         return True  # we will send the 'ack' later (from read())
 
 
@@ -590,10 +731,13 @@ class GeneratorChannel(Channel):
     Calls the .do_yield_data() generator with the options from the open message
     and sends the data which it yields.  If the generator returns a value it
     will be used for the close message.
+
+    The data is sent from the router's send scheduler, a quantum at a time, so
+    that a large transfer doesn't hold up other channels.
     """
-    __generator: 'Generator[bytes, None, JsonObject]'
+    __generator: 'Generator[bytes | memoryview, None, JsonObject]'
 
-    def do_yield_data(self, options: JsonObject) -> 'Generator[bytes, None, JsonObject]':
+    def do_yield_data(self, options: JsonObject) -> 'Generator[bytes | memoryview, None, JsonObject]':
         raise NotImplementedError
 
     def do_open(self, options: JsonObject) -> None:
@@ -601,9 +745,25 @@ class GeneratorChannel(Channel):
         self.do_resume_send()
 
     def do_resume_send(self) -> None:
+        self.schedule_send()
+
+    def do_send_quantum(self, quantum: int) -> bool:
+        if self._close_args is not None:
+            return False
+
         try:
-            while self.send_data(next(self.__generator)):
-                pass
-        except StopIteration as stop:
-            self.done()
-            self.close(stop.value)
+            try:
+                while quantum > 0:
+                    data = next(self.__generator)
+                    quantum -= len(data)
+                    if not self.send_data(data):
+                        return False  # we get rescheduled from .do_resume_send()
+            except StopIteration as stop:
+                self.done()
+                self.close(stop.value)
+                return False
+        except ChannelError as exc:
+            self.close(exc.get_attrs())
+            return False
+
+        return True
@@ -4,7 +4,15 @@
 
 
 from .dbus import DBusChannel
-from .filesystem import FsInfoChannel, FsListChannel, FsReadChannel, FsReplaceChannel, FsWatchChannel
+from .filesystem import (
+    FsCopyChannel,
+    FsDuChannel,
+    FsInfoChannel,
+    FsListChannel,
+    FsReadChannel,
+    FsReplaceChannel,
+    FsWatchChannel,
+)
 from .http_channel import HttpChannel
 from .info import InfoChannel
 from .metrics import InternalMetricsChannel
@@ -17,6 +25,8 @@ from .trivial import EchoChannel, NullChannel
 CHANNEL_TYPES = [  # noqa: RUF067
     DBusChannel,
     EchoChannel,
+    FsCopyChannel,
+    FsDuChannel,
     FsInfoChannel,
     FsListChannel,
     FsReadChannel,
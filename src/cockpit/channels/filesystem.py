@@ -4,22 +4,31 @@
 
 
 import asyncio
+import codecs
+import collections
+import concurrent.futures
 import contextlib
 import enum
 import errno
+import fcntl
 import fnmatch
 import functools
 import grp
+import io
+import itertools
 import logging
 import os
 import pwd
 import re
+import shutil
 import stat
 import tempfile
+import threading
+import time
 from pathlib import Path
-from typing import Callable, Generator, Iterable
+from typing import Callable, ClassVar, Generator, Iterable, Iterator, List, NamedTuple, Tuple
 
-from cockpit._vendor.systemd_ctypes import Handle, PathWatch
+from cockpit._vendor.systemd_ctypes import Handle
 from cockpit._vendor.systemd_ctypes.inotify import Event as InotifyEvent
 from cockpit._vendor.systemd_ctypes.pathwatch import Listener as PathWatchListener
 
@@ -30,6 +39,7 @@ from ..jsonutil import (
     JsonError,
     JsonObject,
     get_bool,
+    get_enum,
     get_int,
     get_object,
     get_str,
@@ -37,6 +47,7 @@ from ..jsonutil import (
     get_strv,
     json_merge_and_filter_patch,
 )
+from ..pathwatches import PathWatchRef, path_watches
 
 logger = logging.getLogger(__name__)
 
@@ -67,32 +78,95 @@ def tag_from_fd(fd: int) -> 'str | None':
         return None
 
 
+def find_line_start(fd: int, start: int, end: int) -> int:
+    """Find the first line which starts at or after `start`
+
+    Returns `start` itself if it's at the start of a line, or if there is no
+    line break between it and `end`, in which case we start in the middle of
+    the only (partial) line there is.
+    """
+    position = start - 1
+    while 0 <= position < end:
+        data = os.pread(fd, min(4096, end - position), position)
+        if not data:
+            break
+        newline = data.find(b'\n')
+        if newline != -1:
+            return position + newline + 1
+        position += len(data)
+    return start
+
+
+def sanitize_text(data: 'bytes | memoryview', *, final: bool) -> 'tuple[bytes | memoryview, int]':
+    """Turn a block of file contents into valid UTF-8 without NUL characters.
+
+    Returns the text and the number of input bytes it covers.  Unless `final`
+    is set, an incomplete character at the end of the block isn't covered:
+    pass it again at the start of the next block.  In the common case that
+    there's nothing to fix, the result is a slice of the input, without a copy.
+    """
+    try:
+        text, consumed = codecs.utf_8_decode(data, 'strict', final)
+    except UnicodeDecodeError:
+        text, consumed = codecs.utf_8_decode(data, 'ignore', final)
+    else:
+        if '\0' not in text:
+            return data[:consumed], consumed
+
+    return text.replace('\0', '').encode(), consumed
+
+
+def entry_type(entry: 'os.DirEntry[str]') -> str:
+    if entry.is_symlink():
+        return 'link'
+    elif entry.is_file():
+        return 'file'
+    elif entry.is_dir():
+        return 'directory'
+    else:
+        return 'special'
+
+
+def read_entries(entries: 'Iterator[os.DirEntry[str]]', count: 'int | None') -> 'list[tuple[str, str]]':
+    # This runs in a worker thread: reading the directory, and finding out the
+    # type of an entry (if the filesystem doesn't tell us) can block.
+    return [(entry.name, entry_type(entry)) for entry in itertools.islice(entries, count)]
+
+
 # DEPRECATED: https://github.com/cockpit-project/cockpit/pull/21055
 # as of 2024-09-30 there are no more users of this in any known project
-class FsListChannel(Channel):
+class FsListChannel(AsyncChannel):
     payload = 'fslist1'
 
-    def send_entry(self, event: str, entry: 'os.DirEntry[str]') -> None:
-        if entry.is_symlink():
-            mode = 'link'
-        elif entry.is_file():
-            mode = 'file'
-        elif entry.is_dir():
-            mode = 'directory'
-        else:
-            mode = 'special'
+    # The directory is read in a worker thread, about this many entries at a
+    # time, so that huge directories don't block the main loop.
+    SCAN_CHUNK_SIZE = 1000
 
-        self.send_json(event=event, path=entry.name, type=mode)
+    async def send_entries(self, entries: 'list[tuple[str, str]]', batch_size: 'int | None') -> None:
+        messages = [{'event': 'present', 'path': name, 'type': mode} for name, mode in entries]
+        if batch_size is None:
+            for message in messages:
+                await self.write_text(self.json_encoder.encode(message) + '\n')
+        else:
+            for start in range(0, len(messages), batch_size):
+                await self.write_text(self.json_encoder.encode(messages[start:start + batch_size]) + '\n')
 
-    def do_open(self, options: 'JsonObject') -> None:
+    async def run(self, options: JsonObject) -> None:
         path = get_str(options, 'path')
         watch = options.get('watch', True)
+        batch_size = get_int(options, 'batch-size', None)
+        sort = get_enum(options, 'sort', ['name'], None)
+        offset = get_int(options, 'offset', 0)
+        limit = get_int(options, 'limit', None)
 
         if watch:
             raise ChannelError('not-supported', message='watching is not implemented, use fswatch1')
+        for name, value, minimum in (('batch-size', batch_size, 1), ('offset', offset, 0), ('limit', limit, 0)):
+            if value is not None and value < minimum:
+                raise ChannelError('protocol-error', message=f'invalid "{name}" value: {value}')
 
         try:
-            scan_dir = os.scandir(path)
+            scan_dir = await self.in_thread(os.scandir, path)
         except FileNotFoundError as error:
             raise ChannelError('not-found', message=str(error)) from error
         except PermissionError as error:
@@ -101,47 +175,134 @@ class FsListChannel(Channel):
             raise ChannelError('internal-error', message=str(error)) from error
 
         self.ready()
-        for entry in scan_dir:
-            self.send_entry("present", entry)
 
-        if not watch:
-            self.done()
-            self.close()
+        # The offset and limit apply to the sorted list, if asked for, or else
+        # to the (arbitrary, but stable) order of the directory itself.
+        stop = None if limit is None else offset + limit
+        if sort is not None:
+            entries = await self.in_thread(read_entries, scan_dir, None)
+            entries.sort()
+            await self.send_entries(entries[offset:stop], batch_size)
+        else:
+            # Read whole batches at a time, to avoid splitting them up
+            chunk_size = self.SCAN_CHUNK_SIZE
+            if batch_size is not None:
+                chunk_size = max(chunk_size // batch_size, 1) * batch_size
+
+            selected = itertools.islice(scan_dir, offset, stop)
+            while True:
+                entries = await self.in_thread(read_entries, selected, chunk_size)
+                if not entries:
+                    break
+                await self.send_entries(entries, batch_size)
+
+        # If we get cancelled, a worker thread might still be using this, so
+        # we only close it here, and otherwise leave it to the garbage
+        # collector.
+        scan_dir.close()
+
+        self.done()
 
 
 class FsReadChannel(GeneratorChannel):
     payload = 'fsread1'
 
-    def do_yield_data(self, options: JsonObject) -> Generator[bytes, None, JsonObject]:
+    # The default is what our flow control is built around, but clients which
+    # read large files can ask for larger frames with the "block-size" option.
+    MAX_BLOCK_SIZE = 16 * 1024 * 1024
+
+    def send_data(self, data: 'bytes | memoryview') -> bool:
+        # .do_yield_data() already took care of the UTF-8 for text channels
+        return self.send_bytes(data)
+
+    def read_blocks(
+        self, filep: io.BufferedReader, block_size: int, length: 'int | None'
+    ) -> Iterator['bytes | memoryview']:
+        leftover = b''
+        while length != 0:
+            data = filep.read1(block_size if length is None else min(block_size, length))
+            if not data:
+                break
+
+            if length is not None:
+                length -= len(data)
+
+            if self.is_binary:
+                yield data
+                continue
+
+            if leftover:
+                data = leftover + data
+            text, consumed = sanitize_text(data, final=False)
+            leftover = data[consumed:]
+            if text:
+                yield text
+
+        if leftover:
+            text, _ = sanitize_text(leftover, final=True)
+            if text:
+                yield text
+
+    def do_yield_data(self, options: JsonObject) -> Generator['bytes | memoryview', None, JsonObject]:
         path = get_str(options, 'path')
         max_read_size = get_int(options, 'max_read_size', 16 * 1024 * 1024)
+        block_size = get_int(options, 'block-size', Channel.BLOCK_SIZE)
+        if not 4096 <= block_size <= self.MAX_BLOCK_SIZE:
+            raise ChannelError('protocol-error', message=f'invalid "block-size" value: {block_size}')
+        offset = get_int(options, 'offset', 0)
+        length = get_int(options, 'length', None)
+        tail = get_int(options, 'tail', None)
+        if_tag = get_str(options, 'if-tag', None)
+        for name, value in (('offset', offset), ('length', length), ('tail', tail)):
+            if value is not None and value < 0:
+                raise ChannelError('protocol-error', message=f'invalid "{name}" value: {value}')
+        if tail is not None and (offset != 0 or length is not None):
+            raise ChannelError('protocol-error', message='"tail" cannot be combined with "offset" or "length"')
 
         logger.debug('Opening file "%s" for reading', path)
 
         try:
             with open(path, 'rb') as filep:
                 buf = os.stat(filep.fileno())
-                if max_read_size != -1 and buf.st_size > max_read_size:
+                tag = tag_from_stat(buf)
+                if tag == if_tag:
+                    logger.debug('  ...not modified')
+                    return {'tag': tag, 'not-modified': True}
+
+                is_regular = stat.S_ISREG(buf.st_mode)
+
+                if tail is not None:
+                    if not is_regular:
+                        raise ChannelError('not-supported', message='"tail" is only supported for regular files')
+                    offset = find_line_start(filep.fileno(), max(buf.st_size - tail, 0), buf.st_size)
+
+                # Files in /proc and /sys don't have a real size, so we can't
+                # rely on it to know where the range ends: the reading below
+                # stops after `length` bytes, or at the end of the file.
+                stop = buf.st_size if length is None else min(offset + length, buf.st_size)
+                size = max(stop - offset, 0)
+
+                if max_read_size != -1 and size > max_read_size:
                     raise ChannelError('too-large')
 
-                if self.is_binary and stat.S_ISREG(buf.st_mode):
-                    self.ready(size_hint=buf.st_size)
+                if self.is_binary and is_regular:
+                    self.ready(size_hint=size)
                 else:
                     self.ready()
 
-                while True:
-                    data = filep.read1(Channel.BLOCK_SIZE)
-                    if data == b'':
-                        break
-                    logger.debug('  ...sending %d bytes', len(data))
-                    if not self.is_binary:
-                        data = data.replace(b'\0', b'').decode(errors='ignore').encode()
-                    yield data
+                if offset != 0:
+                    filep.seek(offset)
+                yield from self.read_blocks(filep, block_size, length)
 
-            return {'tag': tag_from_stat(buf)}
+            result: JsonDict = {'tag': tag}
+            if tail is not None:
+                result['offset'] = offset
+            return result
 
         except FileNotFoundError:
             # Using `yield` and `return {value}` generator, but GeneratorChannel does expect this
+            if if_tag == '-':
+                return {'tag': '-', 'not-modified': True}
             return {'tag': '-'}  # noqa: B901
         except PermissionError as exc:
             raise ChannelError('access-denied') from exc
@@ -189,9 +350,93 @@ class FSReplaceAttrs:
             self.gid = group
 
 
+def write_all(fd: int, data: 'bytes | bytearray | memoryview') -> None:
+    with memoryview(data) as view:
+        while view:
+            view = view[os.write(fd, view):]
+
+
+class WriteBehind:
+    """Writes to a file from a dedicated worker thread, in the background
+
+    Data is collected into blocks of (a multiple of) WRITE_SIZE, which are
+    written in order by the worker, while the caller goes on to receive more.
+    `.write()` only waits when there's more than MAX_PENDING bytes not yet
+    written, which pushes back on the sender when the disk is slower.
+    """
+    WRITE_SIZE = 1024 * 1024
+    MAX_PENDING = 8 * 1024 * 1024
+
+    def __init__(self, fd: int) -> None:
+        self.fd = fd
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='WriteBehind')
+        self.buffer = bytearray()
+        self.pending: 'collections.deque[tuple[concurrent.futures.Future[None], int]]' = collections.deque()
+        self.n_pending = 0
+        self.written = 0  # everything passed to .write()
+        self.completed = 0  # ...of which this much is known to be in the file
+
+    def submit(self, block: 'bytes | bytearray | memoryview') -> None:
+        future = self.executor.submit(write_all, self.fd, block)
+        self.pending.append((future, len(block)))
+        self.n_pending += len(block)
+        self.written += len(block)
+
+    async def wait(self, limit: int) -> None:
+        while self.n_pending > limit:
+            future, size = self.pending[0]
+            await asyncio.wrap_future(future)
+            self.pending.popleft()
+            self.n_pending -= size
+            self.completed += size
+
+    async def write(self, data: bytes) -> None:
+        self.buffer += data
+        if len(self.buffer) >= self.WRITE_SIZE:
+            # Send off all full blocks, keeping the rest for later
+            size = len(self.buffer) - len(self.buffer) % self.WRITE_SIZE
+            block, self.buffer = self.buffer, self.buffer[size:]
+            self.submit(memoryview(block)[:size])
+            await self.wait(self.MAX_PENDING)
+
+    async def flush(self) -> None:
+        if self.buffer:
+            self.submit(self.buffer)
+            self.buffer = bytearray()
+        await self.wait(0)
+
+    async def close(self) -> None:
+        # Writes which haven't started don't need to happen anymore, but we
+        # can't let go of the fd before the worker is done with it.
+        # (shutdown() can only cancel them itself since Python 3.9)
+        for future, _size in self.pending:
+            future.cancel()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, functools.partial(self.executor.shutdown, wait=True))
+        # The writes happen in order, so the file has everything up to the
+        # first one which was cancelled or failed
+        while self.pending:
+            future, size = self.pending.popleft()
+            if future.cancelled() or future.exception() is not None:
+                break
+            self.completed += size
+        self.pending.clear()
+
+
 class FsReplaceChannel(AsyncChannel):
     payload = 'fsreplace1'
-    capabilities = 'attrs',
+    capabilities = 'attrs', 'upload'
+
+    # How long the partial file of an interrupted resumable upload is kept
+    UPLOAD_GRACE_PERIOD = 3600
+    UPLOAD_ID_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+    UPLOAD_NAME_RE = re.compile(r'\..+-upload-[A-Za-z0-9_-]{1,64}')
+    # Marks the partial files which we created, so that we never remove anything else
+    UPLOAD_XATTR = 'user.cockpit.upload'
+
+    # Partial upload files by name: None while in progress, or the timer that
+    # expires it while waiting to be resumed
+    partial_uploads: 'ClassVar[dict[str, asyncio.TimerHandle | None]]' = {}
 
     def delete(self, path: str, tag: 'str | None') -> str:
         if tag is not None and tag != tag_from_path(path):
@@ -200,13 +445,93 @@ class FsReplaceChannel(AsyncChannel):
             os.unlink(path)
         return '-'
 
+    def open_upload(self, upload_name: str, offset: 'int | None') -> 'tuple[int, int]':
+        """Opens (or creates) the partial file of a resumable upload
+
+        Returns the fd, positioned at the end of the content that we already
+        have, and the size of that.  If an offset is requested, the content
+        is cut back to it.
+        """
+        if upload_name in self.partial_uploads and self.partial_uploads[upload_name] is None:
+            raise ChannelError('change-conflict', message='This upload is already in progress')
+
+        fd = os.open(upload_name, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+        try:
+            buf = os.fstat(fd)
+            # In a directory which others can write to, someone else could
+            # have created it, to get the content into a file of theirs
+            if not stat.S_ISREG(buf.st_mode) or buf.st_uid != os.geteuid() or buf.st_nlink != 1:
+                raise ChannelError('access-denied', message=f'{upload_name} is not a partial upload file')
+            with contextlib.suppress(OSError):  # not every file system has user xattrs
+                os.setxattr(fd, self.UPLOAD_XATTR, b'')
+
+            size = buf.st_size
+            if time.time() - buf.st_mtime > self.UPLOAD_GRACE_PERIOD:
+                # left behind by an earlier bridge, and expired by now
+                logger.debug('discarding stale partial upload %s', upload_name)
+                size = 0
+            if offset is not None:
+                size = min(size, offset)
+            os.ftruncate(fd, size)
+            os.lseek(fd, size, os.SEEK_SET)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        expiry = self.partial_uploads.get(upload_name)
+        if expiry is not None:
+            expiry.cancel()
+        self.partial_uploads[upload_name] = None
+        return fd, size
+
+    def remove_stale_uploads(self, dirname: str) -> None:
+        """Removes expired partial files of interrupted resumable uploads
+
+        The bridge that kept them might have exited before they expired.
+        Only files which carry our UPLOAD_XATTR get removed.  This runs in a
+        worker thread, and never fails.
+        """
+        now = time.time()
+        try:
+            with os.scandir(dirname or '.') as entries:
+                for entry in entries:
+                    upload_name = os.path.join(dirname, entry.name)
+                    if not self.UPLOAD_NAME_RE.fullmatch(entry.name) or upload_name in self.partial_uploads:
+                        continue
+                    with contextlib.suppress(OSError):
+                        buf = entry.stat(follow_symlinks=False)
+                        if (stat.S_ISREG(buf.st_mode) and buf.st_uid == os.geteuid() and
+                                now - buf.st_mtime > self.UPLOAD_GRACE_PERIOD):
+                            os.getxattr(upload_name, self.UPLOAD_XATTR, follow_symlinks=False)  # fails if not ours
+                            logger.debug('removing stale partial upload %s', upload_name)
+                            os.unlink(upload_name)
+        except OSError as exc:
+            logger.debug('cannot look for stale partial uploads in %s: %s', dirname, exc)
+
+    def keep_upload(self, upload_name: str) -> None:
+        def expire() -> None:
+            logger.debug('expiring partial upload %s', upload_name)
+            del self.partial_uploads[upload_name]
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(upload_name)
+
+        self.partial_uploads[upload_name] = self.loop.call_later(self.UPLOAD_GRACE_PERIOD, expire)
+
     async def set_contents(
         self, path: str, tag: 'str | None', data: 'bytes | None', size: 'int | None',
-        attrs: 'FSReplaceAttrs | None'
+        attrs: 'FSReplaceAttrs | None', sync: str, upload: 'str | None' = None, offset: 'int | None' = None
     ) -> 'str | None':
         dirname, basename = os.path.split(path)
+
         tmpname: str | None
-        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=f'.{basename}-')
+        if upload is None:
+            fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=f'.{basename}-')
+            offset = 0
+        else:
+            await self.in_thread(self.remove_stale_uploads, dirname)
+            upload_name = tmpname = os.path.join(dirname, f'.{basename}-upload-{upload}')
+            fd, offset = self.open_upload(upload_name, offset)
+        writer = WriteBehind(fd)
 
         def chown_if_required(fd: 'int', buf: 'os.stat_result | None' = None) -> None:
             # Provided attrs are preferred over the existing file permissions
@@ -227,19 +552,25 @@ class FsReplaceChannel(AsyncChannel):
                 logger.debug('fallocate(%s.tmp, %d)', path, size)
                 if size:  # posix_fallocate() of 0 bytes is EINVAL
                     await self.in_thread(os.posix_fallocate, fd, 0, size)
-                self.ready()  # ...only after that worked
 
-            written = 0
+            if upload is not None:
+                self.ready(offset=offset)  # the client continues from there
+            elif size is not None:
+                self.ready()  # ...only after the allocation worked
+
             while data is not None:
-                await self.in_thread(os.write, fd, data)
-                written += len(data)
+                await writer.write(data)
                 data = await self.read()
+            await writer.flush()
 
-            if size is not None and written < size:
-                logger.debug('ftruncate(%s.tmp, %d)', path, written)
-                await self.in_thread(os.ftruncate, fd, written)
+            if size is not None and offset + writer.written < size:
+                logger.debug('ftruncate(%s.tmp, %d)', path, offset + writer.written)
+                await self.in_thread(os.ftruncate, fd, offset + writer.written)
 
-            await self.in_thread(os.fdatasync, fd)
+            if sync == 'data':
+                await self.in_thread(os.fdatasync, fd)
+            elif sync == 'full':
+                await self.in_thread(os.fsync, fd)
 
             if tag is None:
                 # no preconditions about what currently exists or not
@@ -254,6 +585,8 @@ class FsReplaceChannel(AsyncChannel):
                 apply_file_mode(fd)
                 chown_if_required(fd)
                 os.link(tmpname, path)  # will fail if file exists
+                os.unlink(tmpname)
+                tmpname = None
 
             else:
                 # the file must exist with the given tag
@@ -278,7 +611,27 @@ class FsReplaceChannel(AsyncChannel):
                 os.rename(tmpname, path)
                 tmpname = None
 
+            if sync == 'full':
+                # make sure that the new directory entry is on disk as well
+                dir_fd = os.open(dirname or '.', os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    await self.in_thread(os.fsync, dir_fd)
+                finally:
+                    os.close(dir_fd)
+
         finally:
+            if upload is not None and tmpname is not None:
+                # interrupted: save as much as we can for resuming
+                with contextlib.suppress(OSError):
+                    await writer.flush()
+            await writer.close()
+            if upload is not None:
+                if tmpname is not None:
+                    os.ftruncate(fd, offset + writer.completed)
+                    self.keep_upload(upload_name)
+                    tmpname = None
+                else:
+                    del self.partial_uploads[upload_name]
             os.close(fd)
             if tmpname is not None:
                 os.unlink(tmpname)
@@ -290,14 +643,23 @@ class FsReplaceChannel(AsyncChannel):
         path = get_str(options, 'path')
         size = get_int(options, 'size', None)
         tag = get_str(options, 'tag', None)
+        sync = get_enum(options, 'sync', ['data', 'full', 'none'], 'data')
+        upload = get_str(options, 'upload', None)
+        offset = get_int(options, 'offset', None)
+
+        if upload is not None and not self.UPLOAD_ID_RE.fullmatch(upload):
+            raise ChannelError('protocol-error', message=f'invalid "upload" value: {upload}')
+        if offset is not None and (upload is None or offset < 0):
+            raise ChannelError('protocol-error', message=f'invalid "offset" value: {offset}')
 
         try:
             # In the `size` case, .set_contents() sends the ready only after
-            # it knows that the allocate was successful.  In the case without
-            # `size`, we need to send the ready() up front in order to
-            # receive the first frame and decide if we're creating or deleting.
-            if size is not None:
-                tag = await self.set_contents(path, tag, b'', size, attrs)
+            # it knows that the allocate was successful.  Resumable uploads
+            # send it once they know where to continue from.  Otherwise, we
+            # need to send the ready() up front in order to receive the
+            # first frame and decide if we're creating or deleting.
+            if size is not None or upload is not None:
+                tag = await self.set_contents(path, tag, b'', size, attrs, sync, upload, offset)
             else:
                 self.ready()
                 data = await self.read()
@@ -305,7 +667,7 @@ class FsReplaceChannel(AsyncChannel):
                 if data is None:
                     tag = self.delete(path, tag)
                 else:
-                    tag = await self.set_contents(path, tag, data, None, attrs)
+                    tag = await self.set_contents(path, tag, data, None, attrs, sync)
 
             self.done()
             return {'tag': tag}
@@ -324,10 +686,436 @@ class FsReplaceChannel(AsyncChannel):
             raise ChannelError('internal-error', message=str(exc)) from exc
 
 
+FICLONE = 0x40049409  # from <linux/fs.h>
+
+
+class CopyProgress:
+    """How far a copy got, updated from the worker threads"""
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.bytes = 0
+        self.files = 0
+        self.total_bytes = 0
+        self.total_files = 0
+
+    def add(self, n_bytes: int, n_files: int = 0) -> bool:
+        with self.lock:
+            self.bytes += n_bytes
+            self.files += n_files
+        return not self.cancelled
+
+    def report(self) -> JsonDict:
+        with self.lock:
+            return {
+                'bytes': self.bytes, 'total-bytes': self.total_bytes,
+                'files': self.files, 'total-files': self.total_files,
+            }
+
+
+def copy_file_data(src_fd: int, dst_fd: int, size: int, progress: CopyProgress) -> None:
+    """Copies the content of a regular file, without passing it through userspace
+
+    A reflink shares the data blocks with the source on filesystems which
+    support that (btrfs, xfs).  Otherwise copy_file_range() lets the kernel
+    (or even the file server) do the copy.  sendfile() works everywhere.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError:
+        pass
+    else:
+        progress.add(size)
+        return
+
+    # copy_file_range() is new in Python 3.8
+    use_sendfile = not hasattr(os, 'copy_file_range')
+    while True:
+        if not use_sendfile:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, Channel.BLOCK_SIZE * 16)
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                n = -1
+            # Some filesystems (like /proc) report 0 instead of an error: let
+            # sendfile() have the final word about reaching the end
+            use_sendfile = n <= 0
+        else:
+            n = os.sendfile(dst_fd, src_fd, None, Channel.BLOCK_SIZE * 16)
+            if n == 0:
+                break
+
+        if n > 0 and not progress.add(n):
+            break
+
+
+def copy_file(src: str, dst: str, buf: os.stat_result, progress: CopyProgress) -> None:
+    if progress.cancelled:
+        return
+
+    src_fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+        try:
+            copy_file_data(src_fd, dst_fd, buf.st_size, progress)
+            os.fchmod(dst_fd, stat.S_IMODE(buf.st_mode))
+            os.fdatasync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    progress.add(0, 1)
+
+
+def is_inside(path: str, directory: str) -> bool:
+    """Checks if path is (or would be) directory itself, or somewhere below it
+
+    Symlinks are resolved, except in the last component of path, which
+    doesn't need to exist.
+    """
+    dirname, basename = os.path.split(path)
+    real_path = os.path.join(os.path.realpath(dirname or '.'), basename)
+    real_directory = os.path.realpath(directory)
+    return os.path.commonpath([real_path, real_directory]) == real_directory
+
+
+def scan_tree(
+    source: str, target: str, buf: os.stat_result, progress: CopyProgress
+) -> 'tuple[list[tuple[str, str, os.stat_result]], list[tuple[str, int]]]':
+    """Creates the skeleton of a copy of source at target
+
+    Directories and symlinks get created right away.  Returns the regular
+    files which still need to be copied, and the directories whose mode
+    needs to be set once that's done (they might not be writable anymore).
+    """
+    files: 'list[tuple[str, str, os.stat_result]]' = []
+    directories: 'list[tuple[str, int]]' = []
+    todo = [(source, target, buf)]
+
+    while todo and not progress.cancelled:
+        src, dst, buf = todo.pop()
+        if stat.S_ISREG(buf.st_mode):
+            files.append((src, dst, buf))
+            progress.total_bytes += buf.st_size
+            progress.total_files += 1
+        elif stat.S_ISDIR(buf.st_mode):
+            os.mkdir(dst, 0o700)
+            directories.append((dst, stat.S_IMODE(buf.st_mode)))
+            with os.scandir(src) as entries:
+                for entry in entries:
+                    todo.append((entry.path, os.path.join(dst, entry.name), entry.stat(follow_symlinks=False)))
+        elif stat.S_ISLNK(buf.st_mode):
+            os.symlink(os.readlink(src), dst)
+        else:
+            raise ChannelError('not-supported', message=f'{src}: only files, directories and symlinks can be copied')
+
+    return files, directories
+
+
+class FsCopyChannel(AsyncChannel):
+    payload = 'fscopy1'
+
+    COPY_WORKERS = 4
+    PROGRESS_INTERVAL = 0.5
+
+    def check_target(self, path: str, tag: 'str | None', *, is_dir: bool) -> None:
+        if is_dir:
+            # we never replace anything with a directory
+            if tag not in (None, '-') or os.path.lexists(path):
+                raise ChannelError('change-conflict')
+        elif tag is not None and tag != tag_from_path(path):
+            raise ChannelError('change-conflict')
+
+    def install(self, source: str, path: str, tag: 'str | None', *, is_dir: bool) -> None:
+        """Renames source to path, if path (still) has the expected tag"""
+        self.check_target(path, tag, is_dir=is_dir)
+        if tag == '-' and not is_dir:
+            os.link(source, path)  # will fail if file exists
+            os.unlink(source)
+        else:
+            os.rename(source, path)
+
+    async def report_progress(self, progress: CopyProgress) -> None:
+        while True:
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+            self.send_json(progress.report())
+
+    async def copy(self, source: str, target: str, buf: os.stat_result) -> None:
+        progress = CopyProgress()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.COPY_WORKERS, thread_name_prefix='FsCopy')
+        reporter = self.create_task(self.report_progress(progress))
+        futures: 'list[concurrent.futures.Future[None]]' = []
+
+        try:
+            files, directories = await self.in_thread(scan_tree, source, target, buf, progress)
+            futures = [pool.submit(copy_file, src, dst, buf, progress) for src, dst, buf in files]
+            await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+            for directory, mode in reversed(directories):
+                os.chmod(directory, mode)
+        finally:
+            # stop the workers early, if we got cancelled or something failed
+            # (shutdown() can only cancel the queued copies itself since Python 3.9)
+            progress.cancelled = True
+            reporter.cancel()
+            for future in futures:
+                future.cancel()
+            await self.in_thread(functools.partial(pool.shutdown, wait=True))
+
+        self.send_json(progress.report())
+
+    async def run(self, options: JsonObject) -> JsonObject:
+        source = get_str(options, 'source')
+        path = get_str(options, 'path')
+        tag = get_str(options, 'tag', None)
+        source_tag = get_str(options, 'source-tag', None)
+        move = get_bool(options, 'move', default=False)
+
+        try:
+            buf = os.lstat(source)
+            if source_tag is not None and source_tag != tag_from_stat(buf):
+                raise ChannelError('change-conflict')
+            is_dir = stat.S_ISDIR(buf.st_mode)
+            if is_dir and is_inside(path, source):
+                # like cp and mv, which would otherwise copy forever
+                raise ChannelError('not-supported', message=f'cannot copy {source} into itself, {path}')
+            # don't start a copy which is bound to fail: this gets checked
+            # again at the end
+            self.check_target(path, tag, is_dir=is_dir)
+            self.ready()
+
+            if move:
+                # on the same filesystem, there's nothing to copy
+                try:
+                    self.install(source, path, tag, is_dir=is_dir)
+                except OSError as exc:
+                    if exc.errno != errno.EXDEV:
+                        raise
+                else:
+                    self.done()
+                    return {'tag': tag_from_path(path)}
+
+            # Make the copy in a temporary directory next to the target,
+            # and only rename it into place once it's complete
+            dirname, basename = os.path.split(path)
+            staging = tempfile.mkdtemp(dir=dirname, prefix=f'.{basename}-')
+            try:
+                copy = os.path.join(staging, basename)
+                await self.copy(source, copy, buf)
+                self.install(copy, path, tag, is_dir=is_dir)
+            finally:
+                await self.in_thread(functools.partial(shutil.rmtree, staging, ignore_errors=True))
+
+            if move:
+                if is_dir:
+                    await self.in_thread(shutil.rmtree, source)
+                else:
+                    os.unlink(source)
+
+            self.done()
+            return {'tag': tag_from_path(path)}
+
+        except FileNotFoundError as exc:
+            raise ChannelError('not-found') from exc
+        except FileExistsError as exc:
+            # that's from link() noticing that the target file already exists
+            raise ChannelError('change-conflict') from exc
+        except PermissionError as exc:
+            raise ChannelError('access-denied') from exc
+        except IsADirectoryError as exc:
+            # not ideal, but the closest code we have
+            raise ChannelError('access-denied', message=str(exc)) from exc
+        except OSError as exc:
+            raise ChannelError('internal-error', message=str(exc)) from exc
+
+
+class DirectoryUsage(NamedTuple):
+    """What a directory itself contains: the names of its subdirectories,
+    and the total size of everything else (including itself)"""
+    tag: str
+    size: int
+    files: int
+    subdirs: 'list[str]'
+
+
+# The usage of a directory, and the names and stat() results of its subdirectories
+DirectoryScan = Tuple[DirectoryUsage, List[Tuple[str, os.stat_result]]]
+
+
+class DiskUsageCache:
+    """The usage of the directories that were scanned before, by device and inode
+
+    Entries are only valid while the directory has the same tag.  That changes
+    when entries get added or removed, but not when a file inside the
+    directory changes its size, so fsdu1 only uses it when asked to.
+    """
+    def __init__(self, max_size: int) -> None:
+        self.lock = threading.Lock()
+        self.entries: 'collections.OrderedDict[tuple[int, int], DirectoryUsage]' = collections.OrderedDict()
+        self.max_size = max_size
+
+    def get(self, buf: os.stat_result) -> 'DirectoryUsage | None':
+        key = buf.st_dev, buf.st_ino
+        with self.lock:
+            usage = self.entries.get(key)
+            if usage is None or usage.tag != tag_from_stat(buf):
+                return None
+            self.entries.move_to_end(key)
+            return usage
+
+    def put(self, buf: os.stat_result, usage: DirectoryUsage) -> None:
+        key = buf.st_dev, buf.st_ino
+        with self.lock:
+            self.entries[key] = usage
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+def scan_usage(path: str, buf: os.stat_result, cache: 'DiskUsageCache | None') -> DirectoryScan:
+    """Finds the usage of a directory, and its subdirectories (on the same filesystem)"""
+    usage = cache.get(buf) if cache is not None else None
+    if usage is not None:
+        names = usage.subdirs
+        subdirs = []
+        for name in names:
+            with contextlib.suppress(FileNotFoundError):  # races with the cache are fine
+                subdirs.append((name, os.lstat(os.path.join(path, name))))
+    else:
+        size = buf.st_blocks * 512
+        files = 0
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                with contextlib.suppress(FileNotFoundError):
+                    entry_buf = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(entry_buf.st_mode):
+                        subdirs.append((entry.name, entry_buf))
+                    else:
+                        # Hard links each get a share, so that the total works
+                        # out (and doesn't depend on the order of scanning)
+                        size += entry_buf.st_blocks * 512 // entry_buf.st_nlink
+                        files += 1
+        usage = DirectoryUsage(tag_from_stat(buf), size, files, [name for name, _ in subdirs])
+        if cache is not None:
+            cache.put(buf, usage)
+
+    # like du -x: don't descend into other filesystems
+    return usage, [(name, sub_buf) for name, sub_buf in subdirs if sub_buf.st_dev == buf.st_dev]
+
+
+class DiskUsageNode:
+    def __init__(self, path: str, depth: int, parent: 'DiskUsageNode | None') -> None:
+        self.path = path
+        self.depth = depth
+        self.parent = parent
+        self.size = 0
+        self.files = 0
+        self.pending = 0
+        self.error: 'str | None' = None
+
+
+class FsDuChannel(AsyncChannel):
+    payload = 'fsdu1'
+
+    SCAN_WORKERS = 8
+    MAX_QUEUED_SCANS = 2 * SCAN_WORKERS
+    cache = DiskUsageCache(max_size=100000)
+
+    async def run(self, options: JsonObject) -> None:
+        path = get_str(options, 'path')
+        max_depth = get_int(options, 'depth', None)
+        use_cache = get_bool(options, 'cache', default=False)
+
+        if max_depth is not None and max_depth < 0:
+            raise ChannelError('protocol-error', message=f'invalid "depth" value: {max_depth}')
+
+        try:
+            buf = os.stat(path)
+            if not stat.S_ISDIR(buf.st_mode):
+                raise ChannelError('not-supported', message=f'{path} is not a directory')
+        except FileNotFoundError as error:
+            raise ChannelError('not-found', message=str(error)) from error
+        except PermissionError as error:
+            raise ChannelError('access-denied', message=str(error)) from error
+        except OSError as error:
+            raise ChannelError('internal-error', message=str(error)) from error
+
+        self.ready()
+
+        cache = self.cache if use_cache else None
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.SCAN_WORKERS, thread_name_prefix='FsDu')
+        results: 'asyncio.Queue[tuple[DiskUsageNode, concurrent.futures.Future[DirectoryScan]]]' = asyncio.Queue()
+        # Directories which still need to be scanned.  Only a few scans are
+        # submitted to the pool at a time: this is a stack, so that we go
+        # depth first, and finish (and report) subtrees early.
+        todo: 'list[tuple[DiskUsageNode, os.stat_result]]' = []
+        running: 'set[concurrent.futures.Future[DirectoryScan]]' = set()
+
+        def scan_done(node: DiskUsageNode, future: 'concurrent.futures.Future[DirectoryScan]') -> None:
+            # This runs in the worker thread
+            self.loop.call_soon_threadsafe(results.put_nowait, (node, future))
+
+        def submit() -> None:
+            while todo and len(running) < self.MAX_QUEUED_SCANS:
+                node, buf = todo.pop()
+                future = pool.submit(scan_usage, os.path.join(path, node.path), buf, cache)
+                future.add_done_callback(functools.partial(scan_done, node))
+                running.add(future)
+
+        async def finish(node: 'DiskUsageNode | None') -> None:
+            # Report the directories in post-order: their totals are final
+            while node is not None and node.pending == 0:
+                if max_depth is None or node.depth <= max_depth:
+                    message: JsonDict = {'path': node.path, 'size': node.size, 'files': node.files}
+                    if node.error is not None:
+                        message['error'] = node.error
+                    await self.write_text(self.json_encoder.encode(message) + '\n')
+                if node.parent is not None:
+                    node.parent.size += node.size
+                    node.parent.files += node.files
+                    node.parent.pending -= 1
+                node = node.parent
+
+        try:
+            todo.append((DiskUsageNode('', 0, None), buf))
+            submit()
+            while running:
+                node, future = await results.get()
+                running.remove(future)
+                try:
+                    usage, subdirs = future.result()
+                except OSError as error:
+                    if node.parent is None:
+                        raise
+                    node.error = error.strerror
+                else:
+                    node.size += usage.size
+                    node.files += usage.files
+                    node.pending = len(subdirs)
+                    for name, sub_buf in subdirs:
+                        todo.append((DiskUsageNode(os.path.join(node.path, name), node.depth + 1, node), sub_buf))
+                submit()
+                await finish(node)
+
+        except PermissionError as error:
+            raise ChannelError('access-denied', message=str(error)) from error
+        except OSError as error:
+            raise ChannelError('internal-error', message=str(error)) from error
+        finally:
+            # (shutdown() can only cancel the queued scans itself since Python 3.9)
+            for future in running:
+                future.cancel()
+            await self.in_thread(functools.partial(pool.shutdown, wait=True))
+
+        self.done()
+
+
 class FsWatchChannel(Channel, PathWatchListener):
     payload = 'fswatch1'
     _tag: 'str | None' = None
-    _watch = None
+    _watch: 'PathWatchRef | None' = None
 
     # The C bridge doesn't send the initial event, and the JS calls read()
     # instead to figure out the initial state of the file.  If we send the
@@ -375,7 +1163,7 @@ class FsWatchChannel(Channel, PathWatchListener):
         self._tag = None
 
         self._active = False
-        self._watch = PathWatch(self._path, self)
+        self._watch = path_watches.watch(self._path, self)
         self._active = True
 
         self.ready()
@@ -392,9 +1180,35 @@ class Follow(enum.Enum):
     YES = True
 
 
+STAT_TYPES = {stat.S_IFREG: 'reg', stat.S_IFDIR: 'dir', stat.S_IFLNK: 'lnk', stat.S_IFCHR: 'chr',
+              stat.S_IFBLK: 'blk', stat.S_IFIFO: 'fifo', stat.S_IFSOCK: 'sock'}
+
+
+def type_from_dirent(entry: 'os.DirEntry[str]') -> 'JsonDict | None':
+    # Most filesystems tell us the type of the entry when reading the
+    # directory, which saves a stat() for each of them.
+    try:
+        if entry.is_symlink():
+            return {'type': 'lnk'}
+        elif entry.is_dir(follow_symlinks=False):
+            return {'type': 'dir'}
+        elif entry.is_file(follow_symlinks=False):
+            return {'type': 'reg'}
+        else:
+            return {'type': STAT_TYPES.get(stat.S_IFMT(entry.stat(follow_symlinks=False).st_mode))}
+    except FileNotFoundError:
+        return None
+    except OSError:
+        return {'type': None}
+
+
 class FsInfoChannel(Channel, PathWatchListener):
     payload = 'fsinfo'
 
+    # The initial state of a directory is sent in chunks of (up to) this many
+    # entries, as partial updates.
+    ENTRIES_CHUNK_SIZE = 1000
+
     # Options (all get set in `do_open()`)
     path: str
     attrs: 'set[str]'
@@ -402,14 +1216,17 @@ class FsInfoChannel(Channel, PathWatchListener):
     targets: bool
     follow: bool
     watch: bool
+    type_only: bool
 
     # State
     current_value: JsonDict
     effective_fnmatch: str = ''
     fd: 'Handle | None' = None
     pending: 'set[str] | None' = None
-    path_watch: 'PathWatch | None' = None
+    path_watch: 'PathWatchRef | None' = None
     getattrs: 'Callable[[int, str, Follow], JsonDocument]'
+    initial_task: 'asyncio.Task[None] | None' = None
+    write_waiter: 'asyncio.Future[None] | None' = None
 
     @staticmethod
     def make_getattrs(attrs: Iterable[str]) -> 'Callable[[int, str, Follow], JsonDocument | None]':
@@ -438,10 +1255,8 @@ class FsInfoChannel(Channel, PathWatchListener):
             except OSError:
                 return None
 
-        stat_types = {stat.S_IFREG: 'reg', stat.S_IFDIR: 'dir', stat.S_IFLNK: 'lnk', stat.S_IFCHR: 'chr',
-                      stat.S_IFBLK: 'blk', stat.S_IFIFO: 'fifo', stat.S_IFSOCK: 'sock'}
         available_stat_getters = {
-            'type': lambda buf: stat_types.get(stat.S_IFMT(buf.st_mode)),
+            'type': lambda buf: STAT_TYPES.get(stat.S_IFMT(buf.st_mode)),
             'tag': tag_from_stat,
             'mode': lambda buf: stat.S_IMODE(buf.st_mode),
             'size': lambda buf: buf.st_size,
@@ -475,20 +1290,39 @@ class FsInfoChannel(Channel, PathWatchListener):
 
         return get_attrs
 
-    def send_update(self, updates: JsonDict, *, reset: bool = False) -> None:
+    def send_update(self, updates: JsonDict, *, reset: bool = False) -> bool:
+        # A partial update (ie: the first part of a chunked initial state)
+        # keeps its "partial" flag across the reset.
         if reset:
             if set(self.current_value) & set(updates):
                 # if we have an overlap, we need to do a proper reset
                 self.send_json(dict.fromkeys(self.current_value), partial=True)
                 self.current_value = {'partial': True}
-                updates.update(partial=None)
+                updates.setdefault('partial', None)
             else:
                 # otherwise there's no overlap: we can just remove the old keys
-                updates.update(dict.fromkeys(self.current_value))
+                for key in self.current_value:
+                    updates.setdefault(key, None)
 
         json_merge_and_filter_patch(self.current_value, updates)
         if updates:
-            self.send_json(updates)
+            return self.send_json(updates)
+        return True
+
+    def get_targets(self, fd: int, entries: JsonDict) -> JsonDict:
+        # 'targets' is used to report attributes about the ultimate target
+        # of symlinks, but only if this information would not already be
+        # reported.  As such, we exclude '.' and any path which would end
+        # up in 'entries' (if it existed).  '..' needs special treatment:
+        # it might be `.interesting()` but it won't be in 'entries', so
+        # it's always treated as a target.
+        targets: JsonDict = {}
+        for name in {e.get('target') for e in entries.values() if isinstance(e, dict)}:
+            if isinstance(name, str) and name != '.':
+                # exclude anything that would end up in 'entries'
+                if (name == '..' or '/' in name or not self.interesting(name)):
+                    targets[name] = self.getattrs(fd, name, Follow.YES)
+        return targets
 
     def process_update(self, updates: 'set[str]', *, reset: bool = False) -> None:
         assert self.fd is not None
@@ -502,23 +1336,98 @@ class FsInfoChannel(Channel, PathWatchListener):
             info['entries'] = entries
 
         if self.targets:
-            info['targets'] = targets = {}
-            # 'targets' is used to report attributes about the ultimate target
-            # of symlinks, but only if this information would not already be
-            # reported.  As such, we exclude '.' and any path which would end
-            # up in 'entries' (if it existed).  '..' needs special treatment:
-            # it might be `.interesting()` but it won't be in 'entries', so
-            # it's always treated as a target.
-            for name in {e.get('target') for e in entries.values() if isinstance(e, dict)}:
-                if isinstance(name, str) and name != '.':
-                    # exclude anything that would end up in 'entries'
-                    if (name == '..' or '/' in name or not self.interesting(name)):
-                        targets[name] = self.getattrs(self.fd, name, Follow.YES)
+            info['targets'] = self.get_targets(self.fd, entries)
 
         self.send_update({'info': info}, reset=reset)
 
+    def read_entries(
+        self, scan_dir: 'Iterator[os.DirEntry[str]]', dir_fd: int, count: int
+    ) -> 'tuple[JsonDict, JsonDict, bool]':
+        # This runs in a worker thread.  Returns the next (up to) `count`
+        # interesting entries, their targets, and if there might be more.
+        entries: JsonDict = {}
+        more = False
+        for entry in scan_dir:
+            if self.interesting(entry.name):
+                if self.type_only:
+                    entries[entry.name] = type_from_dirent(entry)
+                else:
+                    entries[entry.name] = self.getattrs(dir_fd, entry.name, Follow.NO)
+                if len(entries) == count:
+                    more = True
+                    break
+
+        return entries, self.get_targets(dir_fd, entries) if self.targets else {}, more
+
+    async def report_entries(
+        self, dir_fd: int, scan_dir: 'Iterator[os.DirEntry[str]] | None', resources: contextlib.ExitStack
+    ) -> None:
+        # Sends the initial state.  For directories, the stat() calls happen in
+        # a worker thread, and large directories get sent as a series of
+        # partial updates, each of which waits for the flow control window.
+        #
+        # If the identity of the path changes in the meantime, or the channel
+        # gets closed, this task gets replaced and just stops.  It doesn't get
+        # cancelled, since the worker thread might still be using the fd.
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+
+        with resources:
+            if self.initial_task is not task:
+                return
+
+            info = self.getattrs(dir_fd, '', Follow.NO)
+            assert isinstance(info, dict)  # fstat() will never fail with FileNotFoundError
+
+            if scan_dir is None:
+                self.send_update({'info': info}, reset=True)
+            else:
+                more, reset = True, True
+                while more:
+                    entries, targets, more = await loop.run_in_executor(
+                        None, self.read_entries, scan_dir, dir_fd, self.ENTRIES_CHUNK_SIZE
+                    )
+                    if self.initial_task is not task:
+                        return
+
+                    info['entries'] = entries
+                    if self.targets:
+                        info['targets'] = targets
+                    if not self.send_update({'info': info, 'partial': True if more else None}, reset=reset):
+                        self.write_waiter = loop.create_future()
+                        await self.write_waiter
+                        if self.initial_task is not task:
+                            return
+                    info, reset = {}, False
+
+        self.initial_task = None
+        self.initial_state_sent()
+
+    def initial_state_sent(self) -> None:
+        if not self.watch:
+            self.done()
+            self.close()
+
+    def stop_initial_state(self) -> None:
+        self.initial_task = None
+        self.do_resume_send()
+
+    def do_resume_send(self) -> None:
+        if self.write_waiter is not None:
+            self.write_waiter.set_result(None)
+            self.write_waiter = None
+
     def process_pending_updates(self) -> None:
         assert self.pending is not None
+        if self.is_closing():
+            return
+
+        if self.initial_task is not None:
+            # These would race with the initial state: process them once it's
+            # sent.  If the task gets replaced, we end up waiting for the new one.
+            self.initial_task.add_done_callback(lambda _task: self.process_pending_updates())
+            return
+
         if self.pending:
             self.process_update(self.pending)
         self.pending = None
@@ -570,20 +1479,27 @@ class FsInfoChannel(Channel, PathWatchListener):
 
     def report_initial_state(self, fd: Handle) -> None:
         if self.flag_onlydir_error(fd):
+            self.initial_state_sent()
             return
 
         self.fd = fd
 
-        entries = {''}
+        # The initial state gets reported from a task, with its own copy of
+        # the fd, which stays valid even if the PathWatch closes this one.
+        resources = contextlib.ExitStack()
+        dir_fd = os.dup(fd)
+        resources.callback(os.close, dir_fd)
+
+        scan_dir = None
         if self.fnmatch:
             try:
-                entries.update(os.listdir(f'/proc/self/fd/{self.fd}'))
+                scan_dir = resources.enter_context(os.scandir(f'/proc/self/fd/{dir_fd}'))
                 self.effective_fnmatch = self.fnmatch
             except OSError:
                 # If we failed to get an initial list, then report nothing from now on
                 self.effective_fnmatch = ''
 
-        self.process_update({e for e in entries if self.interesting(e)}, reset=True)
+        self.initial_task = self.create_task(self.report_entries(dir_fd, scan_dir, resources))
 
     def do_inotify_event(self, mask: InotifyEvent, cookie: int, rawname: 'bytes | None') -> None:
         logger.debug('do_inotify_event(%r, %r, %r)', mask, cookie, rawname)
@@ -598,6 +1514,8 @@ class FsInfoChannel(Channel, PathWatchListener):
 
     def do_identity_changed(self, fd: 'Handle | None', err: 'int | None') -> None:
         logger.debug('do_identity_changed(%r, %r)', fd, err)
+        self.stop_initial_state()
+
         # If there were previously pending changes, they are now irrelevant.
         if self.pending is not None:
             # Note: don't set to None, since the handler is still pending
@@ -610,9 +1528,9 @@ class FsInfoChannel(Channel, PathWatchListener):
             self.report_error(err)
 
     def do_close(self) -> None:
-        # non-watch channels close immediately — if we get this, we're watching
-        assert self.path_watch is not None
-        self.path_watch.close()
+        if self.path_watch is not None:
+            self.path_watch.close()
+        self.stop_initial_state()
         self.close()
 
     def do_open(self, options: JsonObject) -> None:
@@ -623,6 +1541,7 @@ class FsInfoChannel(Channel, PathWatchListener):
         attrs = set(get_strv(options, 'attrs'))
         self.getattrs = self.make_getattrs(attrs - {'targets', 'entries'})
         self.fnmatch = get_str(options, 'fnmatch', '*' if 'entries' in attrs else '')
+        self.type_only = attrs - {'targets', 'entries'} == {'type'}
         self.targets = 'targets' in attrs
         self.follow = get_bool(options, 'follow', default=True)
         self.watch = get_bool(options, 'watch', default=False)
@@ -640,15 +1559,13 @@ class FsInfoChannel(Channel, PathWatchListener):
             except OSError as exc:
                 assert exc.errno  # noqa: PT017 - mypy thinks that errno can be None
                 self.report_error(exc.errno)
+                self.initial_state_sent()
             else:
                 self.report_initial_state(fd)
                 fd.close()
 
-            self.done()
-            self.close()
-
         else:
             # PathWatch will call do_identity_changed(), which does the same as
             # above: calls either report_initial_state() or report_error(),
             # depending on if it was provided with an fd or an error code.
-            self.path_watch = PathWatch(self.path, self)
+            self.path_watch = path_watches.watch(self.path, self)
@@ -3,7 +3,6 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 
-import asyncio
 import json
 import logging
 import sys
@@ -12,8 +11,9 @@ from collections import defaultdict
 from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Type, Union
 
 from ..channel import AsyncChannel, ChannelError
-from ..jsonutil import JsonList, JsonObject, get_int
-from ..samples import SAMPLERS, SampleDescription, Sampler, Samples
+from ..jsonutil import JsonDict, JsonList, JsonObject, get_int
+from ..samplerhub import sampler_hub
+from ..samples import SAMPLERS, BridgeSampler, SampleDescription, Sampler, Samples
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +28,8 @@ class InternalMetricsChannel(AsyncChannel):
     restrictions = [('source', 'internal')]
 
     metrics: List[MetricInfo]
-    samplers: Set[Sampler]
+    samplers: Set[Type[Sampler]]
+    last_samples: Samples
     samplers_cache: Optional[Dict[str, Tuple[Type[Sampler], SampleDescription]]] = None
 
     interval: int = 1000
@@ -39,7 +40,8 @@ class InternalMetricsChannel(AsyncChannel):
     @classmethod
     def ensure_samplers(cls) -> None:
         if cls.samplers_cache is None:
-            cls.samplers_cache = {desc.name: (sampler, desc) for sampler in SAMPLERS for desc in sampler.descriptions}
+            samplers: Tuple[Type[Sampler], ...] = (*SAMPLERS, BridgeSampler)
+            cls.samplers_cache = {desc.name: (sampler, desc) for sampler in samplers for desc in sampler.descriptions}
 
     def parse_options(self, options: JsonObject) -> None:
         logger.debug('metrics internal open: %s, channel: %s', options, self.channel)
@@ -56,7 +58,6 @@ class InternalMetricsChannel(AsyncChannel):
             raise ChannelError('protocol-error', message='invalid "metrics" option was specified (not an array)')
 
         assert self.samplers_cache, "ensure_samples not called"
-        sampler_classes = set()
         for metric in metrics:
             # validate it's an object
             name = metric.get('name')
@@ -72,12 +73,10 @@ class InternalMetricsChannel(AsyncChannel):
             if units and units != desc.units:
                 raise ChannelError('not-supported', message=f'{name} has units {desc.units}, not {units}')
 
-            sampler_classes.add(sampler)
+            self.samplers.add(sampler)
             self.metrics.append(MetricInfo(derive=derive, desc=desc))
 
-        self.samplers = {cls() for cls in sampler_classes}
-
-    def send_meta(self, samples: Samples, timestamp: float) -> None:
+    def send_meta(self, samples: Samples, timestamp: float, skipped: int) -> None:
         metrics: JsonList = []
         for metricinfo in self.metrics:
             if metricinfo.desc.instanced:
@@ -96,25 +95,21 @@ class InternalMetricsChannel(AsyncChannel):
                 })
 
         now = int(time.time()) * 1000
-        self.send_json(source='internal', interval=self.interval, timestamp=timestamp * 1000,
-                       now=now, metrics=metrics)
+        meta: JsonDict = {'source': 'internal', 'interval': self.interval, 'timestamp': timestamp * 1000,
+                          'now': now, 'metrics': metrics}
+        if skipped:
+            meta['skipped'] = skipped
+        self.send_json(meta)
         self.need_meta = False
 
-    def sample(self) -> Samples:
-        samples: Samples = defaultdict(dict)
-        for sampler in self.samplers:
-            sampler.sample(samples)
-        return samples
-
     def calculate_sample_rate(self, value: float, old_value: Optional[float]) -> Union[float, bool]:
         if old_value is not None:
             return (value - old_value) / (self.next_timestamp - self.last_timestamp)
         else:
             return False
 
-    def send_updates(self, samples: Samples, last_samples: Samples) -> None:
+    def send_updates(self, samples: Samples, last_samples: Samples, timestamp: float, skipped: int) -> None:
         data: List[Union[float, List[Optional[Union[float, bool]]]]] = []
-        timestamp = time.time()
         self.next_timestamp = timestamp
 
         for metricinfo in self.metrics:
@@ -147,12 +142,20 @@ class InternalMetricsChannel(AsyncChannel):
                 else:
                     data.append(value)
 
+        # The client counts the time of each sample from the last meta message
+        if skipped or abs(timestamp - self.last_timestamp - self.interval / 1000) > 0.001:
+            self.need_meta = True
+
         if self.need_meta:
-            self.send_meta(samples, timestamp)
+            self.send_meta(samples, timestamp, skipped)
 
         self.last_timestamp = self.next_timestamp
         self.send_text(json.dumps([data]))
 
+    def receive_samples(self, samples: Samples, timestamp: float, skipped: int) -> None:
+        self.send_updates(samples, self.last_samples, timestamp, skipped)
+        self.last_samples = samples
+
     async def run(self, options: JsonObject) -> None:
         self.metrics = []
         self.samplers = set()
@@ -162,9 +165,10 @@ class InternalMetricsChannel(AsyncChannel):
         self.parse_options(options)
         self.ready()
 
-        last_samples: Samples = defaultdict(dict)
-        while True:
-            samples = self.sample()
-            self.send_updates(samples, last_samples)
-            last_samples = samples
-            await asyncio.sleep(self.interval / 1000)
+        # The samples are shared with the other metrics1 channels: only read them
+        self.last_samples = defaultdict(dict)
+        subscription = sampler_hub.subscribe(self.interval, self.samplers, self.router.stats, self.receive_samples)
+        try:
+            await subscription.failed
+        finally:
+            subscription.close()
@@ -11,11 +11,12 @@ import logging
 import os
 import pwd
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Optional, Sequence
 
-from cockpit._vendor.systemd_ctypes import Variant, bus, inotify, pathwatch
+from cockpit._vendor.systemd_ctypes import Variant, bus, inotify
 
-from . import config
+from . import config, pathwatches, samplerhub
+from .stats import Stats
 
 logger = logging.getLogger(__name__)
 
@@ -54,7 +55,7 @@ class cockpit_LoginMessages(bus.Object):
 
 class cockpit_Machines(bus.Object):
     path: Path
-    watch: pathwatch.PathWatch
+    watch: pathwatches.PathWatchRef
     pending_notify: Optional[asyncio.Handle]
 
     # D-Bus implementation
@@ -122,7 +123,7 @@ class cockpit_Machines(bus.Object):
 
         # ignore the first callback
         self.pending_notify = ...
-        self.watch = pathwatch.PathWatch(str(self.path), self)
+        self.watch = pathwatches.path_watches.watch(str(self.path), self)
         self.pending_notify = None
 
 
@@ -153,6 +154,99 @@ class cockpit_User(bus.Object):
         self.groups = groups
 
 
+class cockpit_Stats(bus.Object):
+    """The bridge's performance counters.
+
+    The values are computed when they are read, so there are no change
+    notifications: poll them with GetAll.  The main loop lag is only
+    measured while someone polls it.
+    """
+    stats: Stats
+
+    payloads = bus.Interface.Property('a{sa{st}}')
+    channels = bus.Interface.Property('a{sa{sv}}')
+    ready_latency = bus.Interface.Property('a{sat}')
+    ready_latency_buckets = bus.Interface.Property('ad')
+    queued_bytes = bus.Interface.Property('t')
+    input_paused = bus.Interface.Property('b')
+    write_buffer_size = bus.Interface.Property('t')
+    loop_lag = bus.Interface.Property('d')
+    loop_lag_max = bus.Interface.Property('d')
+    path_watches = bus.Interface.Property('t')
+    path_watch_listeners = bus.Interface.Property('t')
+    sampler_timings = bus.Interface.Property('a{sa{sd}}')
+    sampler_missed_ticks = bus.Interface.Property('t')
+
+    @payloads.getter
+    def get_payloads(self) -> Dict[str, Dict[str, int]]:
+        return self.stats.get_payloads()
+
+    @staticmethod
+    def get_variant(value: 'int | float | str') -> Variant:
+        if isinstance(value, str):
+            return Variant(value, 's')
+        elif isinstance(value, float):
+            return Variant(value, 'd')
+        else:
+            return Variant(value, 't')
+
+    @channels.getter
+    def get_channels(self) -> Dict[str, Dict[str, Variant]]:
+        return {
+            channel: {key: self.get_variant(value) for key, value in values.items()}
+            for channel, values in self.stats.get_channels().items()
+        }
+
+    @ready_latency.getter
+    def get_ready_latency(self) -> Dict[str, Sequence[int]]:
+        return self.stats.get_ready_latency()
+
+    @ready_latency_buckets.getter
+    def get_ready_latency_buckets(self) -> Sequence[float]:
+        return self.stats.READY_LATENCY_BUCKETS
+
+    @queued_bytes.getter
+    def get_queued_bytes(self) -> int:
+        return self.stats.get_queued_bytes()
+
+    @input_paused.getter
+    def get_input_paused(self) -> bool:
+        return self.stats.get_input_paused()
+
+    @write_buffer_size.getter
+    def get_write_buffer_size(self) -> int:
+        return self.stats.get_write_buffer_size()
+
+    @loop_lag.getter
+    def get_loop_lag(self) -> float:
+        self.stats.poll_loop_lag()
+        return self.stats.loop_lag
+
+    @loop_lag_max.getter
+    def get_loop_lag_max(self) -> float:
+        self.stats.poll_loop_lag()
+        return self.stats.loop_lag_max
+
+    @path_watches.getter
+    def get_path_watches(self) -> int:
+        return pathwatches.path_watches.get_n_watches()
+
+    @path_watch_listeners.getter
+    def get_path_watch_listeners(self) -> int:
+        return pathwatches.path_watches.get_n_listeners()
+
+    @sampler_timings.getter
+    def get_sampler_timings(self) -> Dict[str, Dict[str, float]]:
+        return samplerhub.sampler_hub.get_timings()
+
+    @sampler_missed_ticks.getter
+    def get_sampler_missed_ticks(self) -> int:
+        return samplerhub.sampler_hub.get_n_missed()
+
+    def __init__(self, stats: Stats) -> None:
+        self.stats = stats
+
+
 EXPORTS = [
     ('/LoginMessages', cockpit_LoginMessages),
     ('/machines', cockpit_Machines),
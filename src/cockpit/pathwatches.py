@@ -0,0 +1,110 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+from typing import Dict, List, Optional
+
+from cockpit._vendor.systemd_ctypes import Handle, PathWatch, inotify
+from cockpit._vendor.systemd_ctypes.pathwatch import Listener
+
+logger = logging.getLogger(__name__)
+
+
+class SharedPathWatch(Listener):
+    """A PathWatch on a path, relaying its events to any number of listeners"""
+    path: str
+    listeners: List[Listener]
+    watch: Optional[PathWatch] = None
+
+    # The last reported identity, for new listeners
+    identified: bool = False
+    fd: Optional[Handle] = None
+    err: Optional[int] = None
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.listeners = []
+        self.watch = PathWatch(path, self)
+
+    def listening(self) -> List[Listener]:
+        # Listeners can go away (or come) while we're dispatching to them
+        return list(self.listeners)
+
+    def do_inotify_event(self, mask: inotify.Event, cookie: int, name: Optional[bytes]) -> None:
+        for listener in self.listening():
+            if listener in self.listeners:
+                listener.do_inotify_event(mask, cookie, name)
+
+    def do_identity_changed(self, fd: Optional[Handle], err: Optional[int]) -> None:
+        self.identified = True
+        self.fd = fd
+        self.err = err
+        for listener in self.listening():
+            if listener in self.listeners:
+                listener.do_identity_changed(fd, err)
+
+    def close(self) -> None:
+        if self.watch is not None:
+            self.watch.close()
+            self.watch = None
+            self.fd = None
+
+
+class PathWatchRef:
+    """A listener's reference to a shared PathWatch.  close() it when done."""
+    def __init__(self, registry: 'PathWatches', shared: SharedPathWatch, listener: Listener) -> None:
+        self.registry = registry
+        self.shared: Optional[SharedPathWatch] = shared
+        self.listener = listener
+
+    def close(self) -> None:
+        if self.shared is not None:
+            self.registry.release(self.shared, self.listener)
+            self.shared = None
+
+
+class PathWatches:
+    """Shares a single PathWatch per path between everyone who watches it
+
+    Every PathWatch has inotify watches on its path, and on the directories
+    leading up to it, and decodes all of their events.  The fswatch1 and
+    fsinfo channels of several browser tabs often watch the same paths, so
+    they get to share those here.
+
+    A new listener immediately gets told about the current identity of the
+    path, just like when creating a PathWatch of its own.
+    """
+    watches: Dict[str, SharedPathWatch]
+
+    def __init__(self) -> None:
+        self.watches = {}
+
+    def watch(self, path: str, listener: Listener) -> PathWatchRef:
+        shared = self.watches.get(path)
+        if shared is None:
+            logger.debug('Creating shared PathWatch for %s', path)
+            shared = self.watches[path] = SharedPathWatch(path)
+
+        shared.listeners.append(listener)
+        if shared.identified:
+            listener.do_identity_changed(shared.fd, shared.err)
+
+        return PathWatchRef(self, shared, listener)
+
+    def release(self, shared: SharedPathWatch, listener: Listener) -> None:
+        shared.listeners.remove(listener)
+        if not shared.listeners:
+            logger.debug('Closing shared PathWatch for %s', shared.path)
+            shared.close()
+            del self.watches[shared.path]
+
+    def get_n_watches(self) -> int:
+        """The number of PathWatches (each with its own set of inotify watches)"""
+        return len(self.watches)
+
+    def get_n_listeners(self) -> int:
+        return sum(len(shared.listeners) for shared in self.watches.values())
+
+
+path_watches = PathWatches()
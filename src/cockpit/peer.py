@@ -199,10 +199,11 @@ class Peer(CockpitProtocol, SubprocessProtocol, Endpoint):
             raise CockpitProtocolError('Received unexpected channel control message before init')
         self.send_channel_control(channel, command, message)
 
-    def channel_data_received(self, channel: str, data: bytes) -> None:
+    def channel_frame_received(self, channel: str, frame: memoryview) -> None:
         if self.init_future is not None:
             raise CockpitProtocolError('Received unexpected channel data before init')
-        self.send_channel_data(channel, data)
+        # No need to look at the data: relay the frame as it is
+        self.send_channel_frame(channel, frame)
 
     # Forwarding data: from the router to the peer
     def do_channel_control(self, channel: str, command: str, message: JsonObject) -> None:
@@ -213,6 +214,14 @@ class Peer(CockpitProtocol, SubprocessProtocol, Endpoint):
         assert self.init_future is None
         self.write_channel_data(channel, data)
 
+    def do_channel_frame(self, channel: str, frame: memoryview) -> None:
+        if self.is_frozen():
+            # the frame needs to be copied before it gets queued
+            super().do_channel_frame(channel, frame)
+        else:
+            assert self.init_future is None
+            self.write_frame(channel, frame)
+
     def do_kill(self, host: 'str | None', group: 'str | None', message: JsonObject) -> None:
         assert self.init_future is None
         self.write_control(message)
@@ -220,6 +229,15 @@ class Peer(CockpitProtocol, SubprocessProtocol, Endpoint):
     def do_close(self) -> None:
         self.close()
 
+    # Flow control: stop forwarding while the router is backed up
+    def do_pause_output(self) -> None:
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def do_resume_output(self) -> None:
+        if self.transport is not None:
+            self.transport.resume_reading()
+
 
 class ConfiguredPeer(Peer):
     config: BridgeConfig
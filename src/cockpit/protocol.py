@@ -6,12 +6,17 @@
 import asyncio
 import json
 import logging
+import re
+import sys
 import traceback
+from typing import Callable, ClassVar
 
 from .jsonutil import JsonError, JsonObject, JsonValue, create_object, get_int, get_str, get_str_or_none, typechecked
 
 logger = logging.getLogger(__name__)
 
+NEWLINE = re.compile(rb'\n')
+
 
 class CockpitProblem(Exception):
     """A type of exception that carries a problem code and a message.
@@ -46,17 +51,47 @@ class CockpitProtocolError(CockpitProblem):
         super().__init__(problem, message=message)
 
 
-class CockpitProtocol(asyncio.Protocol):
-    """A naive implementation of the Cockpit frame protocol
+# asyncio.BufferedProtocol is new in Python 3.7: older transports feed us via
+# .data_received(), which works for any asyncio.Protocol
+if sys.version_info >= (3, 7):
+    ProtocolBase = asyncio.BufferedProtocol
+else:
+    ProtocolBase = asyncio.Protocol
+
+
+class CockpitProtocol(ProtocolBase):
+    """An implementation of the Cockpit frame protocol
 
-    We need to use this because Python's SelectorEventLoop doesn't supported
-    buffered protocols.
+    We try to find a good balance between not making too many small reads and
+    not making too many large copies.  Most incoming messages to the bridge
+    are high tens to low hundreds of bytes, and they often come grouped
+    together.  We read them in medium-sized chunks into a reusable buffer and
+    process as many frames as we can in a single iteration.  If a chunk ends
+    with a partial frame, we leave it for the next iteration, which is the only
+    place we copy data around.
+
+    Large frames are handled by sizing the buffer for the next read according
+    to the length prefix of the frame, so that we don't have to copy (most of)
+    their content.  Once the large frame is consumed, we go back to a buffer of
+    the usual size.
+
+    Transports which don't support asyncio.BufferedProtocol can still feed us
+    via .data_received(), at the cost of a copy.
     """
     transport: 'asyncio.Transport | None' = None
-    buffer = b''
+    _write_message: 'Callable[..., None] | None' = None
     _closed: bool = False
     _communication_done: 'asyncio.Future[None] | None' = None
 
+    # Receive buffer book-keeping: the data between _buffer_start and
+    # _buffer_end has been read but not yet consumed.  The size is picked to
+    # hold a good number of control messages, or a few blocks of channel data.
+    min_buffer_size: ClassVar[int] = 64 * 1024
+    max_buffer_size: ClassVar[int] = 4 * min_buffer_size
+    _buffer: 'memoryview | None' = None
+    _buffer_start: int = 0
+    _buffer_end: int = 0
+
     def do_ready(self) -> None:
         pass
 
@@ -72,16 +107,33 @@ class CockpitProtocol(asyncio.Protocol):
     def channel_data_received(self, channel: str, data: bytes) -> None:
         raise NotImplementedError
 
-    def frame_received(self, frame: bytes) -> None:
-        header, _, data = frame.partition(b'\n')
+    def frame_received(self, frame: memoryview) -> None:
+        """Handles a single complete frame.
 
-        if header != b'':
-            channel = header.decode('ascii')
-            logger.debug('data received: %d bytes of data for channel %s', len(data), channel)
-            self.channel_data_received(channel, data)
+        The frame is a view into our receive buffer, which will be reused after
+        this function returns, so anything which gets passed on is copied.
+        """
+        match = NEWLINE.search(frame)
+        if match is None:
+            raise CockpitProtocolError('frame has no channel header')
+        newline = match.start()
+
+        if newline != 0:
+            self.channel_frame_received(str(frame[:newline], 'ascii'), frame)
 
         else:
-            self.control_received(data)
+            self.control_received(bytes(frame[1:]))
+
+    def channel_frame_received(self, channel: str, frame: memoryview) -> None:
+        """Handles a data frame, including its channel header.
+
+        This can be overridden to relay frames without decoding them.  The
+        default implementation copies out the payload and passes it to
+        .channel_data_received().
+        """
+        data = bytes(frame[len(channel) + 1:])
+        logger.debug('data received: %d bytes of data for channel %s', len(data), channel)
+        self.channel_data_received(channel, data)
 
     def control_received(self, data: bytes) -> None:
         try:
@@ -99,23 +151,24 @@ class CockpitProtocol(asyncio.Protocol):
         except (json.JSONDecodeError, JsonError) as exc:
             raise CockpitProtocolError(f'control message: {exc!s}') from exc
 
-    def consume_one_frame(self, data: bytes) -> int:
+    def consume_one_frame(self, data: memoryview) -> int:
         """Consumes a single frame from view.
 
         Returns positive if a number of bytes were consumed, or negative if no
         work can be done because of a given number of bytes missing.
         """
 
-        try:
-            newline = data.index(b'\n')
-        except ValueError as exc:
+        # The size line is at most 9 digits plus the newline
+        size_line = bytes(data[:10])
+        newline = size_line.find(b'\n')
+        if newline == -1:
             if len(data) < 10:
                 # Let's try reading more
                 return len(data) - 10
-            raise CockpitProtocolError("size line is too long") from exc
+            raise CockpitProtocolError("size line is too long")
 
         try:
-            length = int(data[:newline])
+            length = int(size_line[:newline])
         except ValueError as exc:
             raise CockpitProtocolError("frame size is not an integer") from exc
 
@@ -130,10 +183,66 @@ class CockpitProtocol(asyncio.Protocol):
         self.frame_received(data[start:end])
         return end
 
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        if self._buffer is None:
+            self._buffer = memoryview(bytearray(self.min_buffer_size))
+        return self._buffer[self._buffer_end:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        assert self._buffer is not None
+        self._buffer_end += nbytes
+
+        try:
+            while True:
+                result = self.consume_one_frame(self._buffer[self._buffer_start:self._buffer_end])
+                if result <= 0:
+                    break
+                self._buffer_start += result
+        except CockpitProtocolError as exc:
+            # Drop whatever is left: we can't find the next frame anyway
+            self._buffer_start = self._buffer_end = 0
+            self.close(exc)
+            return
+
+        self._prepare_buffer(-result)
+
+    def _prepare_buffer(self, missing: int) -> None:
+        # Make sure the buffer has room for the remainder of the current frame
+        assert self._buffer is not None
+        pending = self._buffer_end - self._buffer_start
+        size = len(self._buffer)
+
+        if pending == 0:
+            # This is the easy case: we consumed everything.  Reuse the buffer,
+            # unless it was enlarged to hold a large frame.
+            self._buffer_start = self._buffer_end = 0
+            if size > self.max_buffer_size:
+                self._buffer = memoryview(bytearray(self.min_buffer_size))
+            return
+
+        needed = pending + missing
+        if self._buffer_start + needed <= size:
+            # The rest of the frame fits where it is.
+            return
+
+        # Otherwise, we need to move the leftover data to the start of the
+        # buffer.  If it fits without overlapping, we can do that in place.
+        # Else, we allocate a new buffer.
+        if needed <= size and pending <= self._buffer_start:
+            new_buffer = self._buffer
+        else:
+            new_buffer = memoryview(bytearray(max(needed, self.min_buffer_size)))
+        new_buffer[:pending] = self._buffer[self._buffer_start:self._buffer_end]
+        self._buffer = new_buffer
+        self._buffer_start = 0
+        self._buffer_end = pending
+
     def connection_made(self, transport: asyncio.BaseTransport) -> None:
         logger.debug('connection_made(%s)', transport)
         assert isinstance(transport, asyncio.Transport)
         self.transport = transport
+        # Our own transports let control messages overtake queued data
+        self._write_message = getattr(transport, 'write_message', None)
         self.do_ready()
 
         if self._closed:
@@ -144,6 +253,7 @@ class CockpitProtocol(asyncio.Protocol):
         logger.debug('connection_lost')
         assert self.transport is not None
         self.transport = None
+        self._write_message = None
         self.close(exc)
 
     def close(self, exc: 'Exception | None' = None) -> None:
@@ -156,33 +266,57 @@ class CockpitProtocol(asyncio.Protocol):
 
         self.do_closed(exc)
 
-    def write_channel_data(self, channel: str, payload: bytes) -> None:
+    def _write(
+        self, parts: 'tuple[bytes, bytes | memoryview]', channel: 'str | None', *, urgent: bool = False
+    ) -> None:
+        if self.transport is None:
+            logger.debug('cannot write to closed transport')
+        elif self._write_message is not None:
+            # Avoid copying the payload: our transports write both in one go
+            self._write_message(parts, channel, urgent=urgent)
+        else:
+            self.transport.writelines(parts)
+
+    def write_channel_data(self, channel: str, payload: 'bytes | memoryview') -> None:
         """Send a given payload (bytes) on channel (string)"""
         # Channel is certainly ascii (as enforced by .encode() below)
         frame_length = len(channel + '\n') + len(payload)
         header = f'{frame_length}\n{channel}\n'.encode('ascii')
-        if self.transport is not None:
-            logger.debug('writing to transport %s', self.transport)
-            self.transport.write(header + payload)
-        else:
-            logger.debug('cannot write to closed transport')
+        logger.debug('writing to transport %s', self.transport)
+        self._write((header, payload), channel or None)
+
+    def write_frame(self, channel: str, frame: 'bytes | memoryview') -> None:
+        """Send a complete data frame (channel header and payload) as-is"""
+        # The frame is often a view into a receive buffer which is about to
+        # be reused, so we need to copy it.  Our transports won't copy bytes.
+        self._write((b'%d\n' % len(frame), bytes(frame)), channel)
 
     def write_control(self, msg: 'JsonObject | None' = None, **kwargs: JsonValue) -> None:
-        """Write a control message.  See jsonutil.create_object() for details."""
+        """Write a control message.  See jsonutil.create_object() for details.
+
+        Control messages for a channel can overtake data queued for other
+        channels, if the transport supports it.  They stay in order with the
+        data of their own channel.
+        """
         logger.debug('sending control message %r %r', msg, kwargs)
-        pretty = json.dumps(create_object(msg, kwargs), indent=2) + '\n'
-        self.write_channel_data('', pretty.encode())
+        message = create_object(msg, kwargs)
+        payload = (json.dumps(message, indent=2) + '\n').encode()
+        header = b'%d\n\n' % (len(payload) + 1)
+        channel = message.get('channel')
+        if isinstance(channel, str):
+            self._write((header, payload), channel, urgent=True)
+        else:
+            self._write((header, payload), None)
 
     def data_received(self, data: bytes) -> None:
-        try:
-            self.buffer += data
-            while self.buffer:
-                result = self.consume_one_frame(self.buffer)
-                if result <= 0:
-                    return
-                self.buffer = self.buffer[result:]
-        except CockpitProtocolError as exc:
-            self.close(exc)
+        # For transports which don't support BufferedProtocol
+        view = memoryview(data)
+        while view and not self._closed:
+            buffer = self.get_buffer(len(view))
+            nbytes = min(len(buffer), len(view))
+            buffer[:nbytes] = view[:nbytes]
+            view = view[nbytes:]
+            self.buffer_updated(nbytes)
 
     def eof_received(self) -> bool:
         return False
@@ -6,10 +6,11 @@
 import asyncio
 import collections
 import logging
-from typing import Dict, List, Optional
+from typing import ClassVar, Dict, List, Optional
 
 from .jsonutil import JsonObject, JsonValue
 from .protocol import CockpitProblem, CockpitProtocolError, CockpitProtocolServer
+from .stats import Stats
 
 logger = logging.getLogger(__name__)
 
@@ -53,6 +54,9 @@ class Endpoint:
         router.add_endpoint(self)
         self.router = router
 
+    def is_frozen(self) -> bool:
+        return self.__endpoint_frozen_queue is not None
+
     def freeze_endpoint(self) -> None:
         assert self.__endpoint_frozen_queue is None
         logger.debug('Freezing endpoint %s', self)
@@ -74,21 +78,59 @@ class Endpoint:
     def do_channel_data(self, channel: str, data: bytes) -> None:
         raise NotImplementedError
 
+    def do_channel_frame(self, channel: str, frame: memoryview) -> None:
+        """Handles a complete data frame (channel header and payload).
+
+        The frame is only valid for the duration of the call.  Endpoints which
+        can pass frames on without looking at them (like peers) can override
+        this.  The default implementation calls .do_channel_data().
+        """
+        self.do_channel_data(channel, bytes(frame[len(channel) + 1:]))
+
     def do_kill(self, host: 'str | None', group: 'str | None', message: JsonObject) -> None:
         raise NotImplementedError
 
+    # interface for output flow control: the router's transport is backed up
+    # (or not anymore).  Endpoints which produce data on their own should try
+    # to stop doing that for a while.
+    def do_pause_output(self) -> None:
+        pass
+
+    def do_resume_output(self) -> None:
+        pass
+
+    # interface for the send scheduler: endpoints with bulk data to send call
+    # .schedule_send() and then get turns to send up to `quantum` bytes.
+    # Return True to get another turn.
+    def do_send_quantum(self, quantum: int) -> bool:
+        return False
+
+    # interface for the stats: any numbers of our own about an open channel
+    def get_channel_stats(self, channel: str) -> 'dict[str, int | float]':
+        return {}
+
     # interface for sending messages
-    def send_channel_data(self, channel: str, data: bytes) -> None:
+    def send_channel_data(self, channel: str, data: 'bytes | memoryview') -> None:
+        self.router.stats.data_sent(channel, len(data))
         self.router.write_channel_data(channel, data)
 
+    def send_channel_frame(self, channel: str, frame: 'bytes | memoryview') -> None:
+        self.router.stats.data_sent(channel, len(frame) - len(channel) - 1)
+        self.router.write_frame(channel, frame)
+
     def send_channel_control(
         self, channel: str, command: str, msg: 'JsonObject | None', **kwargs: JsonValue
     ) -> None:
         self.router.write_control(msg, channel=channel, command=command, **kwargs)
-        if command == 'close':
+        if command == 'ready':
+            self.router.stats.channel_ready(channel)
+        elif command == 'close':
             self.router.endpoints[self].remove(channel)
             self.router.drop_channel(channel)
 
+    def schedule_send(self) -> None:
+        self.router.schedule_send(self)
+
     def shutdown_endpoint(self, msg: 'JsonObject | None' = None, **kwargs: JsonValue) -> None:
         self.router.shutdown_endpoint(self, msg, **kwargs)
 
@@ -205,15 +247,37 @@ class Router(CockpitProtocolServer):
     endpoints: 'dict[Endpoint, set[str]]'
     no_endpoints: asyncio.Event  # set if endpoints dict is empty
     session_controller: 'SessionController | None'
+    stats: Stats
 
     _eof: bool = False
 
+    # set while our transport's write buffer is over its high watermark
+    output_paused: bool = False
+
+    # Receive-side memory budget: the total number of bytes which endpoints
+    # have received from us, but not yet consumed.  We stop reading from our
+    # transport while this is over the high watermark.
+    RECEIVE_QUEUE_HIGH: ClassVar[int] = 16 * 1024 * 1024
+    RECEIVE_QUEUE_LOW: ClassVar[int] = RECEIVE_QUEUE_HIGH // 4
+    queued_bytes: int = 0
+    input_paused: bool = False
+
+    # Send scheduler: endpoints with bulk data take turns, in order, sending
+    # up to SEND_QUANTUM bytes each per iteration of the main loop.  Anything
+    # else which is ready to go (D-Bus replies, terminal output, control
+    # messages) gets its chance in between.
+    SEND_QUANTUM: ClassVar[int] = 64 * 1024
+    _senders: 'dict[Endpoint, None]'
+    _senders_handle: 'asyncio.Handle | None' = None
+
     def __init__(self, routing_rules: List[RoutingRule], *, session_timeout: 'int | None' = None):
         for rule in routing_rules:
             rule.router = self
         self.routing_rules = routing_rules
         self.open_channels = {}
         self.endpoints = {}
+        self._senders = {}
+        self.stats = Stats(self)
         self.no_endpoints = asyncio.Event()
         self.no_endpoints.set()  # at first there are no endpoints
         self.session_controller = None
@@ -238,6 +302,7 @@ class Router(CockpitProtocolServer):
     def drop_channel(self, channel: str) -> None:
         try:
             self.open_channels.pop(channel)
+            self.stats.channel_closed(channel)
             logger.debug('router dropped channel %s', channel)
         except KeyError:
             logger.error('trying to drop non-existent channel %s from %s', channel, self.open_channels)
@@ -248,6 +313,7 @@ class Router(CockpitProtocolServer):
 
     def shutdown_endpoint(self, endpoint: Endpoint, msg: 'JsonObject | None' = None, **kwargs: JsonValue) -> None:
         channels = self.endpoints.pop(endpoint)
+        self._senders.pop(endpoint, None)
         logger.debug('shutdown_endpoint(%s, %s) will close %s', endpoint, kwargs, channels)
         for channel in channels:
             self.write_control(msg, command='close', channel=channel, **kwargs)
@@ -280,13 +346,16 @@ class Router(CockpitProtocolServer):
             if channel in self.open_channels:
                 raise CockpitProtocolError('channel is already open')
 
+            payload = message.get('payload')
             try:
-                logger.debug('Trying to find endpoint for new channel %s payload=%s', channel, message.get('payload'))
+                logger.debug('Trying to find endpoint for new channel %s payload=%s', channel, payload)
                 endpoint = self.check_rules(message)
             except RoutingError as exc:
+                self.stats.channel_rejected(str(payload))
                 self.write_control(exc.get_attrs(), command='close', channel=channel)
                 return
 
+            self.stats.channel_opened(channel, str(payload))
             self.open_channels[channel] = endpoint
             self.endpoints[endpoint].add(channel)
         else:
@@ -299,7 +368,7 @@ class Router(CockpitProtocolServer):
         # At this point, we have the endpoint.  Route the message.
         endpoint.do_channel_control(channel, command, message)
 
-    def channel_data_received(self, channel: str, data: bytes) -> None:
+    def channel_frame_received(self, channel: str, frame: memoryview) -> None:
         if self.init_host is None:
             raise CockpitProtocolError('channel data message received before init')
 
@@ -308,7 +377,75 @@ class Router(CockpitProtocolServer):
         except KeyError:
             return
 
-        endpoint.do_channel_data(channel, data)
+        self.stats.data_received(channel, len(frame) - len(channel) - 1)
+        endpoint.do_channel_frame(channel, frame)
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        super().connection_made(transport)
+        if not self._closed:
+            self.stats.start()
+
+    def pause_writing(self) -> None:
+        logger.debug('pause_writing(%r): pausing output of %d endpoints', self, len(self.endpoints))
+        self.output_paused = True
+        for endpoint in set(self.endpoints):
+            endpoint.do_pause_output()
+
+    def resume_writing(self) -> None:
+        logger.debug('resume_writing(%r): resuming output of %d endpoints', self, len(self.endpoints))
+        self.output_paused = False
+        for endpoint in set(self.endpoints):
+            endpoint.do_resume_output()
+        self._schedule_senders()
+
+    def schedule_send(self, endpoint: Endpoint) -> None:
+        """Give the endpoint turns to send data until it says it's done."""
+        self._senders[endpoint] = None
+        self._schedule_senders()
+
+    def _schedule_senders(self) -> None:
+        # We don't give out turns while our output is backed up
+        if self._senders and self._senders_handle is None and not self.output_paused:
+            self._senders_handle = asyncio.get_running_loop().call_soon(self._run_senders)
+
+    def _run_senders(self) -> None:
+        self._senders_handle = None
+
+        # Each endpoint which was waiting gets one turn, and goes to the back
+        # of the line if it wants another one.
+        for endpoint in list(self._senders):
+            if self.output_paused:
+                break
+            if endpoint not in self._senders:
+                continue  # shut down during someone else's turn
+            del self._senders[endpoint]
+            if endpoint.do_send_quantum(self.SEND_QUANTUM) and endpoint in self.endpoints:
+                self._senders[endpoint] = None
+
+        self._schedule_senders()
+
+    def update_queued_bytes(self, delta: int) -> None:
+        """Account for received data which is queued in an endpoint.
+
+        Endpoints which buffer incoming data call this with the number of bytes
+        they queued (positive) or consumed (negative).  Reading from the
+        transport is paused while the total is above RECEIVE_QUEUE_HIGH, and
+        resumed once it drops to RECEIVE_QUEUE_LOW.
+        """
+        self.queued_bytes += delta
+        assert self.queued_bytes >= 0
+
+        if not self.input_paused and self.queued_bytes > self.RECEIVE_QUEUE_HIGH:
+            logger.debug('update_queued_bytes(%r): %d bytes queued, pausing input', self, self.queued_bytes)
+            self.input_paused = True
+            if self.transport is not None:
+                self.transport.pause_reading()
+
+        elif self.input_paused and self.queued_bytes <= self.RECEIVE_QUEUE_LOW:
+            logger.debug('update_queued_bytes(%r): %d bytes queued, resuming input', self, self.queued_bytes)
+            self.input_paused = False
+            if self.transport is not None:
+                self.transport.resume_reading()
 
     def eof_received(self) -> bool:
         logger.debug('eof_received(%r)', self)
@@ -324,6 +461,8 @@ class Router(CockpitProtocolServer):
     _communication_done: Optional[asyncio.Future] = None
 
     def do_closed(self, exc: Optional[Exception]) -> None:
+        self.stats.stop()
+
         # If we didn't send EOF yet, do it now.
         if not self._eof:
             self.eof_received()
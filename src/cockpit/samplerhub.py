@@ -0,0 +1,238 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Callable, Collection, Dict, List, Optional, Tuple, Type
+
+from .samples import BridgeSampler, Sampler, Samples
+from .stats import Stats
+
+logger = logging.getLogger(__name__)
+
+# The BridgeSampler samples the Stats of one particular bridge, all others are the same for everyone
+SamplerKey = Tuple[Type[Sampler], Optional[Stats]]
+SamplesCallback = Callable[[Samples, float, int], None]
+
+
+class SamplerTiming:
+    """How long the samplers of one class took, in milliseconds"""
+    __slots__ = ('max', 'samples', 'total')
+
+    def __init__(self) -> None:
+        self.samples = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed: float) -> None:
+        self.samples += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def get_timing(self) -> Dict[str, float]:
+        return {'samples': self.samples, 'total': self.total, 'max': self.max}
+
+
+class SharedSampler:
+    """A Sampler instance, and the number of subscriptions using it"""
+    def __init__(self, key: SamplerKey) -> None:
+        cls, stats = key
+        self.key = key
+        self.sampler = BridgeSampler(stats) if stats is not None else cls()
+        self.users = 0
+
+
+class Subscription:
+    """A subscriber's interest in some samplers at some interval.  close() it when done.
+
+    The callback gets the Samples, the time at which they were taken, in
+    seconds since the epoch, and the number of ticks which were skipped since
+    the previous ones.  Those Samples are shared with all other subscribers
+    on the same interval, so they must not be modified.
+
+    If one of the samplers fails, or the callback raises, the exception gets
+    set on the `failed` future, and the subscriber gets no further samples.
+    """
+    def __init__(self, ticker: 'Ticker', samplers: List[SharedSampler], callback: SamplesCallback) -> None:
+        self.ticker: Optional[Ticker] = ticker
+        self.samplers = samplers
+        self.callback = callback
+        self.failed: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+    def deliver(self, samples: Samples, timestamp: float, skipped: int, errors: Dict[SamplerKey, Exception]) -> None:
+        if self.failed.done():
+            return
+
+        for shared in self.samplers:
+            if shared.key in errors:
+                self.failed.set_exception(errors[shared.key])
+                return
+
+        try:
+            self.callback(samples, timestamp, skipped)
+        except Exception as exc:
+            self.failed.set_exception(exc)
+
+    def close(self) -> None:
+        if self.ticker is not None:
+            self.ticker.hub.release(self.ticker, self)
+            self.ticker = None
+
+
+class Ticker:
+    """Samples the samplers of all subscribers of one interval together
+
+    The ticks are on multiples of the interval since the epoch, independent
+    of how long sampling takes, so the timestamps don't drift.  If sampling
+    takes so long that the deadline of the next tick has already passed, that
+    tick gets skipped, rather than trying to catch up.
+    """
+    task: 'asyncio.Task[None] | None' = None
+
+    def __init__(self, hub: 'SamplerHub', interval: int) -> None:
+        self.hub = hub
+        self.interval = interval
+        self.subscriptions: List[Subscription] = []
+
+    def sample(self, samplers: Collection[SharedSampler]) -> Tuple[Samples, Dict[SamplerKey, Exception]]:
+        samples: Samples = defaultdict(dict)
+        errors: Dict[SamplerKey, Exception] = {}
+        for shared in samplers:
+            start = time.perf_counter()
+            try:
+                shared.sampler.sample(samples)
+            except Exception as exc:
+                logger.debug('%s failed: %s', shared.sampler, exc)
+                errors[shared.key] = exc
+            self.hub.get_timing(shared.key[0]).add((time.perf_counter() - start) * 1000)
+        return samples, errors
+
+    def tick(self, timestamp: float, skipped: int) -> None:
+        # Subscriptions can go away (or come) while we're dispatching to them
+        subscriptions = list(self.subscriptions)
+        samplers = {shared.key: shared for subscription in subscriptions for shared in subscription.samplers}
+        samples, errors = self.sample(samplers.values())
+        for subscription in subscriptions:
+            if subscription in self.subscriptions:
+                subscription.deliver(samples, timestamp, skipped, errors)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        period = self.interval / 1000
+
+        # Sleep on the monotonic loop clock, but count ticks on the wall clock
+        offset = time.time() - loop.time()
+        tick = int((loop.time() + offset) // period) + 1
+        skipped = 0
+
+        while True:
+            await asyncio.sleep(tick * period - offset - loop.time())
+            self.tick(tick * period, skipped)
+
+            next_tick = max(tick + 1, int((loop.time() + offset) // period) + 1)
+            skipped = next_tick - tick - 1
+            if skipped:
+                logger.debug('Sampling every %d ms is falling behind, skipping %d ticks', self.interval, skipped)
+                self.hub.missed += skipped
+            tick = next_tick
+
+    def start(self) -> None:
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+class SamplerHub:
+    """Shares the metrics samplers between everyone who samples them
+
+    Every Sampler reads its files in /proc or /sys, and parses them, each
+    time it is sampled.  Several browser tabs often show the same metrics at
+    the same interval, so those share a single Sampler instance here, which
+    gets sampled once per interval for all of them.
+
+    A new subscriber immediately gets a first sample of its own samplers,
+    just like when sampling them itself.
+
+    The time taken by each Sampler class, and the number of skipped ticks are
+    kept for as long as the bridge runs, for finding slow samplers.
+    """
+    samplers: Dict[SamplerKey, SharedSampler]
+    tickers: Dict[int, Ticker]
+    timings: Dict[str, SamplerTiming]
+    missed: int
+
+    def __init__(self) -> None:
+        self.samplers = {}
+        self.tickers = {}
+        self.timings = {}
+        self.missed = 0
+
+    def subscribe(
+        self, interval: int, classes: Collection[Type[Sampler]], stats: Stats, callback: SamplesCallback
+    ) -> Subscription:
+        """Get the samples of the given Sampler classes every `interval` milliseconds"""
+        samplers = []
+        for cls in classes:
+            key = (cls, stats if cls is BridgeSampler else None)
+            shared = self.samplers.get(key)
+            if shared is None:
+                logger.debug('Creating shared %s', cls.__name__)
+                shared = self.samplers[key] = SharedSampler(key)
+            shared.users += 1
+            samplers.append(shared)
+
+        ticker = self.tickers.get(interval)
+        if ticker is None:
+            logger.debug('Creating ticker for %d ms', interval)
+            ticker = self.tickers[interval] = Ticker(self, interval)
+            ticker.start()
+
+        subscription = Subscription(ticker, samplers, callback)
+        ticker.subscriptions.append(subscription)
+        samples, errors = ticker.sample(samplers)
+        subscription.deliver(samples, time.time(), 0, errors)
+        return subscription
+
+    def release(self, ticker: Ticker, subscription: Subscription) -> None:
+        ticker.subscriptions.remove(subscription)
+        if not ticker.subscriptions:
+            logger.debug('Stopping ticker for %d ms', ticker.interval)
+            ticker.stop()
+            del self.tickers[ticker.interval]
+
+        for shared in subscription.samplers:
+            shared.users -= 1
+            if shared.users == 0:
+                logger.debug('Closing shared %s', shared.key[0].__name__)
+                shared.sampler.close()
+                del self.samplers[shared.key]
+
+    def get_n_samplers(self) -> int:
+        """The number of Sampler instances (each sampled once per interval it's used in)"""
+        return len(self.samplers)
+
+    def get_n_subscriptions(self) -> int:
+        return sum(len(ticker.subscriptions) for ticker in self.tickers.values())
+
+    def get_timing(self, cls: Type[Sampler]) -> SamplerTiming:
+        timing = self.timings.get(cls.__name__)
+        if timing is None:
+            timing = self.timings[cls.__name__] = SamplerTiming()
+        return timing
+
+    def get_timings(self) -> Dict[str, Dict[str, float]]:
+        """Samples taken, and total and maximum milliseconds spent, per Sampler class"""
+        return {name: timing.get_timing() for name, timing in self.timings.items()}
+
+    def get_n_missed(self) -> int:
+        """The number of ticks skipped because sampling was taking too long"""
+        return self.missed
+
+
+sampler_hub = SamplerHub()
@@ -3,17 +3,23 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 
+import ctypes
 import errno
 import logging
 import os
 import re
-from typing import Any, Callable, DefaultDict, Iterable, List, NamedTuple, Optional, Tuple
+import resource
+from typing import Any, Callable, DefaultDict, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
 
-from cockpit._vendor.systemd_ctypes import Handle
+from cockpit._vendor.systemd_ctypes import Handle, inotify
+
+from .stats import Stats
 
 USER_HZ = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
 MS_PER_JIFFY = 1000 / (USER_HZ if (USER_HZ > 0) else 100)
 HWMON_PATH = '/sys/class/hwmon'
+CGROUP_PATH = '/sys/fs/cgroup'
+PROC_PATH = '/proc'
 
 # we would like to do this, but mypy complains; https://github.com/python/mypy/issues/2900
 # Samples = collections.defaultdict[str, Union[float, Dict[str, Union[float, None]]]]
@@ -39,6 +45,10 @@ def read_int_file(rootfd: int, statfile: str, default: Optional[int] = None, key
     finally:
         os.close(fd)
 
+    return parse_int(data, default, key)
+
+
+def parse_int(data: bytes, default: Optional[int] = None, key: bytes = b'') -> Optional[int]:
     if key:
         start = data.index(key) + len(key)
         end = data.index(b'\n', start)
@@ -52,6 +62,362 @@ def read_int_file(rootfd: int, statfile: str, default: Optional[int] = None, key
         return None
 
 
+class ProcFile:
+    """A file in /proc, kept open, and read again from the start for every sample
+
+    Reading with pread() at offset 0 makes the kernel produce the current
+    contents, so there's no need to open the file every time.  The data gets
+    read into a buffer which is reused, and which grows as needed.
+    """
+    def __init__(self, path: str, size: int = 4096) -> None:
+        self.path = path
+        self.fd: Optional[int] = None
+        self.buffer = bytearray(size)
+        self.raw_names: List[bytes] = []
+        self.names: List[str] = []
+
+    def read(self) -> bytes:
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+
+        while True:
+            if hasattr(os, 'preadv'):
+                length = os.preadv(self.fd, [self.buffer], 0)
+                if length < len(self.buffer):
+                    return bytes(memoryview(self.buffer)[:length])
+            else:
+                # Python 3.6: no preadv(), read into a new buffer
+                data = os.pread(self.fd, len(self.buffer), 0)
+                if len(data) < len(self.buffer):
+                    return data
+            # There might be more: read it all again, so that it's consistent
+            self.buffer = bytearray(len(self.buffer) * 2)
+
+    def decode(self, names: List[bytes]) -> List[str]:
+        """Decodes a column of names, such as devices, reusing the result from last time if they're the same"""
+        if names != self.raw_names:
+            self.raw_names = names
+            self.names = [os.fsdecode(name) for name in names]
+        return self.names
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def split_table(data: bytes) -> Tuple[List[bytes], int]:
+    """Splits lines of whitespace-separated fields into a flat list, and the number of fields per line
+
+    Every line needs to have the same number of fields.  Column `i` is then
+    `fields[i::n_columns]`, which can be converted with map(int, ...) in one go.
+    """
+    fields = data.split()
+    # without any lines, any number will do
+    n_columns = len(data.split(b'\n', 1)[0].split()) or 1
+    return fields, n_columns
+
+
+class Inotify:
+    """Just enough inotify to find out about new and removed directories
+
+    The events are read when asked for, without involving the main loop.
+    """
+    libc: Optional[ctypes.CDLL] = None
+
+    def __init__(self) -> None:
+        if Inotify.libc is None:
+            Inotify.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.check(Inotify.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    @staticmethod
+    def check(result: int) -> int:
+        if result == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return result
+
+    def add_watch(self, path: str, mask: inotify.Event) -> int:
+        assert Inotify.libc is not None
+        return self.check(Inotify.libc.inotify_add_watch(self.fd, os.fsencode(path), mask))
+
+    def rm_watch(self, wd: int) -> None:
+        assert Inotify.libc is not None
+        Inotify.libc.inotify_rm_watch(self.fd, wd)  # fails if it's already gone, which is fine
+
+    def read_events(self) -> Iterator[Tuple[int, inotify.Event, str]]:
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < len(data):
+                event = inotify.inotify_event.from_buffer_copy(data, offset)
+                offset += ctypes.sizeof(event)
+                name = os.fsdecode(data[offset:offset + event.len].rstrip(b'\0'))
+                offset += event.len
+                yield event.wd, inotify.Event(event.mask), name
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def raise_nofile_limit() -> int:
+    """Raises the soft limit of open files as far as we may, and returns it
+
+    The default soft limit of 1024 is only there for programs which still use
+    select(); the hard limit is usually much higher.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError) as exc:
+            logger.debug('Failed to raise RLIMIT_NOFILE from %d to %d: %s', soft, hard, exc)
+    # the kernel doesn't allow more than fs.nr_open anyway
+    return soft if soft != resource.RLIM_INFINITY else 1024 * 1024
+
+
+class CGroupFiles(NamedTuple):
+    """The statistics files of one cgroup: open (or None if missing), or
+    not kept open at all (`fds` is None)"""
+    path: str
+    fds: Optional[Dict[str, Optional[int]]]
+    wd: int
+
+
+class CGroupIndex:
+    """The cgroups below a directory, with their statistics files kept open
+
+    Instead of walking the whole tree for every sample, it gets read once,
+    and then kept up to date by watching for new and removed directories with
+    inotify.  The statistics files of each cgroup are opened once, and read
+    with pread(), which makes the kernel produce the current values.
+
+    Open files count against RLIMIT_NOFILE: its soft limit gets raised to the
+    hard one, and up to a half of that is used for all indexes together.
+    The files of the cgroups which don't fit get opened for every read.  Without inotify (or when it overflows), the
+    tree is scanned for changes on every update.
+
+    The samplers share one index per tree: see open_cgroup_index().
+    """
+    WATCH_MASK = (inotify.Event.CREATE | inotify.Event.DELETE | inotify.Event.MOVED_FROM |
+                  inotify.Event.MOVED_TO | inotify.Event.ONLYDIR)
+
+    # Controllers can get enabled for existing cgroups, which makes new files
+    # appear: look for missing files again every so many updates
+    RECHECK_INTERVAL = 30
+
+    n_fds = 0  # for all indexes
+
+    def __init__(self, root: str, filenames: Sequence[str]) -> None:
+        self.root = root
+        self.filenames = list(filenames)
+        self.users = 0
+        self.cgroups: Dict[str, CGroupFiles] = {}
+        self.watches: Dict[int, str] = {}
+        self.updates = 0
+        self.max_fds = raise_nofile_limit() // 2
+
+        self.inotify: Optional[Inotify]
+        try:
+            self.inotify = Inotify()
+        except OSError as exc:
+            logger.debug('No inotify for cgroups, scanning them every time: %s', exc)
+            self.inotify = None
+
+        self.add('')
+
+    def open_files(self, path: str, fds: Dict[str, Optional[int]], *, missing_only: bool = False) -> None:
+        for filename in self.filenames:
+            if missing_only and fds.get(filename) is not None:
+                continue
+            try:
+                fds[filename] = os.open(f'{path}/{filename}', os.O_RDONLY | os.O_CLOEXEC)
+                CGroupIndex.n_fds += 1
+            except FileNotFoundError:
+                fds[filename] = None
+            except OSError as exc:
+                # it might have gone away already, or we're not allowed
+                logger.debug('Failed to open %s/%s: %s', path, filename, exc)
+                fds[filename] = None
+
+    def add_files(self, filenames: Sequence[str]) -> None:
+        new_filenames = [filename for filename in filenames if filename not in self.filenames]
+        if new_filenames:
+            self.filenames.extend(new_filenames)
+            for files in self.cgroups.values():
+                if files.fds is not None:
+                    self.open_files(files.path, files.fds, missing_only=True)
+
+    def add(self, name: str) -> None:
+        """Adds a cgroup and everything below it"""
+        if name in self.cgroups:
+            return
+
+        path = f'{self.root}/{name}' if name else self.root
+
+        # Watch first, so that we don't miss anything that appears while
+        # we're reading the directory
+        wd = -1
+        if self.inotify is not None:
+            try:
+                wd = self.inotify.add_watch(path, self.WATCH_MASK)
+            except FileNotFoundError:
+                return
+            except OSError as exc:
+                logger.debug('Failed to watch %s, scanning cgroups every time: %s', path, exc)
+                self.inotify.close()
+                self.inotify = None
+                self.watches.clear()
+            else:
+                self.watches[wd] = name
+
+        # The root isn't a cgroup that we report
+        fds: 'Dict[str, Optional[int]] | None' = None
+        if name and CGroupIndex.n_fds + len(self.filenames) <= self.max_fds:
+            fds = {}
+            self.open_files(path, fds)
+        self.cgroups[name] = CGroupFiles(path, fds, wd)
+
+        try:
+            with os.scandir(path) as entries:
+                subdirs = [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+        except (FileNotFoundError, NotADirectoryError):
+            self.remove(name)
+            return
+
+        for subdir in subdirs:
+            self.add(f'{name}/{subdir}' if name else subdir)
+
+    def remove(self, name: str) -> None:
+        """Removes a cgroup and everything below it"""
+        prefix = f'{name}/' if name else ''
+        for cgroup in [cgroup for cgroup in self.cgroups if cgroup == name or cgroup.startswith(prefix)]:
+            files = self.cgroups.pop(cgroup)
+            if self.watches.pop(files.wd, None) is not None:
+                if self.inotify is not None:
+                    self.inotify.rm_watch(files.wd)
+            if files.fds is not None:
+                for fd in files.fds.values():
+                    if fd is not None:
+                        os.close(fd)
+                        CGroupIndex.n_fds -= 1
+
+    def rescan(self) -> None:
+        present = set()
+        todo = ['']
+        while todo:
+            name = todo.pop()
+            present.add(name)
+            path = f'{self.root}/{name}' if name else self.root
+            try:
+                with os.scandir(path) as entries:
+                    todo.extend(f'{name}/{entry.name}' if name else entry.name
+                                for entry in entries if entry.is_dir(follow_symlinks=False))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+        for name in self.cgroups.keys() - present:
+            if name in self.cgroups:  # not yet removed with its parent
+                self.remove(name)
+        for name in sorted(present - self.cgroups.keys()):
+            self.add(name)
+
+    def update(self) -> None:
+        """Catches up with the changes to the tree since the last update"""
+        self.updates += 1
+        if self.updates % self.RECHECK_INTERVAL == 0:
+            for files in self.cgroups.values():
+                if files.fds is not None and None in files.fds.values():
+                    self.open_files(files.path, files.fds, missing_only=True)
+
+        if self.inotify is None:
+            self.rescan()
+            return
+
+        for wd, mask, name in self.inotify.read_events():
+            if mask & inotify.Event.Q_OVERFLOW:
+                logger.debug('inotify queue overflow for %s, scanning again', self.root)
+                self.rescan()
+                continue
+
+            parent = self.watches.get(wd)
+            if parent is None:
+                continue  # a watch that we've removed already
+            if mask & inotify.Event.IGNORED:
+                # the directory is gone; normally we have seen the IN_DELETE
+                # in its parent already
+                self.remove(parent)
+            elif mask & inotify.Event.ISDIR:
+                cgroup = f'{parent}/{name}' if parent else name
+                if mask & (inotify.Event.CREATE | inotify.Event.MOVED_TO):
+                    self.add(cgroup)
+                else:
+                    self.remove(cgroup)
+
+    def read(self, name: str, filename: str, size: int = 4096) -> Optional[bytes]:
+        files = self.cgroups[name]
+        if files.fds is None:
+            try:
+                fd = os.open(f'{files.path}/{filename}', os.O_RDONLY | os.O_CLOEXEC)
+                try:
+                    return os.read(fd, size)
+                finally:
+                    os.close(fd)
+            except FileNotFoundError:
+                return None
+            except OSError as exc:
+                # cgroups can disappear between the open and read
+                if exc.errno != errno.ENODEV:
+                    logger.warning('Failed to read %s/%s: %s', files.path, filename, exc)
+                return None
+
+        kept_fd = files.fds[filename]
+        if kept_fd is None:
+            return None
+        try:
+            return os.pread(kept_fd, size, 0)
+        except OSError as exc:
+            if exc.errno != errno.ENODEV:
+                logger.warning('Failed to read %s/%s: %s', files.path, filename, exc)
+            return None
+
+    def read_int(self, name: str, filename: str, default: Optional[int] = None, key: bytes = b'') -> Optional[int]:
+        data = self.read(name, filename)
+        return None if data is None else parse_int(data, default, key)
+
+    def close(self) -> None:
+        self.users -= 1
+        if self.users > 0:
+            return
+
+        if cgroup_indexes.get(self.root) is self:
+            del cgroup_indexes[self.root]
+        self.remove('')
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+cgroup_indexes: Dict[str, CGroupIndex] = {}
+
+
+def open_cgroup_index(root: str, filenames: Sequence[str]) -> CGroupIndex:
+    """Returns the shared index of the cgroups below root, which keeps (at
+    least) the given files open.  Call .close() on it when done."""
+    index = cgroup_indexes.get(root)
+    if index is None:
+        index = cgroup_indexes[root] = CGroupIndex(root, filenames)
+    else:
+        index.add_files(filenames)
+    index.users += 1
+    return index
+
+
 class SampleDescription(NamedTuple):
     name: str
     units: str
@@ -65,6 +431,9 @@ class Sampler:
     def sample(self, samples: Samples) -> None:
         raise NotImplementedError
 
+    def close(self) -> None:
+        pass
+
 
 class CPUSampler(Sampler):
     descriptions = [
@@ -79,25 +448,29 @@ class CPUSampler(Sampler):
         SampleDescription('cpu.core.iowait', 'millisec', 'counter', instanced=True),
     ]
 
+    def __init__(self) -> None:
+        self.stat = ProcFile(f'{PROC_PATH}/stat', 65536)
+        self.names: List[str] = []
+        self.cores: List[str] = []
+
     def sample(self, samples: Samples) -> None:
-        with open('/proc/stat') as stat:
-            for line in stat:
-                if not line.startswith('cpu'):
-                    continue
-                cpu, user, nice, system, _idle, iowait = line.split()[:6]
-                core = cpu[3:] or None
-                if core:
-                    prefix = 'cpu.core'
-                    samples[f'{prefix}.nice'][core] = int(nice) * MS_PER_JIFFY
-                    samples[f'{prefix}.user'][core] = int(user) * MS_PER_JIFFY
-                    samples[f'{prefix}.system'][core] = int(system) * MS_PER_JIFFY
-                    samples[f'{prefix}.iowait'][core] = int(iowait) * MS_PER_JIFFY
-                else:
-                    prefix = 'cpu.basic'
-                    samples[f'{prefix}.nice'] = int(nice) * MS_PER_JIFFY
-                    samples[f'{prefix}.user'] = int(user) * MS_PER_JIFFY
-                    samples[f'{prefix}.system'] = int(system) * MS_PER_JIFFY
-                    samples[f'{prefix}.iowait'] = int(iowait) * MS_PER_JIFFY
+        data = self.stat.read()
+
+        # The "cpu" line with the totals comes first, then a "cpuN" line for each core
+        end = data.find(b'\n', data.rfind(b'\ncpu') + 1)
+        fields, n_columns = split_table(data[:end])
+        names = self.stat.decode(fields[n_columns::n_columns])
+        if names is not self.names:
+            self.names = names
+            self.cores = [name[3:] for name in names]
+
+        for column, name in [(1, 'user'), (2, 'nice'), (3, 'system'), (5, 'iowait')]:
+            values = [value * MS_PER_JIFFY for value in map(int, fields[column::n_columns])]
+            samples[f'cpu.basic.{name}'] = values[0]
+            samples[f'cpu.core.{name}'] = dict(zip(self.cores, values[1:]))  # noqa: B905
+
+    def close(self) -> None:
+        self.stat.close()
 
 
 class MemorySampler(Sampler):
@@ -108,14 +481,21 @@ class MemorySampler(Sampler):
         SampleDescription('memory.swap-used', 'bytes', 'instant', instanced=False),
     ]
 
+    ITEM_RE = re.compile(rb'^(\w+): +(\d+)', re.MULTILINE)
+
+    def __init__(self) -> None:
+        self.meminfo = ProcFile(f'{PROC_PATH}/meminfo')
+
     def sample(self, samples: Samples) -> None:
-        with open('/proc/meminfo') as meminfo:
-            items = {k: int(v.strip(' kB\n')) for line in meminfo for k, v in [line.split(':', 1)]}
+        items = {key: int(value) for key, value in self.ITEM_RE.findall(self.meminfo.read())}
+
+        samples['memory.free'] = 1024 * items[b'MemFree']
+        samples['memory.used'] = 1024 * (items[b'MemTotal'] - items[b'MemAvailable'])
+        samples['memory.cached'] = 1024 * (items[b'Buffers'] + items[b'Cached'])
+        samples['memory.swap-used'] = 1024 * (items[b'SwapTotal'] - items[b'SwapFree'])
 
-        samples['memory.free'] = 1024 * items['MemFree']
-        samples['memory.used'] = 1024 * (items['MemTotal'] - items['MemAvailable'])
-        samples['memory.cached'] = 1024 * (items['Buffers'] + items['Cached'])
-        samples['memory.swap-used'] = 1024 * (items['SwapTotal'] - items['SwapFree'])
+    def close(self) -> None:
+        self.meminfo.close()
 
 
 class CPUTemperatureSampler(Sampler):
@@ -203,46 +583,51 @@ class DiskSampler(Sampler):
         SampleDescription('disk.dev.written', 'bytes', 'counter', instanced=True),
     ]
 
-    def sample(self, samples: Samples) -> None:
-        with open('/proc/diskstats') as diskstats:
-            all_read_bytes = 0
-            all_written_bytes = 0
-
-            for line in diskstats:
-                # https://www.kernel.org/doc/Documentation/ABI/testing/procfs-diskstats
-                fields = line.strip().split()
-                dev_major = fields[0]
-                dev_name = fields[2]
-                num_sectors_read = fields[5]
-                num_sectors_written = fields[9]
-
-                # ignore mdraid
-                if dev_major == '9':
-                    continue
+    def __init__(self) -> None:
+        self.diskstats = ProcFile(f'{PROC_PATH}/diskstats')
+        self.names: List[str] = []
+        self.disks: List[Tuple[int, str]] = []
 
-                # ignore device-mapper
-                if dev_name.startswith('dm-'):
-                    continue
+    @staticmethod
+    def is_disk(dev_major: bytes, dev_name: str) -> bool:
+        # ignore mdraid
+        if dev_major == b'9':
+            return False
 
-                # Skip partitions
-                if dev_name[:2] in ['sd', 'hd', 'vd'] and dev_name[-1].isdigit():
-                    continue
+        # ignore device-mapper
+        if dev_name.startswith('dm-'):
+            return False
 
-                # Ignore nvme partitions
-                if dev_name.startswith('nvme') and 'p' in dev_name:
-                    continue
+        # Skip partitions
+        if dev_name[:2] in ['sd', 'hd', 'vd'] and dev_name[-1].isdigit():
+            return False
 
-                read_bytes = int(num_sectors_read) * 512
-                written_bytes = int(num_sectors_written) * 512
+        # Ignore nvme partitions
+        if dev_name.startswith('nvme') and 'p' in dev_name:
+            return False
+
+        return True
+
+    def sample(self, samples: Samples) -> None:
+        # https://www.kernel.org/doc/Documentation/ABI/testing/procfs-diskstats
+        fields, n_columns = split_table(self.diskstats.read())
+        names = self.diskstats.decode(fields[2::n_columns])
+        if names is not self.names:
+            self.names = names
+            majors = fields[0::n_columns]
+            self.disks = [(row, name) for row, (major, name) in enumerate(zip(majors, names))  # noqa: B905
+                          if self.is_disk(major, name)]
 
-                all_read_bytes += read_bytes
-                all_written_bytes += written_bytes
+        read_bytes = [sectors * 512 for sectors in map(int, fields[5::n_columns])]
+        written_bytes = [sectors * 512 for sectors in map(int, fields[9::n_columns])]
 
-                samples['disk.dev.read'][dev_name] = read_bytes
-                samples['disk.dev.written'][dev_name] = written_bytes
+        samples['disk.dev.read'] = {name: read_bytes[row] for row, name in self.disks}
+        samples['disk.dev.written'] = {name: written_bytes[row] for row, name in self.disks}
+        samples['disk.all.read'] = sum(samples['disk.dev.read'].values())
+        samples['disk.all.written'] = sum(samples['disk.dev.written'].values())
 
-            samples['disk.all.read'] = all_read_bytes
-            samples['disk.all.written'] = all_written_bytes
+    def close(self) -> None:
+        self.diskstats.close()
 
 
 class CGroupSampler(Sampler):
@@ -255,61 +640,89 @@ class CGroupSampler(Sampler):
         SampleDescription('cgroup.cpu.shares', 'count', 'instant', instanced=True),
     ]
 
+    V2_FILES = ['memory.current', 'memory.max', 'memory.swap.current', 'memory.swap.max', 'cpu.weight', 'cpu.stat']
+    V1_MEMORY_FILES = ['memory.usage_in_bytes', 'memory.limit_in_bytes',
+                       'memory.memsw.usage_in_bytes', 'memory.memsw.limit_in_bytes']
+    V1_CPU_FILES = ['cpu.shares', 'cpuacct.usage']
+
     cgroups_v2: Optional[bool] = None
+    indexes: Optional[List[CGroupIndex]] = None
 
     def sample(self, samples: Samples) -> None:
         if self.cgroups_v2 is None:
-            self.cgroups_v2 = os.path.exists('/sys/fs/cgroup/cgroup.controllers')
+            self.cgroups_v2 = os.path.exists(f'{CGROUP_PATH}/cgroup.controllers')
 
-        if self.cgroups_v2:
-            cgroups_v2_path = '/sys/fs/cgroup/'
-            for path, _, _, rootfd in os.fwalk(cgroups_v2_path):
-                cgroup = path.replace(cgroups_v2_path, '')
+        if self.indexes is None:
+            if self.cgroups_v2:
+                self.indexes = [open_cgroup_index(CGROUP_PATH, self.V2_FILES)]
+            else:
+                self.indexes = [open_cgroup_index(f'{CGROUP_PATH}/memory', self.V1_MEMORY_FILES),
+                                open_cgroup_index(f'{CGROUP_PATH}/cpu', self.V1_CPU_FILES)]
+
+        for index in self.indexes:
+            index.update()
 
+        if self.cgroups_v2:
+            [index] = self.indexes
+            for cgroup in index.cgroups:
                 if not cgroup:
                     continue
 
-                samples['cgroup.memory.usage'][cgroup] = read_int_file(rootfd, 'memory.current', 0)
-                samples['cgroup.memory.limit'][cgroup] = read_int_file(rootfd, 'memory.max')
-                samples['cgroup.memory.sw-usage'][cgroup] = read_int_file(rootfd, 'memory.swap.current', 0)
-                samples['cgroup.memory.sw-limit'][cgroup] = read_int_file(rootfd, 'memory.swap.max')
-                samples['cgroup.cpu.shares'][cgroup] = read_int_file(rootfd, 'cpu.weight')
-                usage_usec = read_int_file(rootfd, 'cpu.stat', 0, key=b'usage_usec')
+                samples['cgroup.memory.usage'][cgroup] = index.read_int(cgroup, 'memory.current', 0)
+                samples['cgroup.memory.limit'][cgroup] = index.read_int(cgroup, 'memory.max')
+                samples['cgroup.memory.sw-usage'][cgroup] = index.read_int(cgroup, 'memory.swap.current', 0)
+                samples['cgroup.memory.sw-limit'][cgroup] = index.read_int(cgroup, 'memory.swap.max')
+                samples['cgroup.cpu.shares'][cgroup] = index.read_int(cgroup, 'cpu.weight')
+                usage_usec = index.read_int(cgroup, 'cpu.stat', 0, key=b'usage_usec')
                 if usage_usec:
                     samples['cgroup.cpu.usage'][cgroup] = usage_usec / 1000
         else:
-            memory_path = '/sys/fs/cgroup/memory/'
-            for path, _, _, rootfd in os.fwalk(memory_path):
-                cgroup = path.replace(memory_path, '')
-
+            memory_index, cpu_index = self.indexes
+            for cgroup in memory_index.cgroups:
                 if not cgroup:
                     continue
 
-                samples['cgroup.memory.usage'][cgroup] = read_int_file(rootfd, 'memory.usage_in_bytes', 0)
-                samples['cgroup.memory.limit'][cgroup] = read_int_file(rootfd, 'memory.limit_in_bytes')
-                samples['cgroup.memory.sw-usage'][cgroup] = read_int_file(rootfd, 'memory.memsw.usage_in_bytes', 0)
-                samples['cgroup.memory.sw-limit'][cgroup] = read_int_file(rootfd, 'memory.memsw.limit_in_bytes')
-
-            cpu_path = '/sys/fs/cgroup/cpu/'
-            for path, _, _, rootfd in os.fwalk(cpu_path):
-                cgroup = path.replace(cpu_path, '')
+                samples['cgroup.memory.usage'][cgroup] = memory_index.read_int(cgroup, 'memory.usage_in_bytes', 0)
+                samples['cgroup.memory.limit'][cgroup] = memory_index.read_int(cgroup, 'memory.limit_in_bytes')
+                samples['cgroup.memory.sw-usage'][cgroup] = memory_index.read_int(cgroup,
+                                                                                  'memory.memsw.usage_in_bytes', 0)
+                samples['cgroup.memory.sw-limit'][cgroup] = memory_index.read_int(cgroup,
+                                                                                  'memory.memsw.limit_in_bytes')
 
+            for cgroup in cpu_index.cgroups:
                 if not cgroup:
                     continue
 
-                samples['cgroup.cpu.shares'][cgroup] = read_int_file(rootfd, 'cpu.shares')
-                usage_nsec = read_int_file(rootfd, 'cpuacct.usage')
+                samples['cgroup.cpu.shares'][cgroup] = cpu_index.read_int(cgroup, 'cpu.shares')
+                usage_nsec = cpu_index.read_int(cgroup, 'cpuacct.usage')
                 if usage_nsec:
                     samples['cgroup.cpu.usage'][cgroup] = usage_nsec / 1000000
 
+    def close(self) -> None:
+        if self.indexes is not None:
+            for index in self.indexes:
+                index.close()
+            self.indexes = None
+
 
 class CGroupDiskIO(Sampler):
     IO_RE = re.compile(rb'\bread_bytes: (?P<read>\d+).*\nwrite_bytes: (?P<write>\d+)', flags=re.S)
+    IO_STAT_RE = re.compile(rb'\brbytes=(?P<read>\d+) wbytes=(?P<write>\d+)')
     descriptions = [
         SampleDescription('disk.cgroup.read', 'bytes', 'counter', instanced=True),
         SampleDescription('disk.cgroup.written', 'bytes', 'counter', instanced=True),
     ]
 
+    cgroups_v2: Optional[bool] = None
+    index: Optional[CGroupIndex] = None
+
+    def __init__(self) -> None:
+        # the last totals of each cgroup, the ones of its removed children,
+        # and the own I/O last reported for it
+        self.totals: Dict[str, Tuple[int, int]] = {}
+        self.removed: Dict[str, Tuple[int, int]] = {}
+        self.reported: Dict[str, Tuple[int, int]] = {}
+
     @staticmethod
     def get_cgroup_name(fd: int) -> str:
         with Handle.open('cgroup', os.O_RDONLY, dir_fd=fd) as cgroup_fd:
@@ -333,6 +746,76 @@ class CGroupDiskIO(Sampler):
             return 0, 0
 
     def sample(self, samples: Samples) -> None:
+        if self.cgroups_v2 is None:
+            self.cgroups_v2 = os.path.exists(f'{CGROUP_PATH}/cgroup.controllers')
+
+        if self.cgroups_v2:
+            self.sample_io_stat(samples)
+        else:
+            self.sample_processes(samples)
+
+    def sample_io_stat(self, samples: Samples) -> None:
+        # The kernel keeps the totals per cgroup, and per device:
+        # "8:0 rbytes=… wbytes=… rios=…".  Those include the I/O of all the
+        # cgroups below it, so subtract the totals of the direct children,
+        # to report the own I/O of each cgroup, like without cgroups v2.
+        if self.index is None:
+            self.index = open_cgroup_index(CGROUP_PATH, ['io.stat'])
+        self.index.update()
+
+        # Children get added after their parents: read them first, so that
+        # their totals don't get ahead of their parent's
+        totals: Dict[str, Tuple[int, int]] = {}
+        for cgroup in reversed(list(self.index.cgroups)):
+            if not cgroup:
+                continue
+
+            # missing if the io controller isn't enabled for this cgroup
+            data = self.index.read(cgroup, 'io.stat', 65536)
+            if data is None:
+                continue
+
+            read = written = 0
+            for match in self.IO_STAT_RE.finditer(data):
+                read += int(match.group('read'))
+                written += int(match.group('write'))
+            totals[cgroup] = read, written
+
+        # The I/O of removed children stays in their parent's totals: keep
+        # subtracting their last totals, or it would show up as the parent's
+        for cgroup in self.totals.keys() - totals.keys():
+            self.removed.pop(cgroup, None)
+            self.reported.pop(cgroup, None)
+            parent = cgroup.rpartition('/')[0]
+            if parent in totals:
+                read, written = self.totals[cgroup]
+                removed_read, removed_written = self.removed.get(parent, (0, 0))
+                self.removed[parent] = removed_read + read, removed_written + written
+        self.totals = totals
+
+        own_reads: Dict[str, int] = {}
+        own_writes: Dict[str, int] = {}
+        for cgroup, (read, written) in totals.items():
+            removed_read, removed_written = self.removed.get(cgroup, (0, 0))
+            own_reads[cgroup] = own_reads.get(cgroup, 0) + read - removed_read
+            own_writes[cgroup] = own_writes.get(cgroup, 0) + written - removed_written
+            parent = cgroup.rpartition('/')[0]
+            if parent in totals:
+                own_reads[parent] = own_reads.get(parent, 0) - read
+                own_writes[parent] = own_writes.get(parent, 0) - written
+
+        # These are counters: don't go back below what was reported before,
+        # if some I/O of the children still happened between the reads
+        reads = samples['disk.cgroup.read']
+        writes = samples['disk.cgroup.written']
+        for cgroup in totals:
+            last_read, last_written = self.reported.get(cgroup, (0, 0))
+            reads[cgroup] = max(own_reads[cgroup], last_read)
+            writes[cgroup] = max(own_writes[cgroup], last_written)
+            self.reported[cgroup] = reads[cgroup], writes[cgroup]
+
+    def sample_processes(self, samples: Samples) -> None:
+        # Without cgroups v2, add up the I/O of the processes in each cgroup
         with Handle.open('/proc', os.O_RDONLY | os.O_DIRECTORY) as proc_fd:
             reads = samples['disk.cgroup.read']
             writes = samples['disk.cgroup.written']
@@ -352,6 +835,11 @@ class CGroupDiskIO(Sampler):
                 reads[cgroup_name] = reads.get(cgroup_name, 0) + proc_read
                 writes[cgroup_name] = writes.get(cgroup_name, 0) + proc_write
 
+    def close(self) -> None:
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
 
 class NetworkSampler(Sampler):
     descriptions = [
@@ -359,18 +847,22 @@ class NetworkSampler(Sampler):
         SampleDescription('network.interface.rx', 'bytes', 'counter', instanced=True),
     ]
 
+    def __init__(self) -> None:
+        self.dev = ProcFile(f'{PROC_PATH}/net/dev')
+
     def sample(self, samples: Samples) -> None:
-        with open("/proc/net/dev") as network_samples:
-            for line in network_samples:
-                fields = line.split()
+        data = self.dev.read()
 
-                # Skip header line
-                if fields[0][-1] != ':':
-                    continue
+        # Skip the two header lines.  Older kernels put large counters right after the colon.
+        start = data.find(b'\n', data.find(b'\n') + 1) + 1
+        fields, n_columns = split_table(data[start:].replace(b':', b' '))
+        ifaces = self.dev.decode(fields[0::n_columns])
+
+        samples['network.interface.rx'] = dict(zip(ifaces, map(int, fields[1::n_columns])))  # noqa: B905
+        samples['network.interface.tx'] = dict(zip(ifaces, map(int, fields[9::n_columns])))  # noqa: B905
 
-                iface = fields[0][:-1]
-                samples['network.interface.rx'][iface] = int(fields[1])
-                samples['network.interface.tx'][iface] = int(fields[9])
+    def close(self) -> None:
+        self.dev.close()
 
 
 class MountSampler(Sampler):
@@ -379,30 +871,45 @@ class MountSampler(Sampler):
         SampleDescription('mount.used', 'bytes', 'instant', instanced=True),
     ]
 
+    def __init__(self) -> None:
+        self.mounts = ProcFile(f'{PROC_PATH}/mounts', 16384)
+        self.data = b''
+        self.paths: List[Tuple[bytes, str]] = []
+
     def sample(self, samples: Samples) -> None:
-        with open('/proc/mounts') as mounts:
-            for line in mounts:
+        # The mounts rarely change: only look at them again when they do
+        data = self.mounts.read()
+        if data != self.data:
+            self.data = data
+            self.paths = []
+            fields, n_columns = split_table(data)
+            columns = fields[0::n_columns], fields[1::n_columns], fields[3::n_columns]
+            for fs_spec, fs_file, fs_mntopts in zip(*columns):  # noqa: B905
                 # Only look at real devices
-                if line[0] != '/':
+                if not fs_spec.startswith(b'/'):
                     continue
 
-                fs_spec, fs_file, _fs_vfstype, fs_mntopts, *_rest = line.split()
-
                 # Skip read-only loop mounts
-                if '/loop' in fs_spec and 'ro' in fs_mntopts.split(','):
+                if b'/loop' in fs_spec and b'ro' in fs_mntopts.split(b','):
                     continue
                 # Hide flatpaks
-                if 'revokefs-fuse' in fs_spec and 'flatpak' in fs_file:
+                if b'revokefs-fuse' in fs_spec and b'flatpak' in fs_file:
                     continue
 
-                try:
-                    res = os.statvfs(fs_file)
-                except OSError:
-                    continue
-                frsize = res.f_frsize
-                total = frsize * res.f_blocks
-                samples['mount.total'][fs_file] = total
-                samples['mount.used'][fs_file] = total - frsize * res.f_bfree
+                self.paths.append((fs_file, os.fsdecode(fs_file)))
+
+        for fs_file, path in self.paths:
+            try:
+                res = os.statvfs(fs_file)
+            except OSError:
+                continue
+            frsize = res.f_frsize
+            total = frsize * res.f_blocks
+            samples['mount.total'][path] = total
+            samples['mount.used'][path] = total - frsize * res.f_bfree
+
+    def close(self) -> None:
+        self.mounts.close()
 
 
 class BlockSampler(Sampler):
@@ -411,14 +918,56 @@ class BlockSampler(Sampler):
         SampleDescription('block.device.written', 'bytes', 'counter', instanced=True),
     ]
 
+    def __init__(self) -> None:
+        self.diskstats = ProcFile(f'{PROC_PATH}/diskstats')
+
     def sample(self, samples: Samples) -> None:
-        with open('/proc/diskstats') as diskstats:
-            for line in diskstats:
-                # https://www.kernel.org/doc/Documentation/ABI/testing/procfs-diskstats
-                [_, _, dev_name, _, _, sectors_read, _, _, _, sectors_written, *_] = line.strip().split()
+        # https://www.kernel.org/doc/Documentation/ABI/testing/procfs-diskstats
+        fields, n_columns = split_table(self.diskstats.read())
+        names = self.diskstats.decode(fields[2::n_columns])
+
+        read_bytes = [n * 512 for n in map(int, fields[5::n_columns])]
+        written_bytes = [n * 512 for n in map(int, fields[9::n_columns])]
+        samples['block.device.read'] = dict(zip(names, read_bytes))  # noqa: B905
+        samples['block.device.written'] = dict(zip(names, written_bytes))  # noqa: B905
 
-                samples['block.device.read'][dev_name] = int(sectors_read) * 512
-                samples['block.device.written'][dev_name] = int(sectors_written) * 512
+    def close(self) -> None:
+        self.diskstats.close()
+
+
+class BridgeSampler(Sampler):
+    """The bridge's own load, per payload type.  Not in SAMPLERS: needs a Stats."""
+    descriptions = [
+        SampleDescription('bridge.channels', 'count', 'instant', instanced=True),
+        SampleDescription('bridge.channels.opened', 'count', 'counter', instanced=True),
+        SampleDescription('bridge.frames.in', 'count', 'counter', instanced=True),
+        SampleDescription('bridge.frames.out', 'count', 'counter', instanced=True),
+        SampleDescription('bridge.bytes.in', 'bytes', 'counter', instanced=True),
+        SampleDescription('bridge.bytes.out', 'bytes', 'counter', instanced=True),
+        SampleDescription('bridge.queued.in', 'bytes', 'instant', instanced=False),
+        SampleDescription('bridge.queued.out', 'bytes', 'instant', instanced=False),
+        SampleDescription('bridge.loop.lag', 'millisec', 'instant', instanced=False),
+    ]
+
+    def __init__(self, stats: Stats) -> None:
+        self.stats = stats
+        stats.add_lag_reader()
+
+    def close(self) -> None:
+        self.stats.remove_lag_reader()
+
+    def sample(self, samples: Samples) -> None:
+        for payload, values in self.stats.get_payloads().items():
+            samples['bridge.channels'][payload] = values['channels']
+            samples['bridge.channels.opened'][payload] = values['opened']
+            samples['bridge.frames.in'][payload] = values['frames-in']
+            samples['bridge.frames.out'][payload] = values['frames-out']
+            samples['bridge.bytes.in'][payload] = values['bytes-in']
+            samples['bridge.bytes.out'][payload] = values['bytes-out']
+
+        samples['bridge.queued.in'] = self.stats.get_queued_bytes()
+        samples['bridge.queued.out'] = self.stats.get_write_buffer_size()
+        samples['bridge.loop.lag'] = self.stats.loop_lag * 1000
 
 
 SAMPLERS = [
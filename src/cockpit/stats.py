@@ -0,0 +1,236 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import bisect
+import logging
+import time
+from typing import TYPE_CHECKING, ClassVar, Dict, Optional, Sequence
+
+if TYPE_CHECKING:
+    from .router import Router
+
+logger = logging.getLogger(__name__)
+
+
+class Counters:
+    """Data frames and bytes going in (from the client) and out (to the client)"""
+    __slots__ = ('bytes_in', 'bytes_out', 'frames_in', 'frames_out')
+
+    def __init__(self) -> None:
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+
+    def add(self, other: 'Counters') -> None:
+        self.frames_in += other.frames_in
+        self.bytes_in += other.bytes_in
+        self.frames_out += other.frames_out
+        self.bytes_out += other.bytes_out
+
+    def get_counters(self) -> Dict[str, int]:
+        return {
+            'frames-in': self.frames_in,
+            'bytes-in': self.bytes_in,
+            'frames-out': self.frames_out,
+            'bytes-out': self.bytes_out,
+        }
+
+
+class PayloadStats(Counters):
+    """Totals for one payload type.  The counters only include closed channels."""
+    __slots__ = ('closed', 'opened', 'ready_latency', 'rejected')
+
+    def __init__(self, n_buckets: int) -> None:
+        super().__init__()
+        self.opened = 0
+        self.closed = 0
+        self.rejected = 0
+        self.ready_latency = [0] * n_buckets
+
+
+class ChannelStats(Counters):
+    __slots__ = ('open_time', 'payload', 'payload_type')
+
+    def __init__(self, payload: PayloadStats, payload_type: str) -> None:
+        super().__init__()
+        self.payload = payload
+        self.payload_type = payload_type
+        self.open_time: Optional[float] = time.monotonic()
+
+
+class Stats:
+    """Performance counters for a Router
+
+    The router calls in here for each data frame it receives or sends, and
+    when channels open, get ready, and close.  The counters are kept per open
+    channel, and folded into the totals for their payload type when the
+    channel closes.  Anything more expensive than that (summing up, reading
+    the queue sizes) only happens when someone asks for the numbers.
+
+    While the router is connected and someone is interested, we also check
+    how late the main loop runs a timer once per LOOP_LAG_INTERVAL, which
+    tells us if something is blocking it.  Samplers hold a reference with
+    add_lag_reader() for as long as they exist.  Polling readers (on D-Bus)
+    call poll_loop_lag(), which keeps the timer running for another
+    LOOP_LAG_POLL_TIMEOUT seconds.
+    """
+    # Upper bounds (in seconds) of the buckets of the open-to-ready latency
+    # histograms.  There's one extra bucket at the end for everything slower.
+    READY_LATENCY_BUCKETS: ClassVar[Sequence[float]] = (
+        0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0
+    )
+    LOOP_LAG_INTERVAL: ClassVar[float] = 1.0
+    LOOP_LAG_POLL_TIMEOUT: ClassVar[float] = 60.0
+
+    router: 'Router'
+    channels: Dict[str, ChannelStats]
+    payloads: Dict[str, PayloadStats]
+
+    loop_lag: float = 0.0
+    loop_lag_max: float = 0.0
+    _connected: bool = False
+    _lag_readers: int = 0
+    _lag_polled: Optional[float] = None
+    _lag_timer: Optional[asyncio.TimerHandle] = None
+
+    def __init__(self, router: 'Router') -> None:
+        self.router = router
+        self.channels = {}
+        self.payloads = {}
+
+    def _get_payload(self, name: str) -> PayloadStats:
+        payload = self.payloads.get(name)
+        if payload is None:
+            payload = self.payloads[name] = PayloadStats(len(self.READY_LATENCY_BUCKETS) + 1)
+        return payload
+
+    # called by the router
+    def channel_opened(self, channel: str, payload: str) -> None:
+        stats = self._get_payload(payload)
+        stats.opened += 1
+        self.channels[channel] = ChannelStats(stats, payload)
+
+    def channel_rejected(self, payload: str) -> None:
+        self._get_payload(payload).rejected += 1
+
+    def channel_ready(self, channel: str) -> None:
+        stats = self.channels.get(channel)
+        if stats is not None and stats.open_time is not None:
+            latency = time.monotonic() - stats.open_time
+            stats.payload.ready_latency[bisect.bisect_left(self.READY_LATENCY_BUCKETS, latency)] += 1
+            stats.open_time = None
+
+    def channel_closed(self, channel: str) -> None:
+        stats = self.channels.pop(channel, None)
+        if stats is not None:
+            stats.payload.add(stats)
+            stats.payload.closed += 1
+
+    def data_received(self, channel: str, size: int) -> None:
+        stats = self.channels.get(channel)
+        if stats is not None:
+            stats.frames_in += 1
+            stats.bytes_in += size
+
+    def data_sent(self, channel: str, size: int) -> None:
+        stats = self.channels.get(channel)
+        if stats is not None:
+            stats.frames_out += 1
+            stats.bytes_out += size
+
+    # event loop lag
+    def start(self) -> None:
+        self._connected = True
+        self._update_lag_timer()
+
+    def stop(self) -> None:
+        self._connected = False
+        self._update_lag_timer()
+
+    def add_lag_reader(self) -> None:
+        self._lag_readers += 1
+        self._update_lag_timer()
+
+    def remove_lag_reader(self) -> None:
+        self._lag_readers -= 1
+        self._update_lag_timer()
+
+    def poll_loop_lag(self) -> None:
+        """Keep measuring the loop lag for a while, for a reader who polls it"""
+        self._lag_polled = asyncio.get_running_loop().time()
+        self._update_lag_timer()
+
+    def _update_lag_timer(self) -> None:
+        wanted = self._connected and (self._lag_readers > 0 or self._lag_polled is not None)
+        if wanted and self._lag_timer is None:
+            self._schedule_lag_check(asyncio.get_running_loop())
+        elif not wanted and self._lag_timer is not None:
+            self._lag_timer.cancel()
+            self._lag_timer = None
+
+    def _schedule_lag_check(self, loop: asyncio.AbstractEventLoop) -> None:
+        deadline = loop.time() + self.LOOP_LAG_INTERVAL
+        self._lag_timer = loop.call_at(deadline, self._check_lag, loop, deadline)
+
+    def _check_lag(self, loop: asyncio.AbstractEventLoop, deadline: float) -> None:
+        self.loop_lag = loop.time() - deadline
+        if self.loop_lag > self.loop_lag_max:
+            logger.debug('Main loop lag: %.3fs', self.loop_lag)
+            self.loop_lag_max = self.loop_lag
+
+        if self._lag_polled is not None and loop.time() - self._lag_polled > self.LOOP_LAG_POLL_TIMEOUT:
+            self._lag_polled = None
+        self._lag_timer = None
+        self._update_lag_timer()
+
+    # queries
+    def get_payloads(self) -> Dict[str, Dict[str, int]]:
+        """Returns the counters for each payload type, including open channels"""
+        result = {
+            name: {'channels': 0, 'opened': payload.opened, 'closed': payload.closed, 'rejected': payload.rejected,
+                   **payload.get_counters()}
+            for name, payload in self.payloads.items()
+        }
+
+        for channel in self.channels.values():
+            totals = result[channel.payload_type]
+            totals['channels'] += 1
+            for key, value in channel.get_counters().items():
+                totals[key] += value
+
+        return result
+
+    def get_channels(self) -> 'dict[str, dict[str, int | float | str]]':
+        """Returns the payload type and counters of each open channel
+
+        Channels also report their flow control state: the size of their send
+        window, the round trip time, once it has been measured, and the bytes
+        they have received but not yet consumed, for those which queue them.
+        """
+        result: 'dict[str, dict[str, int | float | str]]' = {}
+        for channel, stats in self.channels.items():
+            values: 'dict[str, int | float | str]' = {'payload': stats.payload_type, **stats.get_counters()}
+            endpoint = self.router.open_channels.get(channel)
+            if endpoint is not None:
+                values.update(endpoint.get_channel_stats(channel))
+            result[channel] = values
+        return result
+
+    def get_ready_latency(self) -> Dict[str, Sequence[int]]:
+        return {name: list(payload.ready_latency) for name, payload in self.payloads.items()}
+
+    def get_queued_bytes(self) -> int:
+        """Bytes received for channels, but not yet consumed by them"""
+        return self.router.queued_bytes
+
+    def get_input_paused(self) -> bool:
+        """If reading from the client is paused, because too much is queued"""
+        return self.router.input_paused
+
+    def get_write_buffer_size(self) -> int:
+        """Bytes waiting to be written to the client"""
+        transport = self.router.transport
+        return transport.get_write_buffer_size() if transport is not None else 0
@@ -10,15 +10,17 @@ import collections
 import ctypes
 import errno
 import fcntl
+import itertools
 import logging
 import os
 import select
 import signal
 import struct
 import subprocess
+import sys
 import termios
 from threading import Thread
-from typing import Any, ClassVar, Sequence
+from typing import Any, ClassVar, Iterable, Sequence
 
 from .jsonutil import JsonObject, get_int
 
@@ -39,14 +41,44 @@ logger = logging.getLogger(__name__)
 IOV_MAX = 1024  # man 2 writev
 
 
+class _Message:
+    # A group of buffers in the write queue of a _Transport
+    __slots__ = ('n_buffers', 'stream', 'urgent')
+
+    def __init__(self, n_buffers: int, stream: 'str | None', *, urgent: bool) -> None:
+        self.n_buffers = n_buffers
+        self.stream = stream
+        self.urgent = urgent
+
+    def blocks(self, stream: 'str | None') -> bool:
+        """Whether an urgent message for the stream must stay behind this one"""
+        return self.stream is None or self.stream == stream
+
+    def can_merge(self, stream: 'str | None') -> bool:
+        """Whether a (non-urgent) message for the stream can be merged into this one"""
+        return not self.urgent and self.stream == stream
+
+
 class _Transport(asyncio.Transport):
     BLOCK_SIZE: ClassVar[int] = 1024 * 1024
+    CORK_SIZE: ClassVar[int] = 64 * 1024
+    WRITE_BUFFER_HIGH: ClassVar[int] = 64 * 1024  # same default as asyncio
 
     # A transport always has a loop and a protocol
     _loop: asyncio.AbstractEventLoop
-    _protocol: asyncio.Protocol
-
-    _queue: 'collections.deque[bytes] | None'
+    _protocol: 'asyncio.Protocol | asyncio.BufferedProtocol'
+
+    _queue: 'collections.deque[bytes | memoryview] | None'
+    _queue_size: int = 0
+    # The buffers in the queue are grouped into messages (see .write_message()).
+    # If the first message was partially written, it has to be finished first.
+    _messages: 'collections.deque[_Message]'
+    _head_started: bool = False
+    _flush_handle: 'asyncio.Handle | None' = None
+    _writer_added: bool = False
+    _writing_paused: bool = False
+    _high_water: int
+    _low_water: int
     _in_fd: int
     _out_fd: int
     _closing: bool
@@ -56,9 +88,10 @@ class _Transport(asyncio.Transport):
 
     def __init__(self,
                  loop: asyncio.AbstractEventLoop,
-                 protocol: asyncio.Protocol,
+                 protocol: 'asyncio.Protocol | asyncio.BufferedProtocol',
                  in_fd: int = -1, out_fd: int = -1,
-                 extra: 'dict[str, object] | None' = None):
+                 extra: 'dict[str, object] | None' = None,
+                 write_buffer_limits: 'tuple[int, int] | None' = None):
         super().__init__(extra)
 
         self._loop = loop
@@ -74,6 +107,8 @@ class _Transport(asyncio.Transport):
         self._in_fd = in_fd
         self._out_fd = out_fd
 
+        self.set_write_buffer_limits(*(write_buffer_limits or ()))
+
         os.set_blocking(in_fd, False)
         if out_fd != in_fd:
             os.set_blocking(out_fd, False)
@@ -83,6 +118,13 @@ class _Transport(asyncio.Transport):
 
     def _read_ready(self) -> None:
         logger.debug('Read ready on %s %s %d', self, self._protocol, self._in_fd)
+
+        # asyncio.BufferedProtocol is new in Python 3.7: older protocols get .data_received()
+        if sys.version_info >= (3, 7):
+            if isinstance(self._protocol, asyncio.BufferedProtocol):
+                self._read_ready_buffered(self._protocol)
+                return
+
         try:
             data = os.read(self._in_fd, _Transport.BLOCK_SIZE)
         except BlockingIOError:  # pragma: no cover
@@ -100,11 +142,41 @@ class _Transport(asyncio.Transport):
             logger.debug('  read %d bytes', len(data))
             self._protocol.data_received(data)
         else:
-            logger.debug('  got EOF')
-            self._close_reader()
-            keep_open = self._protocol.eof_received()
-            if not keep_open:
-                self.close()
+            self._eof_received()
+
+    def _read_ready_buffered(self, protocol: asyncio.BufferedProtocol) -> None:
+        # The protocol provides the buffer, and we read straight into it
+        buffer = memoryview(protocol.get_buffer(_Transport.BLOCK_SIZE))
+        try:
+            if hasattr(os, 'readv'):
+                n_bytes = os.readv(self._in_fd, (buffer,))
+            else:
+                data = os.read(self._in_fd, len(buffer))
+                n_bytes = len(data)
+                buffer[:n_bytes] = data
+        except BlockingIOError:  # pragma: no cover
+            return
+        except OSError as exc:
+            if self._eio_is_eof and exc.errno == errno.EIO:
+                # PTY devices return EIO to mean "EOF"
+                n_bytes = 0
+            else:
+                # Other errors: terminate the connection
+                self.abort(exc)
+                return
+
+        if n_bytes != 0:
+            logger.debug('  read %d bytes', n_bytes)
+            protocol.buffer_updated(n_bytes)
+        else:
+            self._eof_received()
+
+    def _eof_received(self) -> None:
+        logger.debug('  got EOF')
+        self._close_reader()
+        keep_open = self._protocol.eof_received()
+        if not keep_open:
+            self.close()
 
     def is_reading(self) -> bool:
         return self._is_reading
@@ -149,16 +221,43 @@ class _Transport(asyncio.Transport):
             logger.debug('%s got EOF.  bytes in queue, deferring close', self)
 
     def get_write_buffer_size(self) -> int:
-        if self._queue is None:
-            return 0
-        return sum(len(block) for block in self._queue)
+        return self._queue_size
 
     def get_write_buffer_limits(self) -> 'tuple[int, int]':
-        return (0, 0)
+        return (self._low_water, self._high_water)
 
     def set_write_buffer_limits(self, high: 'int | None' = None, low: 'int | None' = None) -> None:
-        assert high is None or high == 0
-        assert low is None or low == 0
+        """Set the high and low watermarks for write flow control.
+
+        The protocol is paused when the amount of data that the kernel didn't
+        accept yet goes above the high watermark, and resumed when it drops to
+        (or below) the low watermark.  This works like the asyncio transports:
+        if only one value is given, the other one is derived from it, and
+        setting both to 0 pauses as soon as a write is incomplete.
+        """
+        if high is None:
+            high = self.WRITE_BUFFER_HIGH if low is None else 4 * low
+        if low is None:
+            low = high // 4
+
+        if not high >= low >= 0:
+            raise ValueError(f'high ({high!r}) must be >= low ({low!r}) must be >= 0')
+
+        self._high_water = high
+        self._low_water = low
+
+        if self._writer_added:
+            self._update_writing_paused()
+
+    def _update_writing_paused(self) -> None:
+        if not self._writing_paused and self._queue_size > self._high_water:
+            logger.debug('%s write buffer at %d bytes: pausing protocol', self, self._queue_size)
+            self._writing_paused = True
+            self._protocol.pause_writing()
+        elif self._writing_paused and self._queue_size <= self._low_water:
+            logger.debug('%s write buffer at %d bytes: resuming protocol', self, self._queue_size)
+            self._writing_paused = False
+            self._protocol.resume_writing()
 
     def _write_eof_now(self) -> None:
         raise NotImplementedError
@@ -167,25 +266,58 @@ class _Transport(asyncio.Transport):
         logger.debug('%s _write_ready', self)
         assert self._queue is not None
 
-        try:
-            n_bytes = os.writev(self._out_fd, self._queue)
-        except BlockingIOError:  # pragma: no cover
-            n_bytes = 0
-        except OSError as exc:
-            self.abort(exc)
-            return
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        # writev() will complain if we give it too many buffers at once, so we
+        # write in batches of IOV_MAX.  Keep going as long as batches get
+        # written completely.
+        while self._queue:
+            if len(self._queue) > IOV_MAX:
+                batch: 'Sequence[bytes | memoryview]' = list(itertools.islice(self._queue, IOV_MAX))
+            else:
+                batch = self._queue
 
-        logger.debug('  successfully wrote %d bytes from the queue', n_bytes)
+            try:
+                n_bytes = os.writev(self._out_fd, batch)
+            except BlockingIOError:  # pragma: no cover
+                n_bytes = 0
+            except OSError as exc:
+                self.abort(exc)
+                return
 
-        while n_bytes:
-            block = self._queue.popleft()
-            if len(block) > n_bytes:
-                # This block wasn't completely written.
-                logger.debug('  incomplete block.  Stop.')
-                self._queue.appendleft(block[n_bytes:])
+            logger.debug('  successfully wrote %d bytes from the queue', n_bytes)
+            self._queue_size -= n_bytes
+
+            n_blocks = 0
+            while n_bytes:
+                block = self._queue.popleft()
+                if len(block) > n_bytes:
+                    # This block wasn't completely written.
+                    logger.debug('  incomplete block.  Stop.')
+                    self._queue.appendleft(memoryview(block)[n_bytes:])
+                    break
+                n_bytes -= len(block)
+                n_blocks += 1
+                logger.debug('  removed complete block.  %d remains.', n_bytes)
+
+            # Remove the messages we finished
+            n_remaining = n_blocks
+            while n_remaining:
+                message = self._messages[0]
+                if message.n_buffers > n_remaining:
+                    message.n_buffers -= n_remaining
+                    break
+                n_remaining -= message.n_buffers
+                self._messages.popleft()
+            if n_bytes or n_remaining:
+                self._head_started = True
+            elif n_blocks:
+                self._head_started = False
+
+            if n_blocks < IOV_MAX:
                 break
-            n_bytes -= len(block)
-            logger.debug('  removed complete block.  %d remains.', n_bytes)
 
         if not self._queue:
             logger.debug('%s queue drained.')
@@ -196,20 +328,57 @@ class _Transport(asyncio.Transport):
             if self._closing:
                 self.abort()
 
+        else:
+            if not self._writer_added:
+                # The kernel buffer is full: wait until we can write again
+                logger.debug('%s waiting for fd %s to become writable', self, self._out_fd)
+                self._loop.add_writer(self._out_fd, self._write_ready)
+                self._writer_added = True
+            self._update_writing_paused()
+
     def _remove_write_queue(self) -> None:
         if self._queue is not None:
-            self._protocol.resume_writing()
-            self._loop.remove_writer(self._out_fd)
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            if self._writer_added:
+                self._loop.remove_writer(self._out_fd)
+                self._writer_added = False
             self._queue = None
-
-    def _create_write_queue(self, data: bytes) -> None:
-        logger.debug('%s creating write queue for fd %s', self, self._out_fd)
-        assert self._queue is None
-        self._loop.add_writer(self._out_fd, self._write_ready)
-        self._queue = collections.deque((data,))
-        self._protocol.pause_writing()
-
-    def write(self, data: bytes) -> None:
+            self._queue_size = 0
+            self._head_started = False
+            if self._writing_paused:
+                self._writing_paused = False
+                self._protocol.resume_writing()
+
+    def write(self, data: 'bytes | bytearray | memoryview') -> None:
+        self.writelines((data,))
+
+    def writelines(self, list_of_data: 'Iterable[bytes | bytearray | memoryview]') -> None:
+        """Queue some data for writing.
+
+        Writes are corked: everything written during one main loop iteration
+        gets flushed with a single writev() call at the start of the next one,
+        or as soon as CORK_SIZE bytes have been queued up.  Passing separate
+        buffers here (like a frame header and its payload) avoids copying them
+        together.
+
+        The data is queued without copying if it can't change after we return:
+        bytes, and memoryviews of bytes.  Anything else (bytearrays, views of
+        mutable buffers like a receive buffer or a mmap) gets copied.
+        """
+        self.write_message(list_of_data)
+
+    def write_message(self, list_of_data: 'Iterable[bytes | bytearray | memoryview]',
+                      stream: 'str | None' = None, *, urgent: bool = False) -> None:
+        """Queue some data for writing, as a message which belongs to a stream.
+
+        This is like .writelines(), except that urgent messages can overtake
+        queued messages from other streams.  They never overtake messages of
+        the same stream, messages without a stream, or a message which is
+        already partially written.  Urgent messages which overtook the same
+        messages stay in order.  Messages are never split up.
+        """
         # this is a race condition with subprocesses: if we get and process the the "exited"
         # event before seeing BrokenPipeError, we'll try to write to a closed pipe.
         # Do what the standard library does and ignore, instead of assert
@@ -219,27 +388,69 @@ class _Transport(asyncio.Transport):
 
         assert not self._eof
 
-        if self._queue is not None:
-            self._queue.append(data)
+        if self._queue is None:
+            logger.debug('%s creating write queue for fd %s', self, self._out_fd)
+            self._queue = collections.deque()
+            self._messages = collections.deque()
+            self._flush_handle = self._loop.call_soon(self._write_ready)
+
+        n_queued = len(self._queue)
+        for data in list_of_data:
+            if data:
+                # We hold on to the data after returning: don't let it change under us.
+                # A view keeps its bytes object alive, and slices of it share its .obj
+                block: 'bytes | memoryview'
+                if isinstance(data, bytes) or (isinstance(data, memoryview) and isinstance(data.obj, bytes)):
+                    block = data
+                else:
+                    block = bytes(data)
+                self._queue.append(block)
+                self._queue_size += len(block)
+        n_buffers = len(self._queue) - n_queued
+
+        if not n_buffers:
+            pass
+        elif urgent:
+            blocks = [self._queue.pop() for _ in range(n_buffers)]
+            self._insert_urgent(_Message(n_buffers, stream, urgent=True), reversed(blocks))
+        elif self._messages and self._messages[-1].can_merge(stream) and len(self._messages) > self._head_started:
+            # Consecutive messages of a stream can't be split up by urgent
+            # messages anyway, so we don't need to keep them apart.
+            self._messages[-1].n_buffers += n_buffers
+        else:
+            self._messages.append(_Message(n_buffers, stream, urgent=False))
 
-            # writev() will complain if the queue is too long.  Consolidate it.
-            if len(self._queue) > IOV_MAX:
-                all_data = b''.join(self._queue)
-                self._queue.clear()
-                self._queue.append(all_data)
+        if self._flush_handle is not None:
+            if self._queue_size >= self.CORK_SIZE:
+                self._write_ready()
+        elif self._writer_added:
+            # We're already backed up: see if we went over the high watermark
+            self._update_writing_paused()
 
-            return
+    def _insert_urgent(self, message: _Message, blocks: 'Iterable[bytes | memoryview]') -> None:
+        assert self._queue is not None
+        position = len(self._messages)
+        index = len(self._queue)
 
-        try:
-            n_bytes = os.write(self._out_fd, data)
-        except BlockingIOError:
-            n_bytes = 0
-        except OSError as exc:
-            self.abort(exc)
-            return
+        # Go after the last message we may not overtake...
+        while position > self._head_started:
+            other = self._messages[position - 1]
+            if other.blocks(message.stream):
+                break
+            position -= 1
+            index -= other.n_buffers
 
-        if n_bytes != len(data):
-            self._create_write_queue(data[n_bytes:])
+        # ... but stay behind other urgent messages which got there first
+        while position < len(self._messages) and self._messages[position].urgent:
+            index += self._messages[position].n_buffers
+            position += 1
+
+        if position < len(self._messages):
+            logger.debug('%s queueing urgent message ahead of %d others', self, len(self._messages) - position)
+        self._messages.insert(position, message)
+        for block in blocks:
+            self._queue.insert(index, block)
+            index += 1
 
     def close(self) -> None:
         if self._closing:
@@ -290,7 +501,8 @@ class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
     SubprocessProtocol defined in this module (which only has a
     process_exited() method).  Whatever the protocol writes is sent to stdin,
     and whatever comes from stdout is given to the Protocol via the
-    .data_received() function.
+    .data_received() function (or via .get_buffer() and .buffer_updated() for
+    BufferedProtocol objects).
 
     If stderr is configured as a pipe, the transport will separately collect
     data from it, making it available via the .get_stderr() method.
@@ -346,6 +558,7 @@ class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
                  *,
                  pty: bool = False,
                  window: 'WindowSize | None' = None,
+                 write_buffer_limits: 'tuple[int, int] | None' = None,
                  **kwargs: Any):
 
         # go down as a team -- we don't want any leaked processes when the bridge terminates
@@ -382,7 +595,7 @@ class SubprocessTransport(_Transport, asyncio.SubprocessTransport):
         else:
             self._stderr = None
 
-        super().__init__(loop, protocol, in_fd, out_fd)
+        super().__init__(loop, protocol, in_fd, out_fd, write_buffer_limits=write_buffer_limits)
         self.watch_exit(self._process)
 
     def set_window_size(self, size: WindowSize) -> None:
@@ -464,10 +677,21 @@ class StdioTransport(_Transport):
         - pipes
         - character devices (including terminals)
         - sockets
-    """
 
-    def __init__(self, loop: asyncio.AbstractEventLoop, protocol: asyncio.Protocol, stdin: int = 0, stdout: int = 1):
-        super().__init__(loop, protocol, stdin, stdout)
+    This usually carries the data for all channels of the bridge, so it gets
+    a larger write buffer before the protocol gets paused.
+    """
+    WRITE_BUFFER_HIGH = 1024 * 1024
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        protocol: 'asyncio.Protocol | asyncio.BufferedProtocol',
+        stdin: int = 0,
+        stdout: int = 1,
+        write_buffer_limits: 'tuple[int, int] | None' = None,
+    ):
+        super().__init__(loop, protocol, stdin, stdout, write_buffer_limits=write_buffer_limits)
 
     def can_write_eof(self) -> bool:
         return False
@@ -514,7 +738,11 @@ class Spooler:
     def _is_ready(self) -> bool:
         if self._fd == -1:
             return False
-        return select.select([self._fd], [], [], 0) != ([], [], [])
+        # not select(): with the cgroup statistics files kept open (see
+        # cockpit.samples), our fds can easily be beyond FD_SETSIZE
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        return poller.poll(0) != []
 
     def get(self, *, reset: bool = False) -> bytes:
         while self._is_ready():
@@ -0,0 +1,404 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Protocol-level benchmarks for the bridge.
+
+Each case drives a Bridge through the Cockpit protocol, the same way that
+cockpit-ws does, over two kinds of transports:
+
+  - mock: the MockTransport from the unit tests, which feeds frames straight
+    into the bridge and collects its output, so we only measure the bridge
+
+  - pipe: a pair of pipes with a StdioTransport on each end, like the real
+    thing, so we also measure our transport and the syscalls
+
+The results can be written as JSON, and compared with an earlier run, for
+example before and after a change.  Run from the top-level source directory:
+
+    PYTHONPATH=src python3 -m test.bench.bridge --json before.json
+    PYTHONPATH=src python3 -m test.bench.bridge --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import IO, Awaitable, Callable, Dict, List, Optional, Protocol, Tuple
+
+from cockpit._vendor.systemd_ctypes import run_async
+from cockpit.bridge import Bridge
+from cockpit.jsonutil import JsonObject, JsonValue, get_int
+from cockpit.protocol import CockpitProtocol
+from cockpit.transports import StdioTransport
+
+from ..pytest.mocktransport import MockTransport
+
+# the metrics shown on the overview and metrics pages
+METRICS = [
+    'cpu.basic.nice', 'cpu.basic.user', 'cpu.basic.system', 'cpu.basic.iowait', 'cpu.core.user',
+    'memory.free', 'memory.used', 'memory.cached', 'memory.swap-used',
+    'disk.all.read', 'disk.all.written', 'disk.dev.read', 'disk.dev.written',
+    'network.interface.rx', 'network.interface.tx',
+    'cgroup.memory.usage', 'cgroup.cpu.usage', 'disk.cgroup.read', 'disk.cgroup.written',
+]
+
+
+class Result:
+    def __init__(self, case: str, metric: str, value: float, unit: str, *, lower_is_better: bool = False) -> None:
+        self.case = case
+        self.metric = metric
+        self.value = value
+        self.unit = unit
+        self.lower_is_better = lower_is_better
+
+    def to_json(self, transport: str) -> JsonObject:
+        return {
+            'case': self.case,
+            'transport': transport,
+            'metric': self.metric,
+            'value': self.value,
+            'unit': self.unit,
+            'lower-is-better': self.lower_is_better,
+        }
+
+
+class Client(Protocol):
+    """The parts of the MockTransport interface which the cases use"""
+    async def next_frame(self) -> Tuple[str, bytes]: ...
+
+    def send_json(self, channel_: str, **kwargs: JsonValue) -> None: ...
+
+    def send_data(self, channel: str, data: bytes) -> None: ...
+
+
+class PipeClient(CockpitProtocol, Client):
+    def __init__(self) -> None:
+        self.queue: 'asyncio.Queue[Tuple[str, bytes]]' = asyncio.Queue()
+
+    def channel_frame_received(self, channel: str, frame: memoryview) -> None:
+        self.queue.put_nowait((channel, bytes(frame[len(channel) + 1:])))
+
+    def control_received(self, data: bytes) -> None:
+        self.queue.put_nowait(('', data))
+
+    async def next_frame(self) -> Tuple[str, bytes]:
+        return await self.queue.get()
+
+    def send_json(self, channel_: str, **kwargs: JsonValue) -> None:
+        # same rules as MockTransport.send_json()
+        msg = {k.replace('_', '-') if k != "max_read_size" else k: v for k, v in kwargs.items()}
+        self.send_data(channel_, json.dumps(msg).encode('ascii'))
+
+    def send_data(self, channel: str, data: bytes) -> None:
+        self.write_channel_data(channel, data)
+
+
+async def next_msg(client: Client, expected_channel: str) -> JsonObject:
+    channel, data = await client.next_frame()
+    assert channel == expected_channel, (channel, data)
+    return json.loads(data)
+
+
+next_channel = 0
+
+
+async def open_channel(client: Client, payload: str, **kwargs: JsonValue) -> str:
+    global next_channel
+    next_channel += 1
+    channel = f'bench.{next_channel}'
+    client.send_json('', command='open', channel=channel, payload=payload, **kwargs)
+    msg = await next_msg(client, '')
+    assert msg['command'] == 'ready', msg
+    assert msg['channel'] == channel, msg
+    return channel
+
+
+async def close_channel(client: Client, channel: str) -> None:
+    client.send_json('', command='close', channel=channel)
+    while True:
+        msg = await next_msg(client, '')
+        if msg['channel'] == channel and msg['command'] == 'close':
+            break
+
+
+async def wait_close(client: Client, channel: str) -> None:
+    while True:
+        msg = await next_msg(client, '')
+        if msg['command'] == 'close':
+            assert msg['channel'] == channel, msg
+            assert 'problem' not in msg, msg
+            return
+
+
+def make_file(directory: Optional[str], size: int) -> IO[bytes]:
+    file = tempfile.NamedTemporaryFile(dir=directory)
+    block = os.urandom(1 << 20)
+    for _ in range(size):
+        file.write(block)
+    file.flush()
+    return file
+
+
+async def bench_echo(client: Client, args: argparse.Namespace) -> List[Result]:
+    """Round trips of small frames through an echo channel, with some in flight"""
+    channel = await open_channel(client, 'echo')
+    data = b'x' * args.frame_size
+    sent = received = 0
+
+    start = time.monotonic()
+    while received < args.count:
+        while sent < args.count and sent - received < args.window:
+            client.send_data(channel, data)
+            sent += 1
+        assert await client.next_frame() == (channel, data)
+        received += 1
+    elapsed = time.monotonic() - start
+
+    await close_channel(client, channel)
+    return [Result('echo', 'frames', args.count / elapsed, 'frames/s')]
+
+
+async def bench_fsread1(client: Client, args: argparse.Namespace) -> List[Result]:
+    """Reading a large file with flow control, answering pings as we go"""
+    with make_file(args.directory, args.size) as file:
+        start = time.monotonic()
+        client.send_json('', command='open', channel='read', payload='fsread1', path=file.name,
+                         binary='raw', flow_control=True, max_read_size=-1)
+        received = 0
+        while True:
+            channel, data = await client.next_frame()
+            if channel:
+                received += len(data)
+                continue
+            msg = json.loads(data)
+            if msg['command'] == 'ping':
+                client.send_json('', **dict(msg, command='pong'))
+            elif msg['command'] == 'close':
+                assert 'problem' not in msg, msg
+                break
+        elapsed = time.monotonic() - start
+
+    assert received == args.size << 20
+    return [Result('fsread1', 'throughput', received / elapsed / 1e6, 'MB/s')]
+
+
+async def bench_fsreplace1(client: Client, args: argparse.Namespace) -> List[Result]:
+    """Writing a large file, keeping a window of unacknowledged data in flight (like cockpit.js)
+
+    This is done once for each of the durability modes of the "sync" option.
+    """
+    block = os.urandom(64 * 1024)
+    total = args.size << 20
+    window = 16 * len(block)
+    results = []
+
+    for sync in ['data', 'full', 'none']:
+        with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+            start = time.monotonic()
+            channel = await open_channel(client, 'fsreplace1', path=f'{directory}/file', send_acks='bytes',
+                                         sync=sync)
+            sent = acked = 0
+            while acked < total:
+                while sent < total and sent - acked < window:
+                    client.send_data(channel, block)
+                    sent += len(block)
+                msg = await next_msg(client, '')
+                assert msg['command'] == 'ack', msg
+                acked += get_int(msg, 'bytes')
+            client.send_json('', command='done', channel=channel)
+            await wait_close(client, channel)
+            elapsed = time.monotonic() - start
+
+        # 'data' is the default, and keeps the name from before there was a choice
+        metric = 'throughput' if sync == 'data' else f'throughput-sync-{sync}'
+        results.append(Result('fsreplace1', metric, total / elapsed / 1e6, 'MB/s'))
+
+    return results
+
+
+async def bench_dbus(client: Client, args: argparse.Namespace) -> List[Result]:
+    """Property calls on the internal bus, one at a time"""
+    channel = await open_channel(client, 'dbus-json3', bus='internal')
+    latencies = []
+    for n in range(args.count // 10):
+        start = time.monotonic()
+        client.send_data(channel, json.dumps({
+            'call': ['/superuser', 'org.freedesktop.DBus.Properties', 'GetAll', ['cockpit.Superuser']],
+            'id': str(n),
+        }).encode())
+        reply = await next_msg(client, channel)
+        latencies.append(time.monotonic() - start)
+        assert reply['id'] == str(n), reply
+
+    await close_channel(client, channel)
+    quantiles = statistics.quantiles(latencies, n=100)
+    return [
+        Result('dbus-json3', 'p50', quantiles[49] * 1000, 'ms', lower_is_better=True),
+        Result('dbus-json3', 'p99', quantiles[98] * 1000, 'ms', lower_is_better=True),
+    ]
+
+
+async def bench_metrics1(client: Client, args: argparse.Namespace) -> List[Result]:
+    """CPU time (of the whole process) per sample for a typical set of internal metrics"""
+    channel = await open_channel(client, 'metrics1', source='internal', interval=1,
+                                 metrics=[{'name': name} for name in METRICS])
+    n_samples = args.count // 1000
+    samples = 0
+
+    start = time.process_time()
+    while samples < n_samples:
+        received, data = await client.next_frame()
+        assert received == channel
+        if data.startswith(b'['):  # not meta
+            samples += 1
+    elapsed = time.process_time() - start
+
+    await close_channel(client, channel)
+    return [Result('metrics1', 'sample', elapsed / n_samples * 1000, 'ms', lower_is_better=True)]
+
+
+async def bench_churn(client: Client, args: argparse.Namespace) -> List[Result]:
+    """Opening a channel, waiting for it to be ready, and closing it again"""
+    n_channels = args.count // 10
+
+    start = time.monotonic()
+    for _ in range(n_channels):
+        channel = await open_channel(client, 'null')
+        await close_channel(client, channel)
+    elapsed = time.monotonic() - start
+
+    return [Result('churn', 'channels', n_channels / elapsed, 'channels/s')]
+
+
+CASES: Dict[str, Callable[[Client, argparse.Namespace], Awaitable[List[Result]]]] = {
+    'echo': bench_echo,
+    'fsread1': bench_fsread1,
+    'fsreplace1': bench_fsreplace1,
+    'dbus-json3': bench_dbus,
+    'metrics1': bench_metrics1,
+    'churn': bench_churn,
+}
+
+
+def new_bridge() -> Bridge:
+    return Bridge(argparse.Namespace(privileged=False, beipack=False))
+
+
+async def run_mock(args: argparse.Namespace) -> List[Result]:
+    bridge = new_bridge()
+    transport = MockTransport(bridge)
+    transport.init()
+
+    results = []
+    for case in args.cases:
+        results.extend(await CASES[case](transport, args))
+
+    await transport.stop()
+    return results
+
+
+async def run_pipe(args: argparse.Namespace) -> List[Result]:
+    loop = asyncio.get_running_loop()
+    client_in, bridge_out = os.pipe()
+    bridge_in, client_out = os.pipe()
+
+    bridge = new_bridge()
+    client = PipeClient()
+    StdioTransport(loop, bridge, stdin=bridge_in, stdout=bridge_out)
+    StdioTransport(loop, client, stdin=client_in, stdout=client_out)
+    assert (await next_msg(client, ''))['command'] == 'init'
+    client.send_json('', command='init', version=1, host='localhost')
+
+    results = []
+    for case in args.cases:
+        results.extend(await CASES[case](client, args))
+
+    bridge.close()
+    client.close()
+    await asyncio.sleep(0.1)
+    for fd in (client_in, bridge_out, bridge_in, client_out):
+        os.close(fd)
+    return results
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], text=True,
+                                       cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[JsonObject], filename: str) -> None:
+    with open(filename) as file:
+        baseline = {(r['case'], r['transport'], r['metric']): r['value'] for r in json.load(file)['results']}
+
+    for result in results:
+        old = baseline.get((result['case'], result['transport'], result['metric']))
+        if not isinstance(old, (int, float)) or not old:
+            continue
+        value = result['value']
+        assert isinstance(value, (int, float))
+        change = (value - old) / old * 100
+        better = change < 0 if result['lower-is-better'] else change > 0
+        print(f"{result['case']:>10} {result['transport']:>4} {result['metric']:>10}: "
+              f"{old:10.2f} → {value:10.2f} {result['unit']:<10} {change:+6.1f}% {'better' if better else 'worse'}")
+
+
+async def run(args: argparse.Namespace) -> None:
+    results: List[JsonObject] = []
+    for transport in args.transports:
+        for result in await (run_mock(args) if transport == 'mock' else run_pipe(args)):
+            print(f'{result.case:>10} {transport:>4} {result.metric:>10}: {result.value:10.2f} {result.unit}')
+            results.append(result.to_json(transport))
+
+    if args.compare:
+        print()
+        compare(results, args.compare)
+
+    if args.json:
+        output = {
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options': {key: getattr(args, key) for key in ['count', 'frame_size', 'size', 'window']},
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(output, sys.stdout, indent=2)
+        else:
+            with open(args.json, 'w') as file:
+                json.dump(output, file, indent=2)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the bridge through the Cockpit protocol')
+    parser.add_argument('--transport', dest='transports', action='append', choices=['mock', 'pipe'],
+                        help='Transport to use, can be given more than once (default: both)')
+    parser.add_argument('--count', type=int, default=100000, help='Frames for echo; a tenth of that many D-Bus '
+                        'calls and channels for churn, a thousandth of that many metrics samples (default: 100000)')
+    parser.add_argument('--frame-size', type=int, default=100, help='Bytes per echo frame (default: 100)')
+    parser.add_argument('--window', type=int, default=64, help='Echo frames in flight (default: 64)')
+    parser.add_argument('--size', type=int, default=256, help='MiB to read and write (default: 256)')
+    parser.add_argument('--directory', help='Where to create test files (default: $TMPDIR)')
+    parser.add_argument('--json', metavar='FILE', help='Write the results as JSON ("-" for stdout)')
+    parser.add_argument('--compare', metavar='FILE', help='Compare with results from an earlier --json run')
+    parser.add_argument('cases', nargs='*', metavar='CASE', help=f'Cases to run: {", ".join(CASES)} (default: all)')
+    args = parser.parse_args()
+    if unknown := set(args.cases) - set(CASES):
+        parser.error(f'unknown cases: {", ".join(sorted(unknown))}')
+    args.transports = args.transports or ['mock', 'pipe']
+    args.cases = args.cases or list(CASES)
+    run_async(run(args))
+
+
+if __name__ == '__main__':
+    main()
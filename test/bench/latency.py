@@ -0,0 +1,134 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Measure D-Bus reply latency while a large fsread1 is running.
+
+A Bridge talks to a client over a pair of pipes, just like on its
+stdin/stdout.  The client makes a steady stream of calls on the internal bus
+and measures how long it takes to get the replies: first on an idle bridge,
+and then while a flow-controlled fsread1 of a large file is in progress.  Run
+from the top-level source directory:
+
+    PYTHONPATH=src python3 -m test.bench.latency
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from cockpit._vendor.systemd_ctypes import run_async
+from cockpit.bridge import Bridge
+from cockpit.jsonutil import JsonObject
+from cockpit.protocol import CockpitProtocol
+from cockpit.transports import StdioTransport
+
+
+class Client(CockpitProtocol):
+    def __init__(self) -> None:
+        self.ready = asyncio.get_running_loop().create_future()
+        self.calls: 'dict[str, asyncio.Future[None]]' = {}
+        self.read_done: 'asyncio.Future[JsonObject] | None' = None
+        self.next_id = 0
+
+    def transport_control_received(self, command: str, message: JsonObject) -> None:
+        assert command == 'init'
+        self.write_control(command='init', version=1, host='localhost')
+        self.write_control(command='open', channel='bus', payload='dbus-json3', bus='internal')
+
+    def channel_control_received(self, channel: str, command: str, message: JsonObject) -> None:
+        if command == 'ready' and channel == 'bus':
+            self.ready.set_result(None)
+        elif command == 'ping':
+            self.write_control(message, command='pong')
+        elif command == 'close' and channel == 'read':
+            assert self.read_done is not None
+            self.read_done.set_result(message)
+
+    def channel_data_received(self, channel: str, data: bytes) -> None:
+        if channel == 'bus':
+            reply = json.loads(data)
+            if 'id' in reply:
+                self.calls.pop(reply['id']).set_result(None)
+
+    async def call(self) -> float:
+        self.next_id += 1
+        tag = str(self.next_id)
+        future = self.calls[tag] = asyncio.get_running_loop().create_future()
+        start = time.monotonic()
+        self.write_channel_data('bus', json.dumps({
+            'call': ['/superuser', 'org.freedesktop.DBus.Properties', 'GetAll', ['cockpit.Superuser']],
+            'id': tag,
+        }).encode())
+        await future
+        return time.monotonic() - start
+
+    def start_read(self, path: str) -> 'asyncio.Future[JsonObject]':
+        self.read_done = asyncio.get_running_loop().create_future()
+        self.write_control(command='open', channel='read', payload='fsread1', path=path,
+                           binary='raw', flow_control=True, max_read_size=-1)
+        return self.read_done
+
+
+async def measure(client: Client, count: int, interval: float) -> 'list[float]':
+    latencies = []
+    for _ in range(count):
+        latencies.append(await client.call())
+        await asyncio.sleep(interval)
+    return latencies
+
+
+def report(name: str, latencies: 'list[float]') -> None:
+    ms = sorted(latency * 1000 for latency in latencies)
+    quantiles = statistics.quantiles(ms, n=100)
+    print(f'{name:>8}: {len(ms)} calls  p50 {quantiles[49]:7.2f}ms  p90 {quantiles[89]:7.2f}ms  '
+          f'p99 {quantiles[98]:7.2f}ms  max {ms[-1]:7.2f}ms')
+
+
+async def run(args: argparse.Namespace) -> None:
+    loop = asyncio.get_running_loop()
+    client_in, bridge_out = os.pipe()
+    bridge_in, client_out = os.pipe()
+
+    bridge = Bridge(argparse.Namespace(privileged=False, beipack=False))
+    client = Client()
+    StdioTransport(loop, bridge, stdin=bridge_in, stdout=bridge_out)
+    StdioTransport(loop, client, stdin=client_in, stdout=client_out)
+    await client.ready
+
+    with tempfile.NamedTemporaryFile(dir=args.directory) as file:
+        file.truncate(args.size << 20)
+
+        report('idle', await measure(client, args.count, args.interval))
+
+        read_done = client.start_read(file.name)
+        latencies = []
+        while not read_done.done():
+            latencies.append(await client.call())
+            await asyncio.sleep(args.interval)
+        close = await read_done
+        assert 'problem' not in close, close
+        report('fsread1', latencies)
+
+    bridge.close()
+    client.close()
+    await asyncio.sleep(0.1)
+    for fd in (client_in, bridge_out, bridge_in, client_out):
+        os.close(fd)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark D-Bus reply latency during a large fsread1')
+    parser.add_argument('--size', type=int, default=1024, help='MiB to read (default: 1024)')
+    parser.add_argument('--count', type=int, default=200, help='Calls on the idle bridge (default: 200)')
+    parser.add_argument('--interval', type=float, default=0.005, help='Seconds between calls (default: 0.005)')
+    parser.add_argument('--directory', help='Where to create the test file (default: $TMPDIR)')
+    run_async(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
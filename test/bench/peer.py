@@ -0,0 +1,124 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Measure fsread1 throughput directly and relayed through a peer bridge.
+
+The peer is a second `cockpit.bridge --privileged`, spawned without sudo,
+which is the same setup as the superuser bridge minus the authentication.
+Channels which request `superuser: "require"` get routed to it.  Run from the
+top-level source directory:
+
+    PYTHONPATH=src python3 -m test.bench.peer
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from cockpit.channel import ChannelRoutingRule
+from cockpit.channels.filesystem import FsReadChannel
+from cockpit.jsonutil import JsonObject
+from cockpit.packages import BridgeConfig
+from cockpit.peer import PeerRoutingRule
+from cockpit.protocol import CockpitProtocol
+from cockpit.router import Router
+from cockpit.transports import StdioTransport
+
+PEER_CONFIG = BridgeConfig({
+    "spawn": [sys.executable, "-m", "cockpit.bridge", "--privileged"],
+    "environ": ['PYTHONPATH=' + ':'.join(sys.path)],
+    "match": {"superuser": "require"},
+})
+
+
+class RelayRouter(Router):
+    def __init__(self) -> None:
+        self.peer_rule = PeerRoutingRule(self, PEER_CONFIG)
+        super().__init__([self.peer_rule, ChannelRoutingRule(self, [FsReadChannel])])
+
+    def do_send_init(self) -> None:
+        self.write_control(command='init', version=1)
+
+
+class Client(CockpitProtocol):
+    def __init__(self) -> None:
+        self.ready = asyncio.get_running_loop().create_future()
+        self.done: 'asyncio.Future[JsonObject] | None' = None
+        self.received = 0
+        self.next_channel = 0
+
+    def transport_control_received(self, command: str, message: JsonObject) -> None:
+        assert command == 'init'
+        self.write_control(command='init', version=1, host='localhost')
+        self.ready.set_result(None)
+
+    def channel_control_received(self, channel: str, command: str, message: JsonObject) -> None:
+        if command == 'ping':
+            self.write_control(message, command='pong')
+        elif command == 'close':
+            assert self.done is not None
+            self.done.set_result(message)
+
+    def channel_data_received(self, channel: str, data: bytes) -> None:
+        self.received += len(data)
+
+    async def read(self, path: str, **kwargs: 'str | int') -> int:
+        self.next_channel += 1
+        self.received = 0
+        self.done = asyncio.get_running_loop().create_future()
+        self.write_control({'max_read_size': -1, **kwargs}, command='open', channel=str(self.next_channel),
+                           payload='fsread1', path=path, binary='raw', flow_control=True)
+        close = await self.done
+        assert 'problem' not in close, close
+        return self.received
+
+
+async def run(args: argparse.Namespace) -> None:
+    loop = asyncio.get_running_loop()
+    client_in, router_out = os.pipe()
+    router_in, client_out = os.pipe()
+
+    router = RelayRouter()
+    client = Client()
+    StdioTransport(loop, router, stdin=router_in, stdout=router_out)
+    StdioTransport(loop, client, stdin=client_in, stdout=client_out)
+    await client.ready
+
+    with tempfile.NamedTemporaryFile(dir=args.directory) as file:
+        block = os.urandom(1 << 20)
+        for _ in range(args.size):
+            file.write(block)
+        file.flush()
+
+        # warm up the page cache and the peer
+        await client.read(file.name)
+        await client.read(file.name, superuser='require')
+
+        for name, options in [('direct', {}), ('peer', {'superuser': 'require'})]:
+            start = time.monotonic()
+            received = await client.read(file.name, **options)
+            elapsed = time.monotonic() - start
+            assert received == args.size << 20
+            print(f'{name:>8}: {received / elapsed / 1e6:8.1f} MB/s')
+
+    router.peer_rule.shutdown()
+    router.close()
+    client.close()
+    await asyncio.sleep(0.1)
+    for fd in (client_in, router_out, router_in, client_out):
+        os.close(fd)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark fsread1 relayed through a peer bridge')
+    parser.add_argument('--size', type=int, default=512, help='MiB to read (default: 512)')
+    parser.add_argument('--directory', help='Where to create the test file (default: $TMPDIR)')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Measure the throughput of the frame parser in CockpitProtocol.
+
+Frames are written into a pipe from a thread and read by a StdioTransport
+on the other end.  Run from the top-level source directory:
+
+    PYTHONPATH=src python3 -m test.bench.protocol
+"""
+
+import argparse
+import asyncio
+import os
+import threading
+import time
+
+from cockpit.jsonutil import JsonObject
+from cockpit.protocol import CockpitProtocol
+from cockpit.transports import StdioTransport
+
+
+class CountingProtocol(CockpitProtocol):
+    def __init__(self) -> None:
+        self.frames = 0
+        self.bytes = 0
+        self.done = asyncio.get_running_loop().create_future()
+
+    def channel_data_received(self, channel: str, data: bytes) -> None:
+        self.frames += 1
+        self.bytes += len(data)
+
+    def channel_control_received(self, channel: str, command: str, message: JsonObject) -> None:
+        self.frames += 1
+
+    def transport_control_received(self, command: str, message: JsonObject) -> None:
+        self.frames += 1
+
+    def eof_received(self) -> bool:
+        self.done.set_result(None)
+        return False
+
+
+def make_frame(channel: str, data: bytes) -> bytes:
+    msg = channel.encode('ascii') + b'\n' + data
+    return str(len(msg)).encode('ascii') + b'\n' + msg
+
+
+def writer(fd: int, blob: bytes, count: int) -> None:
+    try:
+        for _ in range(count):
+            view = memoryview(blob)
+            while view:
+                view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+async def measure(frame: bytes, total_size: int) -> 'tuple[int, float]':
+    # batch the frames so that the writer isn't the bottleneck
+    batch = frame * max(1, (1 << 20) // len(frame))
+    count = max(1, total_size // len(batch))
+
+    loop = asyncio.get_running_loop()
+    protocol = CountingProtocol()
+    ours, theirs = os.pipe()
+    their_stdout, our_stdout = os.pipe()
+    thread = threading.Thread(target=writer, args=(theirs, batch, count))
+
+    start = time.monotonic()
+    StdioTransport(loop, protocol, stdin=ours, stdout=our_stdout)
+    thread.start()
+    await protocol.done
+    elapsed = time.monotonic() - start
+    thread.join()
+
+    for fd in (ours, their_stdout, our_stdout):
+        os.close(fd)
+
+    assert protocol.frames == count * (len(batch) // len(frame))
+    return protocol.frames, elapsed
+
+
+async def run(args: argparse.Namespace) -> None:
+    cases = {
+        'control': make_frame('', b'{"command": "ping", "channel": "1:2!3"}'),
+        'small': make_frame('1:2!3', b'x' * 100),
+        'block': make_frame('1:2!3', b'x' * 16 * 1024),
+        'large': make_frame('1:2!3', b'x' * 1024 * 1024),
+    }
+
+    for name, frame in cases.items():
+        frames, elapsed = await measure(frame, args.size << 20)
+        print(f'{name:>8}: {len(frame):8d} bytes/frame  '
+              f'{frames / elapsed:12.0f} frames/s  {frames * len(frame) / elapsed / 1e6:8.1f} MB/s')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the Cockpit frame protocol parser')
+    parser.add_argument('--size', type=int, default=256, help='MiB of frames to send per case (default: 256)')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
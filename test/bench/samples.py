@@ -0,0 +1,334 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Benchmarks for the metrics samplers.
+
+The samplers run in-process, without a bridge, against synthetic data which
+is generated to look like a large machine.  Each case measures the current
+implementation next to a straightforward reference version of how it used
+to work, on the same data.  Run from the top-level source directory:
+
+    PYTHONPATH=src python3 -m test.bench.samples
+"""
+
+import argparse
+import collections
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Dict, List, NamedTuple, Tuple, Type
+
+import cockpit.samples
+from cockpit.samples import (
+    MS_PER_JIFFY,
+    BlockSampler,
+    CGroupSampler,
+    CPUSampler,
+    DiskSampler,
+    MemorySampler,
+    MountSampler,
+    NetworkSampler,
+    Sampler,
+    Samples,
+    read_int_file,
+)
+
+
+class Result(NamedTuple):
+    case: str
+    variant: str
+    per_sample: float
+
+
+def measure(sample: Callable[[Samples], None], count: int) -> float:
+    """Milliseconds of CPU time per sample, after a first one for warming up"""
+    sample(collections.defaultdict(dict))
+    start = time.process_time()
+    for _ in range(count):
+        sample(collections.defaultdict(dict))
+    return (time.process_time() - start) / count * 1000
+
+
+def make_cgroup_tree(root: str, n_cgroups: int) -> None:
+    """Slices with services, each with a few scopes below, like on a container host"""
+    with open(f'{root}/cgroup.controllers', 'w') as file:
+        file.write('cpu io memory pids\n')
+
+    n = 0
+    while n < n_cgroups:
+        slice_path = f'{root}/machine-{n}.slice'
+        for depth in range(3):
+            path = f'{slice_path}/scope-{depth}.scope' if depth else slice_path
+            os.mkdir(path)
+            for filename, content in [
+                ('memory.current', '123456789'), ('memory.max', 'max'),
+                ('memory.swap.current', '0'), ('memory.swap.max', 'max'),
+                ('cpu.weight', '100'), ('cpu.stat', 'usage_usec 1234567\nuser_usec 1000000\nsystem_usec 234567'),
+            ]:
+                with open(f'{path}/{filename}', 'w') as file:
+                    file.write(f'{content}\n')
+            n += 1
+
+
+def fwalk_cgroups(samples: Samples) -> None:
+    # CGroupSampler before the CGroupIndex: walk the tree, and open every file, every time
+    cgroups_v2_path = f'{cockpit.samples.CGROUP_PATH}/'
+    for path, _, _, rootfd in os.fwalk(cgroups_v2_path):
+        cgroup = path.replace(cgroups_v2_path, '')
+
+        if not cgroup:
+            continue
+
+        samples['cgroup.memory.usage'][cgroup] = read_int_file(rootfd, 'memory.current', 0)
+        samples['cgroup.memory.limit'][cgroup] = read_int_file(rootfd, 'memory.max')
+        samples['cgroup.memory.sw-usage'][cgroup] = read_int_file(rootfd, 'memory.swap.current', 0)
+        samples['cgroup.memory.sw-limit'][cgroup] = read_int_file(rootfd, 'memory.swap.max')
+        samples['cgroup.cpu.shares'][cgroup] = read_int_file(rootfd, 'cpu.weight')
+        usage_usec = read_int_file(rootfd, 'cpu.stat', 0, key=b'usage_usec')
+        if usage_usec:
+            samples['cgroup.cpu.usage'][cgroup] = usage_usec / 1000
+
+
+def bench_cgroups(args: argparse.Namespace) -> List[Result]:
+    """CGroupSampler on a synthetic cgroup v2 tree"""
+    with tempfile.TemporaryDirectory(dir=args.directory) as root:
+        make_cgroup_tree(root, args.cgroups)
+        cockpit.samples.CGROUP_PATH = root
+
+        sampler = CGroupSampler()
+        try:
+            expected: Samples = collections.defaultdict(dict)
+            fwalk_cgroups(expected)
+            samples: Samples = collections.defaultdict(dict)
+            sampler.sample(samples)
+            assert samples == expected
+
+            return [
+                Result('cgroups', 'fwalk', measure(fwalk_cgroups, args.count)),
+                Result('cgroups', 'index', measure(sampler.sample, args.count)),
+            ]
+        finally:
+            sampler.close()
+
+
+def make_proc_tree(root: str, args: argparse.Namespace) -> None:
+    """The files in /proc read by the samplers, for a machine with lots of cores, disks and interfaces"""
+    with open(f'{root}/stat', 'w') as file:
+        file.write('cpu  123456789 1234 56789012 987654321 43210 0 12345 0 0 0\n')
+        for cpu in range(args.cpus):
+            file.write(f'cpu{cpu} {1234567 + cpu} 12 {567890 + cpu} 9876543 432 0 123 0 0 0\n')
+        file.write('intr 123456789 ' + ' '.join(str(n % 7) for n in range(1000)) + '\n')
+        file.write('ctxt 123456789\nbtime 1700000000\nprocesses 123456\nprocs_running 3\nprocs_blocked 0\n')
+        file.write('softirq 123456 1 2 3 4 5 6 7 8 9 10\n')
+
+    with open(f'{root}/meminfo', 'w') as file:
+        for key, value in [
+            ('MemTotal', 1056745472), ('MemFree', 123456789), ('MemAvailable', 876543210),
+            ('Buffers', 123456), ('Cached', 12345678), ('SwapCached', 0), ('Active', 3456789),
+            ('Inactive', 2345678), ('Active(anon)', 12345), ('Inactive(anon)', 234567), ('SwapTotal', 8388604),
+            ('SwapFree', 8388604), ('Dirty', 468), ('AnonPages', 228864), ('Mapped', 146648), ('Shmem', 9288),
+            ('Slab', 308448), ('KernelStack', 1136), ('PageTables', 2220), ('CommitLimit', 536761340),
+            ('Committed_AS', 1234567), ('VmallocTotal', 34359738367), ('HugePages_Total', 0),
+            ('Hugepagesize', 2048), ('DirectMap4k', 123456), ('DirectMap2M', 6168576),
+        ]:
+            unit = '' if key.startswith('HugePages_') else ' kB'
+            file.write(f'{key + ":":<16}{value:>12}{unit}\n')
+
+    with open(f'{root}/diskstats', 'w') as file:
+        def write_disk(major: int, minor: int, name: str, n: int) -> None:
+            file.write(f'{major:>4} {minor:>7} {name} {n} 12 {n * 100} 345 {n * 2} 23 {n * 300} 456 0 789 1234 '
+                       '0 0 0 0 12 34\n')
+
+        for disk in range(args.disks):
+            write_disk(259, disk * 4, f'nvme{disk}n1', disk)
+            for partition in range(1, 4):
+                write_disk(259, disk * 4 + partition, f'nvme{disk}n1p{partition}', disk + partition)
+        for disk in range(args.disks):
+            write_disk(253, disk, f'dm-{disk}', disk)
+        write_disk(9, 0, 'md0', 0)
+
+    os.mkdir(f'{root}/net')
+    with open(f'{root}/net/dev', 'w') as file:
+        file.write('Inter-|   Receive                                                |  Transmit\n')
+        file.write(' face |bytes    packets errs drop fifo frame compressed multicast|'
+                   'bytes    packets errs drop fifo colls carrier compressed\n')
+        for iface in ['lo', *(f'veth{n:x}' for n in range(args.interfaces))]:
+            file.write(f'{iface:>6}: {len(iface) * 1234567:>7} {1234:>7} 0 0 0 0 0 0 '
+                       f'{len(iface) * 7654321:>7} {4321:>7} 0 0 0 0 0 0\n')
+
+    with open(f'{root}/mounts', 'w') as file:
+        file.write('proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0\n')
+        file.write('sysfs /sys sysfs rw,nosuid,nodev,noexec,relatime 0 0\n')
+        for mount in range(args.mounts):
+            file.write(f'/dev/nvme{mount}n1p1 {root} xfs rw,relatime,attr2,inode64 0 0\n')
+            file.write(f'overlay /var/lib/containers/storage/overlay/{mount:064x}/merged overlay rw 0 0\n')
+
+
+# The samplers before the ProcFile: open the file in text mode, and split it line by line, every time
+
+def text_cpu(samples: Samples) -> None:
+    with open(f'{cockpit.samples.PROC_PATH}/stat') as stat:
+        for line in stat:
+            if not line.startswith('cpu'):
+                continue
+            cpu, user, nice, system, _idle, iowait = line.split()[:6]
+            core = cpu[3:] or None
+            if core:
+                prefix = 'cpu.core'
+                samples[f'{prefix}.nice'][core] = int(nice) * MS_PER_JIFFY
+                samples[f'{prefix}.user'][core] = int(user) * MS_PER_JIFFY
+                samples[f'{prefix}.system'][core] = int(system) * MS_PER_JIFFY
+                samples[f'{prefix}.iowait'][core] = int(iowait) * MS_PER_JIFFY
+            else:
+                prefix = 'cpu.basic'
+                samples[f'{prefix}.nice'] = int(nice) * MS_PER_JIFFY
+                samples[f'{prefix}.user'] = int(user) * MS_PER_JIFFY
+                samples[f'{prefix}.system'] = int(system) * MS_PER_JIFFY
+                samples[f'{prefix}.iowait'] = int(iowait) * MS_PER_JIFFY
+
+
+def text_memory(samples: Samples) -> None:
+    with open(f'{cockpit.samples.PROC_PATH}/meminfo') as meminfo:
+        items = {k: int(v.strip(' kB\n')) for line in meminfo for k, v in [line.split(':', 1)]}
+
+    samples['memory.free'] = 1024 * items['MemFree']
+    samples['memory.used'] = 1024 * (items['MemTotal'] - items['MemAvailable'])
+    samples['memory.cached'] = 1024 * (items['Buffers'] + items['Cached'])
+    samples['memory.swap-used'] = 1024 * (items['SwapTotal'] - items['SwapFree'])
+
+
+def text_disk(samples: Samples) -> None:
+    with open(f'{cockpit.samples.PROC_PATH}/diskstats') as diskstats:
+        all_read_bytes = 0
+        all_written_bytes = 0
+
+        for line in diskstats:
+            fields = line.strip().split()
+            dev_major = fields[0]
+            dev_name = fields[2]
+
+            if dev_major == '9' or dev_name.startswith('dm-'):
+                continue
+            if dev_name[:2] in ['sd', 'hd', 'vd'] and dev_name[-1].isdigit():
+                continue
+            if dev_name.startswith('nvme') and 'p' in dev_name:
+                continue
+
+            read_bytes = int(fields[5]) * 512
+            written_bytes = int(fields[9]) * 512
+            all_read_bytes += read_bytes
+            all_written_bytes += written_bytes
+            samples['disk.dev.read'][dev_name] = read_bytes
+            samples['disk.dev.written'][dev_name] = written_bytes
+
+        samples['disk.all.read'] = all_read_bytes
+        samples['disk.all.written'] = all_written_bytes
+
+
+def text_block(samples: Samples) -> None:
+    with open(f'{cockpit.samples.PROC_PATH}/diskstats') as diskstats:
+        for line in diskstats:
+            [_, _, dev_name, _, _, sectors_read, _, _, _, sectors_written, *_] = line.strip().split()
+            samples['block.device.read'][dev_name] = int(sectors_read) * 512
+            samples['block.device.written'][dev_name] = int(sectors_written) * 512
+
+
+def text_network(samples: Samples) -> None:
+    with open(f'{cockpit.samples.PROC_PATH}/net/dev') as network_samples:
+        for line in network_samples:
+            fields = line.split()
+            if fields[0][-1] != ':':
+                continue
+            iface = fields[0][:-1]
+            samples['network.interface.rx'][iface] = int(fields[1])
+            samples['network.interface.tx'][iface] = int(fields[9])
+
+
+def text_mount(samples: Samples) -> None:
+    with open(f'{cockpit.samples.PROC_PATH}/mounts') as mounts:
+        for line in mounts:
+            if line[0] != '/':
+                continue
+            fs_spec, fs_file, _fs_vfstype, fs_mntopts, *_rest = line.split()
+            if '/loop' in fs_spec and 'ro' in fs_mntopts.split(','):
+                continue
+            if 'revokefs-fuse' in fs_spec and 'flatpak' in fs_file:
+                continue
+            try:
+                res = os.statvfs(fs_file)
+            except OSError:
+                continue
+            frsize = res.f_frsize
+            total = frsize * res.f_blocks
+            samples['mount.total'][fs_file] = total
+            samples['mount.used'][fs_file] = total - frsize * res.f_bfree
+
+
+PROC_SAMPLERS: List[Tuple[str, Type[Sampler], Callable[[Samples], None]]] = [
+    ('cpu', CPUSampler, text_cpu),
+    ('memory', MemorySampler, text_memory),
+    ('disk', DiskSampler, text_disk),
+    ('block', BlockSampler, text_block),
+    ('network', NetworkSampler, text_network),
+    ('mount', MountSampler, text_mount),
+]
+
+
+def bench_procfs(args: argparse.Namespace) -> List[Result]:
+    """The samplers reading files in /proc, on synthetic copies of them"""
+    with tempfile.TemporaryDirectory(dir=args.directory) as root:
+        make_proc_tree(root, args)
+        cockpit.samples.PROC_PATH = root
+
+        results = []
+        for case, cls, reference in PROC_SAMPLERS:
+            sampler = cls()
+            try:
+                expected: Samples = collections.defaultdict(dict)
+                reference(expected)
+                samples: Samples = collections.defaultdict(dict)
+                sampler.sample(samples)
+                assert samples == expected, case
+
+                results.append(Result(case, 'text', measure(reference, args.count)))
+                results.append(Result(case, 'procfile', measure(sampler.sample, args.count)))
+            finally:
+                sampler.close()
+
+        return results
+
+
+CASES: Dict[str, Callable[[argparse.Namespace], List[Result]]] = {
+    'cgroups': bench_cgroups,
+    'procfs': bench_procfs,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the metrics samplers on synthetic data')
+    parser.add_argument('--count', type=int, default=100, help='Samples to take of each (default: 100)')
+    parser.add_argument('--cgroups', type=int, default=3000, help='Size of the cgroup tree (default: 3000)')
+    parser.add_argument('--cpus', type=int, default=256, help='CPU cores in /proc/stat (default: 256)')
+    parser.add_argument('--disks', type=int, default=64, help='Disks in /proc/diskstats (default: 64)')
+    parser.add_argument('--interfaces', type=int, default=64, help='Interfaces in /proc/net/dev (default: 64)')
+    parser.add_argument('--mounts', type=int, default=32, help='Disk mounts in /proc/mounts (default: 32)')
+    parser.add_argument('--directory', help='Where to create the synthetic files (default: $TMPDIR)')
+    parser.add_argument('--json', action='store_true', help='Write the results as JSON to stdout')
+    parser.add_argument('cases', nargs='*', metavar='CASE', help=f'Cases to run: {", ".join(CASES)} (default: all)')
+    args = parser.parse_args()
+    if unknown := set(args.cases) - set(CASES):
+        parser.error(f'unknown cases: {", ".join(sorted(unknown))}')
+
+    results = [result for case in args.cases or CASES for result in CASES[case](args)]
+    if args.json:
+        print(json.dumps([{'case': r.case, 'variant': r.variant, 'ms-per-sample': r.per_sample} for r in results],
+                         indent=2))
+    else:
+        for result in results:
+            print(f'{result.case:>10} {result.variant:>8}: {result.per_sample:8.3f} ms per sample')
+
+
+if __name__ == '__main__':
+    main()
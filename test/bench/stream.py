@@ -0,0 +1,103 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Measure the throughput of a subprocess stream channel through the Router.
+
+A Router serving 'stream' channels talks to a client over a pair of pipes,
+just like the bridge on its stdin/stdout.  The client opens a flow-controlled
+channel running `head -c SIZE /dev/zero` and answers the pings as it consumes
+the data.  Run from the top-level source directory:
+
+    PYTHONPATH=src python3 -m test.bench.stream
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+from cockpit.channel import ChannelRoutingRule
+from cockpit.channels.stream import SubprocessStreamChannel
+from cockpit.jsonutil import JsonObject
+from cockpit.protocol import CockpitProtocol
+from cockpit.router import Router
+from cockpit.transports import StdioTransport
+
+
+class StreamRouter(Router):
+    def __init__(self) -> None:
+        super().__init__([ChannelRoutingRule(self, [SubprocessStreamChannel])])
+        self.pauses = 0
+
+    def pause_writing(self) -> None:
+        self.pauses += 1
+        super().pause_writing()
+
+    def do_send_init(self) -> None:
+        self.write_control(command='init', version=1)
+
+
+class Client(CockpitProtocol):
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.received = 0
+        self.done = asyncio.get_running_loop().create_future()
+
+    def transport_control_received(self, command: str, message: JsonObject) -> None:
+        assert command == 'init'
+        self.write_control(command='init', version=1, host='localhost')
+        self.write_control(command='open', channel='1', payload='stream', binary='raw', flow_control=True,
+                           spawn=['head', '-c', str(self.size), '/dev/zero'])
+
+    def channel_control_received(self, channel: str, command: str, message: JsonObject) -> None:
+        if command == 'ping':
+            self.write_control(message, command='pong')
+        elif command == 'close':
+            self.done.set_result(message)
+
+    def channel_data_received(self, channel: str, data: bytes) -> None:
+        self.received += len(data)
+
+
+async def measure(size: int, limits: 'tuple[int, int] | None') -> 'tuple[float, int]':
+    loop = asyncio.get_running_loop()
+    client_in, router_out = os.pipe()
+    router_in, client_out = os.pipe()
+
+    router = StreamRouter()
+    client = Client(size)
+
+    start = time.monotonic()
+    router_transport = StdioTransport(loop, router, stdin=router_in, stdout=router_out, write_buffer_limits=limits)
+    StdioTransport(loop, client, stdin=client_in, stdout=client_out)
+    close = await client.done
+    elapsed = time.monotonic() - start
+    assert close.get('exit-status') == 0, close
+    assert client.received == size
+
+    router_transport.close()
+    client.close()
+    await asyncio.sleep(0.1)
+    for fd in (client_in, router_out, router_in, client_out):
+        os.close(fd)
+
+    return elapsed, router.pauses
+
+
+async def run(args: argparse.Namespace) -> None:
+    size = args.size << 20
+    for limits in [(0, 0), (64 * 1024, 16 * 1024), None]:
+        elapsed, pauses = await measure(size, limits)
+        high, low = limits or (StdioTransport.WRITE_BUFFER_HIGH, StdioTransport.WRITE_BUFFER_HIGH // 4)
+        print(f'high={high:8d} low={low:8d}: {size / elapsed / 1e6:8.1f} MB/s, {pauses} pauses')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark a stream channel through the router')
+    parser.add_argument('--size', type=int, default=1024, help='MiB of output to stream (default: 1024)')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -32,8 +32,9 @@ class MockPeer(Router):
         if command == 'open':
             self.write_control(command='ready', channel=channel)
 
-    def channel_data_received(self, channel, data):
-        pass
+    def channel_frame_received(self, channel, frame):
+        # echo the data back, as-is
+        self.write_frame(channel, frame)
 
 
 async def run():
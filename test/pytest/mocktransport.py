@@ -12,6 +12,7 @@ class MockTransport(asyncio.Transport):
     queue: 'asyncio.Queue[Tuple[str, bytes]]'
     next_id: int = 0
     close_future: Optional[asyncio.Future] = None
+    reading_paused: bool = False
 
     async def assert_empty(self):
         await asyncio.sleep(0.1)
@@ -25,7 +26,17 @@ class MockTransport(asyncio.Transport):
     def send_data(self, channel: str, data: bytes) -> None:
         msg = channel.encode('ascii') + b'\n' + data
         msg = str(len(msg)).encode('ascii') + b'\n' + msg
-        self.protocol.data_received(msg)
+        if isinstance(self.protocol, asyncio.BufferedProtocol):
+            # Feed it the way our real transports do, in as many reads as it takes
+            view = memoryview(msg)
+            while view:
+                buffer = memoryview(self.protocol.get_buffer(len(view)))
+                n = min(len(buffer), len(view))
+                buffer[:n] = view[:n]
+                self.protocol.buffer_updated(n)
+                view = view[n:]
+        else:
+            self.protocol.data_received(msg)
 
     def send_init(self, version: int = 1, host:  str = MOCK_HOSTNAME, **kwargs: JsonValue) -> None:
         self.send_json('', command='init', version=version, host=host, **kwargs)
@@ -81,7 +92,7 @@ class MockTransport(asyncio.Transport):
     def send_ping(self, **kwargs: JsonValue):
         self.send_json('', command='ping', **kwargs)
 
-    def __init__(self, protocol: asyncio.Protocol):
+    def __init__(self, protocol: 'asyncio.Protocol | asyncio.BufferedProtocol'):
         self.queue = asyncio.Queue()
         self.protocol = protocol
         protocol.connection_made(self)
@@ -92,6 +103,15 @@ class MockTransport(asyncio.Transport):
         _, channel, data = data.split(b'\n', 2)
         self.queue.put_nowait((channel.decode('ascii'), data))
 
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def pause_reading(self) -> None:
+        self.reading_paused = True
+
+    def resume_reading(self) -> None:
+        self.reading_paused = False
+
     async def stop(self) -> None:
         keep_open = self.protocol.eof_received()
         if keep_open:
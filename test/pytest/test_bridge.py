@@ -2,19 +2,23 @@ import argparse
 import asyncio
 import contextlib
 import errno
+import functools
 import getpass
 import grp
 import json
 import os
 import pwd
 import shlex
+import shutil
 import stat
 import subprocess
 import sys
+import threading
+import time
 import unittest.mock
 from collections import deque
 from pathlib import Path
-from typing import AsyncGenerator, Dict, Generator, Iterator, Sequence, Union
+from typing import Any, AsyncGenerator, Dict, Generator, Iterator, List, Sequence, Set, Union
 
 import pytest
 import pytest_asyncio
@@ -22,10 +26,14 @@ import pytest_asyncio
 from cockpit._vendor.systemd_ctypes import bus
 from cockpit.bridge import Bridge
 from cockpit.channel import AsyncChannel, Channel, ChannelRoutingRule
-from cockpit.channels import CHANNEL_TYPES
-from cockpit.channels.filesystem import tag_from_path
+from cockpit.channels import CHANNEL_TYPES, filesystem
+from cockpit.channels.filesystem import FsDuChannel, FsInfoChannel, FsReplaceChannel, tag_from_path
 from cockpit.jsonutil import JsonDict, JsonObject, JsonValue, get_bool, get_dict, get_int, get_str, json_merge_patch
 from cockpit.packages import BridgeConfig
+from cockpit.pathwatches import path_watches
+from cockpit.samplerhub import sampler_hub
+from cockpit.samples import MemorySampler, Samples
+from cockpit.stats import Stats
 
 from .mocktransport import MOCK_HOSTNAME, MockTransport
 
@@ -420,12 +428,182 @@ async def test_internal_metrics(transport: MockTransport) -> None:
     # memory.used should be an integer
     assert isinstance(data[0][1], int)
 
+    # the ticks after the first sample are aligned to the interval, which needs new meta
+    _, data = await transport.next_frame()
+    meta = json.loads(data)
+    assert meta['timestamp'] == pytest.approx(round(meta['timestamp'] / interval) * interval, abs=0.01)
+
     # next data for rate should not be False
     _, data = await transport.next_frame()
     data = json.loads(data)
     assert all(d is not False for d in data[0][0])
 
 
+@pytest.mark.asyncio
+async def test_internal_metrics_bridge(transport: MockTransport) -> None:
+    metrics = [
+        {"name": "bridge.channels"},
+        {"name": "bridge.bytes.in", "derive": "rate"},
+        {"name": "bridge.queued.out"},
+    ]
+    ch = await transport.check_open('metrics1', source='internal', interval=100, metrics=metrics)
+    _, data = await transport.next_frame()
+    meta = json.loads(data)
+    assert meta['metrics'][0]['name'] == 'bridge.channels'
+    assert 'metrics1' in meta['metrics'][0]['instances']
+
+    _, data = await transport.next_frame()
+    (channels, bytes_in, queued_out), = json.loads(data)
+    assert channels[meta['metrics'][0]['instances'].index('metrics1')] == 1
+    assert all(rate is False for rate in bytes_in)
+    assert isinstance(queued_out, int)
+
+    transport.send_close(ch)
+
+
+@pytest.mark.asyncio
+async def test_internal_metrics_shared(transport: MockTransport, monkeypatch: pytest.MonkeyPatch) -> None:
+    n_samples = 0
+
+    def sample(self: MemorySampler, samples: Samples) -> None:
+        nonlocal n_samples
+        n_samples += 1
+        samples['memory.used'] = n_samples
+
+    monkeypatch.setattr(MemorySampler, 'sample', sample)
+    n_samplers = sampler_hub.get_n_samplers()
+
+    metrics = [{'name': 'memory.used'}]
+    ch1 = transport.send_open('metrics1', source='internal', interval=100, metrics=metrics)
+    ch2 = transport.send_open('metrics1', source='internal', interval=100, metrics=metrics)
+
+    # frames of the two channels can come in any order
+    values: Dict[str, List[int]] = {ch1: [], ch2: []}
+    closed: Set[str] = set()
+    while len(closed) < 2:
+        channel, data = await transport.next_frame()
+        msg = json.loads(data)
+        if channel and isinstance(msg, list):
+            (value,), = msg
+            values[channel].append(value)
+        elif msg.get('command') == 'close':
+            closed.add(msg['channel'])
+
+        if len(values[ch2]) == 4 and not closed:
+            # one MemorySampler for both channels...
+            assert sampler_hub.get_n_samplers() == n_samplers + 1
+            transport.send_close(ch1)
+            transport.send_close(ch2)
+
+    # ...sampled on its own for the first sample of each, then once per tick for both
+    assert values[ch1][0] != values[ch2][0]
+    assert values[ch2][0] not in values[ch1]
+    assert values[ch2][1:4] == list(range(values[ch2][1], values[ch2][1] + 3))
+    assert set(values[ch2][1:]) <= set(values[ch1])
+    assert sampler_hub.get_n_samplers() == n_samplers
+
+
+@pytest.mark.asyncio
+async def test_internal_metrics_schedule(transport: MockTransport, monkeypatch: pytest.MonkeyPatch) -> None:
+    slow = False
+
+    def sample(self: MemorySampler, samples: Samples) -> None:
+        nonlocal slow
+        if slow:
+            slow = False
+            time.sleep(0.25)
+        samples['memory.used'] = 0
+
+    monkeypatch.setattr(MemorySampler, 'sample', sample)
+    n_missed = sampler_hub.get_n_missed()
+
+    ch = await transport.check_open('metrics1', source='internal', interval=100, metrics=[{'name': 'memory.used'}])
+
+    # the first sample is taken right away, then the ticks are on multiples of the interval
+    assert 'timestamp' in await transport.next_msg(ch)
+    assert await transport.next_msg(ch) == [[0]]
+    meta = await transport.next_msg(ch)
+    assert meta['timestamp'] == pytest.approx(round(meta['timestamp'] / 100) * 100, abs=0.01)
+    assert 'skipped' not in meta
+    assert await transport.next_msg(ch) == [[0]]
+    assert await transport.next_msg(ch) == [[0]]
+
+    # falling behind skips ticks, and sends new meta for the one which comes after
+    slow = True
+    while (meta := await transport.next_msg(ch)) == [[0]]:
+        pass
+    assert meta['skipped'] >= 2
+    assert sampler_hub.get_n_missed() >= n_missed + meta['skipped']
+    assert await transport.next_msg(ch) == [[0]]
+    assert sampler_hub.get_timings()['MemorySampler']['max'] >= 250
+
+    await transport.check_close(ch)
+
+
+@pytest.mark.asyncio
+async def test_stats(bridge: Bridge, transport: MockTransport) -> None:
+    echo = await transport.check_open('echo')
+    for _ in range(3):
+        transport.send_data(echo, b'x' * 100)
+        await transport.assert_data(echo, b'x' * 100)
+
+    await transport.check_open('nonexistent', problem='not-supported')
+
+    (values,) = await transport.check_bus_call('/stats', 'org.freedesktop.DBus.Properties', 'GetAll',
+                                               ['cockpit.Stats'])
+    assert values['Payloads']['v']['echo'] == {
+        'channels': 1, 'opened': 1, 'closed': 0, 'rejected': 0,
+        'frames-in': 3, 'bytes-in': 300, 'frames-out': 3, 'bytes-out': 300
+    }
+    assert values['Payloads']['v']['nonexistent']['rejected'] == 1
+    assert values['Payloads']['v']['dbus-json3']['channels'] == 1
+    assert values['Channels']['v'][echo]['v']['payload'] == {'t': 's', 'v': 'echo'}
+    assert values['Channels']['v'][echo]['v']['send-window'] == {'t': 't', 'v': Channel.SEND_WINDOW}
+    assert sum(values['ReadyLatency']['v']['echo']) == 1
+    assert len(values['ReadyLatency']['v']['echo']) == len(values['ReadyLatencyBuckets']['v']) + 1
+    assert values['QueuedBytes']['v'] == 0
+    assert values['InputPaused']['v'] is False
+    assert values['PathWatches']['v'] == path_watches.get_n_watches()
+    assert values['PathWatchListeners']['v'] == path_watches.get_n_listeners()
+    assert values['SamplerTimings']['v'] == sampler_hub.get_timings()
+    assert values['SamplerMissedTicks']['v'] == sampler_hub.get_n_missed()
+
+    transport.send_done(echo)
+    await transport.assert_msg('', command='done', channel=echo)
+    await transport.assert_msg('', command='close', channel=echo)
+
+    assert bridge.stats.get_payloads()['echo'] == {
+        'channels': 0, 'opened': 1, 'closed': 1, 'rejected': 0,
+        'frames-in': 3, 'bytes-in': 300, 'frames-out': 3, 'bytes-out': 300
+    }
+    assert echo not in bridge.stats.get_channels()
+
+
+@pytest.mark.asyncio
+async def test_stats_loop_lag(bridge: Bridge, transport: MockTransport, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Stats, 'LOOP_LAG_INTERVAL', 0.01)
+    monkeypatch.setattr(Stats, 'LOOP_LAG_POLL_TIMEOUT', 0.1)
+
+    # The bridge is connected (to the transport), but nobody is interested
+    assert bridge.stats._lag_timer is None
+
+    bridge.stats.add_lag_reader()
+    assert bridge.stats._lag_timer is not None
+    time.sleep(0.05)  # block the main loop
+    await asyncio.sleep(0.02)
+    assert bridge.stats.loop_lag_max >= 0.03
+    bridge.stats.remove_lag_reader()
+    assert bridge.stats._lag_timer is None
+
+    # Polling keeps the timer running for a while
+    bridge.stats.poll_loop_lag()
+    assert bridge.stats._lag_timer is not None
+    await asyncio.sleep(0.05)
+    assert bridge.stats._lag_timer is not None
+    await asyncio.sleep(0.2)
+    assert bridge.stats._lag_timer is None
+
+
 @pytest.mark.asyncio
 async def test_fsread1_errors(transport: MockTransport, tmp_path: Path) -> None:
     if os.geteuid() != 0:
@@ -475,6 +653,126 @@ async def test_fsread1_size_hint_absent_char_device(transport: MockTransport) ->
     await transport.check_open('fsread1', path='/dev/null', binary='raw', absent_keys=['size-hint'])
 
 
+async def read_fsread1(transport: MockTransport, **kwargs: Any) -> 'tuple[list[bytes], JsonObject]':
+    ch = await transport.check_open('fsread1', **kwargs)
+    frames = []
+    while True:
+        channel, data = await transport.next_frame()
+        if channel == ch:
+            frames.append(data)
+        elif json.loads(data)['command'] == 'close':
+            return frames, json.loads(data)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('size', [100, 100000])  # one block, and several
+async def test_fsread1_text(transport: MockTransport, tmp_path: Path, size: int) -> None:
+    # multi-byte characters split across blocks, NULs and invalid UTF-8
+    line = 'x' * 999 + 'ö\n'
+    content = (line * (size // len(line) + 1)).encode()[:size]
+    content = content[:50] + b'\0\0' + content[50:90] + b'\xff\xfe' + content[90:]
+    myfile = tmp_path / 'myfile'
+    myfile.write_bytes(content)
+    expected = content.replace(b'\0', b'').decode(errors='ignore').encode()
+
+    frames, close = await read_fsread1(transport, path=str(myfile), block_size=4096)
+    assert b''.join(frames) == expected
+    assert all(len(frame) <= 4096 for frame in frames)
+    for frame in frames:
+        frame.decode()  # each frame is valid on its own
+    assert close['tag'] == tag_from_path(myfile)
+
+    # binary is sent as-is
+    frames, close = await read_fsread1(transport, path=str(myfile), block_size=4096, binary='raw')
+    assert b''.join(frames) == content
+    assert all(len(frame) <= 4096 for frame in frames)
+
+
+@pytest.mark.asyncio
+async def test_fsread1_block_size(transport: MockTransport, tmp_path: Path) -> None:
+    myfile = tmp_path / 'myfile'
+    myfile.write_bytes(b'x' * 1000000)
+
+    frames, _ = await read_fsread1(transport, path=str(myfile), binary='raw')
+    assert {len(frame) for frame in frames[:-1]} == {Channel.BLOCK_SIZE}
+    frames, _ = await read_fsread1(transport, path=str(myfile), binary='raw', block_size=256 * 1024)
+    assert [len(frame) for frame in frames] == [256 * 1024] * 3 + [1000000 - 3 * 256 * 1024]
+
+    await transport.check_open('fsread1', path=str(myfile), block_size=100, problem='protocol-error')
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('size', [1000, 100000])  # one block, and several
+async def test_fsread1_range(transport: MockTransport, tmp_path: Path, size: int) -> None:
+    content = b''.join(b'line %d\n' % i for i in range(size))[:size]
+    myfile = tmp_path / 'myfile'
+    myfile.write_bytes(content)
+    tag = tag_from_path(myfile)
+
+    async def read(**kwargs: JsonValue) -> bytes:
+        frames, close = await read_fsread1(transport, path=str(myfile), binary='raw', **kwargs)
+        assert close['tag'] == tag
+        return b''.join(frames)
+
+    assert await read(offset=100) == content[100:]
+    assert await read(offset=100, length=50) == content[100:150]
+    assert await read(length=size * 2) == content
+    assert await read(offset=size) == b''
+    assert await read(offset=size * 2, length=10) == b''
+    # the limit applies to the range, not the file
+    assert await read(offset=size - 100, max_read_size=100) == content[-100:]
+    await transport.check_open('fsread1', path=str(myfile), length=101, max_read_size=100, problem='too-large')
+
+    # tail starts at the first complete line
+    frames, close = await read_fsread1(transport, path=str(myfile), tail=100)
+    start = content.index(b'\n', size - 101) + 1
+    assert b''.join(frames) == content[start:]
+    assert close['offset'] == start
+    assert close['tag'] == tag
+    # ...unless we're already at the start of one, or there's none
+    frames, close = await read_fsread1(transport, path=str(myfile), tail=size - start)
+    assert b''.join(frames) == content[start:]
+    frames, close = await read_fsread1(transport, path=str(myfile), tail=size * 2)
+    assert b''.join(frames) == content
+    assert close['offset'] == 0
+    myfile.write_bytes(b'x' * size)
+    frames, close = await read_fsread1(transport, path=str(myfile), tail=10)
+    assert b''.join(frames) == b'x' * 10
+
+    bad_options: 'list[dict[str, Any]]' = [
+        {'offset': -1}, {'length': -1}, {'tail': -1}, {'tail': 10, 'offset': 10}, {'tail': 10, 'length': 10}
+    ]
+    for bad in bad_options:
+        await transport.check_open('fsread1', path=str(myfile), **bad, problem='protocol-error')
+    await transport.check_open('fsread1', path='/dev/null', tail=10, problem='not-supported')
+
+
+@pytest.mark.asyncio
+async def test_fsread1_if_tag(transport: MockTransport, tmp_path: Path) -> None:
+    myfile = tmp_path / 'myfile'
+
+    async def check_not_modified(tag: str) -> None:
+        # closes without reading (or even getting ready)
+        ch = transport.send_open('fsread1', path=str(myfile), if_tag=tag)
+        await transport.assert_msg('', command='done', channel=ch)
+        await transport.assert_msg('', command='close', channel=ch, tag=tag, not_modified=True)
+
+    await check_not_modified('-')
+
+    myfile.write_text('content')
+    frames, close = await read_fsread1(transport, path=str(myfile), if_tag='-')
+    assert frames == [b'content']
+    assert 'not-modified' not in close
+    tag = get_str(close, 'tag')
+    await check_not_modified(tag)
+
+    myfile.write_text('changed content')
+    frames, close = await read_fsread1(transport, path=str(myfile), if_tag=tag)
+    assert frames == [b'changed content']
+    assert close['tag'] != tag
+    assert 'not-modified' not in close
+
+
 @pytest.mark.asyncio
 async def test_fslist1_no_watch(transport: MockTransport, tmp_path: Path) -> None:
     # empty
@@ -507,6 +805,91 @@ async def test_fslist1_notexist(transport: MockTransport) -> None:
         reply_keys={'message': "[Errno 2] No such file or directory: '/nonexisting'"})
 
 
+async def read_fslist1(transport: MockTransport, path: Path, **kwargs: Any) -> 'list[Any]':
+    ch = await transport.check_open('fslist1', path=str(path), watch=False, **kwargs)
+    messages = []
+    while True:
+        channel, data = await transport.next_frame()
+        if channel == ch:
+            messages.append(json.loads(data))
+        elif json.loads(data)['command'] == 'close':
+            assert 'problem' not in json.loads(data)
+            return messages
+
+
+@pytest.mark.asyncio
+async def test_fslist1_batches(transport: MockTransport, tmp_path: Path) -> None:
+    for i in range(25):
+        (tmp_path / f'file{i:02}').touch()
+    (tmp_path / 'dir').mkdir()
+    names = sorted(os.listdir(tmp_path))
+
+    batches = await read_fslist1(transport, tmp_path, batch_size=10, sort='name')
+    assert [len(batch) for batch in batches] == [10, 10, 6]
+    entries = [entry for batch in batches for entry in batch]
+    assert [entry['path'] for entry in entries] == names
+    assert entries[0] == {'event': 'present', 'path': 'dir', 'type': 'directory'}
+    assert entries[1] == {'event': 'present', 'path': 'file00', 'type': 'file'}
+
+    # without batch-size, we get one message per entry, as always
+    messages = await read_fslist1(transport, tmp_path, sort='name', offset=5, limit=10)
+    assert [message['path'] for message in messages] == names[5:15]
+
+    # paging through the unsorted directory gives each entry once
+    seen: 'list[str]' = []
+    for offset in range(0, 26, 4):
+        batches = await read_fslist1(transport, tmp_path, batch_size=4, offset=offset, limit=4)
+        assert len(batches) == 1
+        seen.extend(entry['path'] for entry in batches[0])
+    assert sorted(seen) == names
+
+    assert await read_fslist1(transport, tmp_path, limit=0) == []
+    assert await read_fslist1(transport, tmp_path, offset=26) == []
+
+    bad_options: 'list[dict[str, Any]]' = [{'batch-size': 0}, {'offset': -1}, {'limit': -1}, {'sort': 'size'}]
+    for bad in bad_options:
+        await transport.check_open('fslist1', path=str(tmp_path), watch=False, **bad, problem='protocol-error')
+
+
+@pytest.mark.asyncio
+async def test_fslist1_flow_control(transport: MockTransport, tmp_path: Path) -> None:
+    # enough entries for a few MB of messages
+    names = {f'{i:05}' + 'x' * 200 for i in range(12000)}
+    for name in names:
+        (tmp_path / name).touch()
+
+    ch = await transport.check_open('fslist1', path=str(tmp_path), watch=False, batch_size=100, flow_control=True)
+    pings: 'list[JsonObject]' = []
+    seen: 'list[str]' = []
+    received = 0
+
+    async def recv_one() -> 'JsonObject':
+        nonlocal received
+        channel, data = await transport.next_frame()
+        if channel == ch:
+            received += len(data)
+            seen.extend(entry['path'] for entry in json.loads(data))
+        message = json.loads(data) if channel == '' else {}
+        if message.get('command') == 'ping':
+            pings.append(message)
+        return message
+
+    # the window fills up, and the listing stalls
+    while received < Channel.SEND_WINDOW:
+        await recv_one()
+    assert (await recv_one())['command'] == 'ping'
+    await transport.assert_empty()
+    assert len(seen) < len(names)
+
+    # answering the pings gets us the rest
+    while True:
+        while pings:
+            transport.send_json('', **dict(pings.pop(0), command='pong'))
+        if (await recv_one()).get('command') == 'close':
+            break
+    assert set(seen) == names
+
+
 class GrpPwMock:
     def __init__(self, uid: 'int', gid: 'int | None' = None) -> None:
         self.pw_uid = uid
@@ -842,6 +1225,164 @@ async def test_fsreplace1_attrs(transport: MockTransport, fchown_mock: unittest.
         assert call_gid == user_group_mock.gr_gid
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize('sync', ['data', 'full', 'none'])
+async def test_fsreplace1_large(transport: MockTransport, tmp_path: Path, sync: str) -> None:
+    myfile = tmp_path / 'myfile'
+
+    # several times the write-behind block size, in uneven frames
+    block = bytes(range(256)) * 257
+    content = block * 100
+    ch = await transport.check_open('fsreplace1', path=str(myfile), size=len(content), sync=sync)
+    for offset in range(0, len(content), len(block)):
+        transport.send_data(ch, content[offset:offset + len(block)])
+    transport.send_done(ch)
+    await transport.assert_msg('', command='done', channel=ch)
+    close = await transport.assert_msg('', command='close', channel=ch)
+    assert myfile.read_bytes() == content
+    assert close['tag'] == tag_from_path(myfile)
+    assert list(tmp_path.iterdir()) == [myfile]  # no temp file left
+
+    # cancel halfway through: the file stays as it was
+    ch = await transport.check_open('fsreplace1', path=str(myfile), sync=sync)
+    for _ in range(0, len(content) // 2, len(block)):
+        transport.send_data(ch, block[::-1])
+    await transport.check_close(ch)
+    assert myfile.read_bytes() == content
+    assert list(tmp_path.iterdir()) == [myfile]
+
+
+@pytest.mark.asyncio
+async def test_fsreplace1_upload(transport: MockTransport, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    myfile = tmp_path / 'myfile'
+    partial = tmp_path / '.myfile-upload-abc'
+    content = os.urandom(3 << 20)
+
+    # start, and get interrupted
+    ch = transport.send_open('fsreplace1', path=str(myfile), upload='abc', tag='-')
+    await transport.assert_msg('', command='ready', channel=ch, offset=0)
+    for offset in range(0, len(content) // 2, 100000):
+        transport.send_data(ch, content[offset:offset + 100000])
+    await transport.check_close(ch)
+    assert not myfile.exists()
+    stored = partial.read_bytes()
+    assert content.startswith(stored)
+
+    # ask how far we got, without sending anything
+    ch = transport.send_open('fsreplace1', path=str(myfile), upload='abc', tag='-')
+    await transport.assert_msg('', command='ready', channel=ch, offset=len(stored))
+    await transport.check_close(ch)
+
+    # the same upload can't be in progress twice
+    ch = transport.send_open('fsreplace1', path=str(myfile), upload='abc', tag='-')
+    await transport.assert_msg('', command='ready', channel=ch, offset=len(stored))
+    other = transport.send_open('fsreplace1', path=str(myfile), upload='abc', tag='-')
+    await transport.assert_msg('', command='close', channel=other, problem='change-conflict')
+
+    # continue from there to the end
+    transport.send_data(ch, content[len(stored):])
+    transport.send_done(ch)
+    await transport.assert_msg('', command='done', channel=ch)
+    close = await transport.assert_msg('', command='close', channel=ch)
+    assert close['tag'] == tag_from_path(myfile)
+    assert myfile.read_bytes() == content
+    assert list(tmp_path.iterdir()) == [myfile]
+
+    # go back to an earlier offset, with a size hint
+    ch = transport.send_open('fsreplace1', path=str(myfile), upload='abc', tag=close['tag'], size=len(content))
+    await transport.assert_msg('', command='ready', channel=ch, offset=0)
+    transport.send_data(ch, b'first')
+    await transport.check_close(ch)
+    assert b'first'.startswith(partial.read_bytes())  # no leftover allocation
+    ch = transport.send_open('fsreplace1', path=str(myfile), upload='abc', tag=close['tag'], offset=0)
+    await transport.assert_msg('', command='ready', channel=ch, offset=0)
+    transport.send_data(ch, b'final')
+    transport.send_done(ch)
+    await transport.assert_msg('', command='done', channel=ch)
+    await transport.assert_msg('', command='close', channel=ch)
+    assert myfile.read_bytes() == b'final'
+    assert list(tmp_path.iterdir()) == [myfile]
+
+    # interrupted uploads expire after a while
+    monkeypatch.setattr(FsReplaceChannel, 'UPLOAD_GRACE_PERIOD', 0.1)
+    ch = transport.send_open('fsreplace1', path=str(myfile), upload='abc')
+    await transport.assert_msg('', command='ready', channel=ch, offset=0)
+    transport.send_data(ch, b'unfinished')
+    await transport.check_close(ch)
+    assert partial.exists()
+    await asyncio.sleep(0.3)
+    assert list(tmp_path.iterdir()) == [myfile]
+
+    # invalid options
+    bad_options: 'list[dict[str, Any]]' = [
+        {'upload': '../abc'}, {'upload': ''}, {'offset': 5}, {'upload': 'abc', 'offset': -1}
+    ]
+    for options in bad_options:
+        ch = transport.send_open('fsreplace1', path=str(myfile), **options)
+        await transport.assert_msg('', command='close', channel=ch, problem='protocol-error')
+
+
+@pytest.mark.asyncio
+async def test_fsreplace1_stale_uploads(transport: MockTransport, tmp_path: Path) -> None:
+    # Expired partial files, which an earlier bridge left behind, get removed by the next upload
+    expired = time.time() - FsReplaceChannel.UPLOAD_GRACE_PERIOD - 60
+
+    def make_file(name: str, *, marked: bool = True, mtime: 'float | None' = expired) -> Path:
+        path = tmp_path / name
+        path.write_bytes(b'partial')
+        if marked:
+            os.setxattr(path, FsReplaceChannel.UPLOAD_XATTR, b'')
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    try:
+        make_file('.other-upload-abc')
+    except OSError as exc:
+        pytest.skip(f'no user xattrs: {exc}')
+    fresh = make_file('.other-upload-def', mtime=None)
+    unmarked = make_file('.other-upload-ghi', marked=False)
+    unrelated = make_file('.other-abc')
+
+    # writes which aren't resumable don't look
+    myfile = tmp_path / 'myfile'
+    ch = await transport.check_open('fsreplace1', path=str(myfile))
+    transport.send_data(ch, b'content')
+    transport.send_done(ch)
+    await transport.assert_msg('', command='done', channel=ch)
+    await transport.check_close(ch)
+    assert len(list(tmp_path.iterdir())) == 5
+
+    ch = transport.send_open('fsreplace1', path=str(myfile), upload='xyz')
+    await transport.assert_msg('', command='ready', channel=ch, offset=0)
+    transport.send_done(ch)
+    await transport.assert_msg('', command='done', channel=ch)
+    await transport.check_close(ch)
+    assert sorted(tmp_path.iterdir()) == sorted([fresh, unmarked, unrelated, myfile])
+
+
+@pytest.mark.asyncio
+async def test_fsreplace1_upload_not_ours(transport: MockTransport, tmp_path: Path) -> None:
+    # A partial file with another link might have been planted, to get the content
+    target = tmp_path / 'target'
+    target.write_bytes(b'')
+    os.link(target, tmp_path / '.myfile-upload-abc')
+    ch = transport.send_open('fsreplace1', path=str(tmp_path / 'myfile'), upload='abc')
+    await transport.assert_msg('', command='close', channel=ch, problem='access-denied')
+    assert target.read_bytes() == b''
+
+    os.mkfifo(tmp_path / '.myfile-upload-def')
+    ch = transport.send_open('fsreplace1', path=str(tmp_path / 'myfile'), upload='def')
+    await transport.assert_msg('', command='close', channel=ch, problem='access-denied')
+
+
+@pytest.mark.asyncio
+async def test_fsreplace1_bad_sync(transport: MockTransport, tmp_path: Path) -> None:
+    ch = transport.send_open('fsreplace1', path=str(tmp_path / 'myfile'), sync='eventually')
+    await transport.assert_msg('', command='close', channel=ch, problem='protocol-error')
+    assert list(tmp_path.iterdir()) == []
+
+
 @pytest.mark.asyncio
 async def test_fsreplace1_size_hint(transport: MockTransport, tmp_path: Path) -> None:
     myfile = tmp_path / 'myfile'
@@ -909,6 +1450,242 @@ async def test_fsreplace1_size_hint(transport: MockTransport, tmp_path: Path) ->
     assert myfile.read_bytes() == b'too large'
 
 
+async def run_fscopy1(transport: MockTransport, **kwargs: Any) -> 'tuple[list[JsonObject], JsonObject]':
+    ch = await transport.check_open('fscopy1', **kwargs)
+    progress = []
+    while True:
+        channel, data = await transport.next_frame()
+        if channel == '':
+            break
+        progress.append(json.loads(data))
+    assert json.loads(data) == {'command': 'done', 'channel': ch}
+    close = await transport.assert_msg('', command='close', channel=ch)
+    return progress, close
+
+
+@pytest.mark.asyncio
+async def test_fscopy1(transport: MockTransport, tmp_path: Path) -> None:
+    source = tmp_path / 'source'
+    source.write_bytes(b'x' * 100000)
+    source.chmod(0o640)
+    target = tmp_path / 'target'
+
+    # copy to a new file
+    progress, close = await run_fscopy1(transport, source=str(source), path=str(target), tag='-')
+    assert progress[-1] == {'bytes': 100000, 'total-bytes': 100000, 'files': 1, 'total-files': 1}
+    assert close['tag'] == tag_from_path(target)
+    assert target.read_bytes() == source.read_bytes()
+    assert stat.S_IMODE(target.stat().st_mode) == 0o640
+    assert sorted(tmp_path.iterdir()) == [source, target]  # no leftovers
+
+    # ...but not again
+    ch = transport.send_open('fscopy1', source=str(source), path=str(target), tag='-')
+    await transport.assert_msg('', command='close', channel=ch, problem='change-conflict')
+
+    # replacing needs the right tag
+    source.write_bytes(b'new content')
+    ch = transport.send_open('fscopy1', source=str(source), path=str(target), tag='1:2')
+    await transport.assert_msg('', command='close', channel=ch, problem='change-conflict')
+    _, close = await run_fscopy1(transport, source=str(source), path=str(target), tag=close['tag'])
+    assert target.read_bytes() == b'new content'
+
+    # the source can be required to be unchanged
+    ch = transport.send_open('fscopy1', source=str(source), path=str(target), **{'source-tag': '1:2'})
+    await transport.assert_msg('', command='close', channel=ch, problem='change-conflict')
+    await run_fscopy1(transport, source=str(source), path=str(target), **{'source-tag': tag_from_path(source)})
+
+    # move
+    _, close = await run_fscopy1(transport, source=str(source), path=str(tmp_path / 'moved'), move=True)
+    assert not source.exists()
+    assert (tmp_path / 'moved').read_bytes() == b'new content'
+    assert close['tag'] == tag_from_path(tmp_path / 'moved')
+
+    # files which can't be read show up as such
+    ch = transport.send_open('fscopy1', source=str(source), path=str(target))
+    await transport.assert_msg('', command='close', channel=ch, problem='not-found')
+
+    # missing options
+    ch = transport.send_open('fscopy1', path=str(target))
+    await transport.assert_msg('', command='close', channel=ch, problem='protocol-error')
+
+
+@pytest.mark.asyncio
+async def test_fscopy1_sendfile(transport: MockTransport, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # as on Pythons without os.copy_file_range()
+    monkeypatch.delattr(os, 'copy_file_range')
+    source = tmp_path / 'source'
+    source.write_bytes(os.urandom(1 << 20))
+    target = tmp_path / 'target'
+
+    progress, _ = await run_fscopy1(transport, source=str(source), path=str(target))
+    assert progress[-1]['bytes'] == 1 << 20
+    assert target.read_bytes() == source.read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_fscopy1_tree(transport: MockTransport, tmp_path: Path) -> None:
+    source = tmp_path / 'source'
+    (source / 'sub' / 'dir').mkdir(parents=True)
+    for i in range(20):
+        (source / 'sub' / f'file{i}').write_bytes(os.urandom(i * 1000))
+    (source / 'sub' / 'dir' / 'empty').touch()
+    (source / 'link').symlink_to('sub/file1')
+    (source / 'readonly').mkdir(mode=0o555)
+
+    def contents(path: Path) -> 'dict[str, Any]':
+        result: 'dict[str, Any]' = {}
+        for item in sorted(path.rglob('*')):
+            name = str(item.relative_to(path))
+            if item.is_symlink():
+                result[name] = os.readlink(item)
+            elif item.is_dir():
+                result[name] = stat.S_IMODE(item.stat().st_mode)
+            else:
+                result[name] = item.read_bytes()
+        return result
+
+    target = tmp_path / 'target'
+    progress, close = await run_fscopy1(transport, source=str(source), path=str(target))
+    assert progress[-1] == {'bytes': 190000, 'total-bytes': 190000, 'files': 21, 'total-files': 21}
+    assert close['tag'] == tag_from_path(target)
+    assert contents(target) == contents(source)
+    assert sorted(tmp_path.iterdir()) == [source, target]  # no leftovers
+
+    # directories are never replaced
+    ch = transport.send_open('fscopy1', source=str(source), path=str(target))
+    await transport.assert_msg('', command='close', channel=ch, problem='change-conflict')
+    assert sorted(tmp_path.iterdir()) == [source, target]
+
+    # a directory can't be copied or moved into itself, not even via a symlink
+    alias = tmp_path / 'alias'
+    alias.symlink_to('source')
+    for path in [source / 'copy', source / 'sub' / 'copy', alias / 'copy']:
+        for move in [False, True]:
+            ch = transport.send_open('fscopy1', source=str(source), path=str(path), move=move)
+            await transport.assert_msg('', command='close', channel=ch, problem='not-supported',
+                                       message=f'cannot copy {source} into itself, {path}')
+    assert not (source / 'copy').exists()
+    assert not (source / 'sub' / 'copy').exists()
+    alias.unlink()
+    # ...but a sibling with a common prefix is fine
+    await run_fscopy1(transport, source=str(source / 'sub'), path=str(source / 'sub2'))
+    shutil.rmtree(source / 'sub2')
+
+    # special files are not supported
+    os.mkfifo(target / 'fifo')
+    ch = transport.send_open('fscopy1', source=str(target), path=str(tmp_path / 'again'))
+    await transport.assert_msg('', command='ready', channel=ch)
+    await transport.assert_msg('', command='close', channel=ch, problem='not-supported')
+    assert sorted(tmp_path.iterdir()) == [source, target]
+
+    # move a tree
+    expected = contents(source)
+    await run_fscopy1(transport, source=str(source), path=str(tmp_path / 'moved'), move=True, tag='-')
+    assert contents(tmp_path / 'moved') == expected
+    assert not source.exists()
+
+
+async def read_fsdu1(transport: MockTransport, path: Path, **kwargs: Any) -> 'dict[str, JsonObject]':
+    ch = await transport.check_open('fsdu1', path=str(path), **kwargs)
+    result: 'dict[str, JsonObject]' = {}
+    while True:
+        channel, data = await transport.next_frame()
+        if channel == '':
+            break
+        message = json.loads(data)
+        assert message['path'] not in result
+        # post-order: subdirectories come before their parents
+        assert not any(message['path'].startswith(seen + '/') for seen in result)
+        result[message.pop('path')] = message
+    assert json.loads(data) == {'command': 'done', 'channel': ch}
+    await transport.assert_msg('', command='close', channel=ch)
+    assert list(result)[-1] == ''
+    return result
+
+
+@pytest.mark.asyncio
+async def test_fsdu1(transport: MockTransport, tmp_path: Path) -> None:
+    def usage(path: Path) -> int:
+        return path.lstat().st_blocks * 512
+
+    def du(path: Path) -> JsonObject:
+        items = [path, *path.rglob('*')]
+        return {'size': sum(usage(item) for item in items), 'files': sum(not item.is_dir() for item in items)}
+
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'c').mkdir()
+    (tmp_path / 'top').write_bytes(os.urandom(10000))
+    (tmp_path / 'a' / 'one').write_bytes(os.urandom(100000))
+    (tmp_path / 'a' / 'b' / 'two').write_bytes(os.urandom(20000))
+    (tmp_path / 'c' / 'link').symlink_to('../top')
+
+    expected = {name: du(tmp_path / name) for name in ['a/b', 'a', 'c', '']}
+    assert await read_fsdu1(transport, tmp_path) == expected
+    assert await read_fsdu1(transport, tmp_path, depth=1) == {name: expected[name] for name in ['a', 'c', '']}
+    assert await read_fsdu1(transport, tmp_path, depth=0) == {'': expected['']}
+    assert await read_fsdu1(transport, tmp_path, cache=True) == expected
+
+    # the cache doesn't notice files changing in place...
+    with (tmp_path / 'a' / 'b' / 'two').open('ab') as file:
+        file.write(os.urandom(100000))
+    assert await read_fsdu1(transport, tmp_path, cache=True) == expected
+    # ...which is why it isn't used by default
+    expected = {name: du(tmp_path / name) for name in ['a/b', 'a', 'c', '']}
+    assert await read_fsdu1(transport, tmp_path) == expected
+
+    # ...but it does notice new and removed files and directories
+    (tmp_path / 'a' / 'b' / 'three').write_bytes(os.urandom(5000))
+    (tmp_path / 'c' / 'link').unlink()
+    (tmp_path / 'c' / 'd').mkdir()
+    expected = {name: du(tmp_path / name) for name in ['a/b', 'a', 'c/d', 'c', '']}
+    assert await read_fsdu1(transport, tmp_path, cache=True) == expected
+
+    # unreadable directories are reported as such
+    if os.getuid() != 0:
+        (tmp_path / 'c' / 'd').chmod(0)
+        result = await read_fsdu1(transport, tmp_path)
+        assert result['c/d']['error'] == 'Permission denied'
+        (tmp_path / 'c' / 'd').chmod(0o700)
+
+    # errors
+    ch = transport.send_open('fsdu1', path=str(tmp_path / 'nonexistent'))
+    await transport.assert_msg('', command='close', channel=ch, problem='not-found')
+    ch = transport.send_open('fsdu1', path=str(tmp_path / 'top'))
+    await transport.assert_msg('', command='close', channel=ch, problem='not-supported')
+    ch = transport.send_open('fsdu1', path=str(tmp_path), depth=-1)
+    await transport.assert_msg('', command='close', channel=ch, problem='protocol-error')
+
+
+@pytest.mark.asyncio
+async def test_fsdu1_wide(transport: MockTransport, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # Only a few directories are queued for scanning at a time
+    monkeypatch.setattr(FsDuChannel, 'MAX_QUEUED_SCANS', 3)
+    lock = threading.Lock()
+    running = max_running = 0
+
+    def scan_usage(*args: Any) -> Any:
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.001)
+        try:
+            return real_scan_usage(*args)
+        finally:
+            with lock:
+                running -= 1
+
+    real_scan_usage = filesystem.scan_usage
+    monkeypatch.setattr(filesystem, 'scan_usage', scan_usage)
+
+    for i in range(100):
+        (tmp_path / f'dir{i}' / 'sub').mkdir(parents=True)
+    result = await read_fsdu1(transport, tmp_path)
+    assert len(result) == 201
+    assert result['']['files'] == 0
+    assert max_running <= 3
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize('channeltype', CHANNEL_TYPES)
 async def test_channel(bridge: Bridge, transport: MockTransport, channeltype, tmp_path: Path) -> None:
@@ -937,6 +1714,10 @@ async def test_channel(bridge: Bridge, transport: MockTransport, channeltype, tm
         args = {'path': '/', 'watch': False}
     elif payload == 'fsread1':
         args = {'path': '/etc/passwd'}
+    elif payload == 'fsdu1':
+        args = {'path': str(tmp_path)}
+    elif payload == 'fscopy1':
+        args = {'source': '/etc/passwd', 'path': str(tmp_path / 'passwd')}
     elif payload == 'fsreplace1':
         args = {'path': 'tmpfile'}
     elif payload == 'fswatch1':
@@ -1101,6 +1882,45 @@ async def test_async_acks(bridge: Bridge, transport: MockTransport) -> None:
     await transport.check_close(ch)
 
 
+@pytest.mark.asyncio
+async def test_receive_budget(bridge: Bridge, transport: MockTransport, monkeypatch: pytest.MonkeyPatch) -> None:
+    for rule in bridge.routing_rules:
+        if isinstance(rule, ChannelRoutingRule):
+            rule.table['ack1'] = [AckChannel]
+    monkeypatch.setattr(bridge, 'RECEIVE_QUEUE_HIGH', 4 * Channel.BLOCK_SIZE)
+    monkeypatch.setattr(bridge, 'RECEIVE_QUEUE_LOW', Channel.BLOCK_SIZE)
+
+    ch = await transport.check_open('ack1')
+    ack = bridge.open_channels[ch]
+    assert isinstance(ack, AckChannel)
+
+    # fill up the queue: the bridge should stop reading
+    block = b'x' * Channel.BLOCK_SIZE
+    for _ in range(8):
+        transport.send_data(ch, block)
+    assert ack.queued_bytes == bridge.queued_bytes == 8 * Channel.BLOCK_SIZE
+    assert transport.reading_paused
+    assert bridge.stats.get_channels()[ch]['queued-bytes'] == 8 * Channel.BLOCK_SIZE
+    assert bridge.stats.get_input_paused()
+
+    # the first block gets read right away, but we're still over the limit
+    await asyncio.sleep(0.1)
+    assert ack.queued_bytes == bridge.queued_bytes == 7 * Channel.BLOCK_SIZE
+    assert transport.reading_paused
+
+    # consume more data until we drop to the low watermark
+    for n in range(6, 0, -1):
+        ack.semaphore.release()
+        await asyncio.sleep(0.1)
+        assert ack.queued_bytes == bridge.queued_bytes == n * Channel.BLOCK_SIZE
+        assert transport.reading_paused == bridge.stats.get_input_paused() == (n > 1)
+
+    # closing the channel drops whatever is left
+    transport.send_data(ch, block)
+    await transport.check_close(ch)
+    assert bridge.queued_bytes == 0
+
+
 @pytest.mark.asyncio
 async def test_flow_control(transport: MockTransport, tmp_path: Path) -> None:
     bigun = tmp_path / 'bigun'
@@ -1143,6 +1963,78 @@ async def test_flow_control(transport: MockTransport, tmp_path: Path) -> None:
     transport.send_close(fsread1)
 
 
+@pytest.mark.asyncio
+async def test_flow_control_window(bridge: Bridge, transport: MockTransport, tmp_path: Path) -> None:
+    bigun = tmp_path / 'bigun'
+    total_bytes = 16 * 1024 * 1024
+    recvd_bytes = 0
+    bigun.write_bytes(b'0' * total_bytes)
+    fsread1 = await transport.check_open('fsread1', path=str(bigun), flow_control=True, binary='raw')
+    channel = bridge.open_channels[fsread1]
+    assert isinstance(channel, Channel)
+    assert channel.send_window == Channel.SEND_WINDOW
+    assert channel.round_trip_time is None
+    stats = bridge.stats.get_channels()[fsread1]
+    assert stats['send-window'] == Channel.SEND_WINDOW
+    assert 'round-trip-time' not in stats
+
+    # Answer the pings with some latency: the window should grow to cover it
+    loop = asyncio.get_running_loop()
+    pongs: 'list[asyncio.TimerHandle]' = []
+    while recvd_bytes < total_bytes:
+        channel_id, data = await transport.next_frame()
+        if channel_id == fsread1:
+            recvd_bytes += len(data)
+        else:
+            ping = json.loads(data)
+            assert ping['command'] == 'ping'
+            pong = functools.partial(transport.send_json, '', **dict(ping, command='pong'))
+            pongs.append(loop.call_later(0.05, pong))
+
+    assert channel.round_trip_time is not None
+    assert channel.round_trip_time >= 0.05
+    assert channel.send_window > Channel.SEND_WINDOW
+    # the channel might be gone from the bridge's stats already
+    assert channel.get_channel_stats(fsread1) == {
+        'send-window': channel.send_window, 'round-trip-time': channel.round_trip_time
+    }
+
+    for pong in pongs:
+        pong.cancel()
+    # the ping for the last block comes after it
+    await transport.assert_msg('', command='ping', channel=fsread1, sequence=total_bytes)
+    await transport.assert_msg('', command='done', channel=fsread1)
+    await transport.assert_msg('', command='close', channel=fsread1)
+
+
+@pytest.mark.asyncio
+async def test_send_scheduler(transport: MockTransport, tmp_path: Path) -> None:
+    bigun = tmp_path / 'bigun'
+    bigun.write_bytes(b'0' * 8 * 1024 * 1024)
+
+    # Without flow control, nothing stops these channels from sending the
+    # entire file at once, except for the scheduler.
+    first = await transport.check_open('fsread1', path=str(bigun), binary='raw')
+    second = transport.send_open('fsread1', path=str(bigun), binary='raw')
+    echo = transport.send_open('echo')
+    transport.send_data(echo, b'hello')
+
+    events: 'list[tuple[str, str]]' = []
+    while (first, 'close') not in events or (second, 'close') not in events:
+        channel, data = await transport.next_frame()
+        if channel == '':
+            msg = json.loads(data)
+            events.append((msg['channel'], msg['command']))
+        else:
+            events.append((channel, 'data'))
+
+    # The echo and the second transfer got their turns during the first one
+    assert events.index((echo, 'data')) < events.index((first, 'done'))
+    assert events.index((second, 'data')) < events.index((first, 'done'))
+
+    await transport.check_close(echo)
+
+
 @pytest.mark.asyncio
 async def test_large_upload(transport: MockTransport, tmp_path: Path) -> None:
     fifo = str(tmp_path / 'pipe')
@@ -1345,6 +2237,118 @@ async def test_fsinfo_empty_update(transport: MockTransport, tmp_path: Path) ->
     await transport.check_close(ch)
 
 
+@pytest.mark.asyncio
+async def test_fsinfo_chunked(transport: MockTransport, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(FsInfoChannel, 'ENTRIES_CHUNK_SIZE', 10)
+    expected: JsonDict = {}
+    for i in range(24):
+        (tmp_path / f'file{i}').touch()
+        expected[f'file{i}'] = 'reg'
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'link').symlink_to('dir')
+    os.mkfifo(tmp_path / 'fifo')
+    expected.update(dir='dir', link='lnk', fifo='fifo')
+
+    # the type comes from readdir() in the first case, and from stat() in the second
+    for attrs in (['type'], ['type', 'mode']):
+        ch = await transport.check_open('fsinfo', path=str(tmp_path), attrs=attrs, fnmatch='*')
+        patches = []
+        while True:
+            channel, data = await transport.next_frame()
+            if channel != ch:
+                break
+            patches.append(json.loads(data))
+        assert json.loads(data) == {'command': 'done', 'channel': ch}
+        await transport.assert_msg('', command='close', channel=ch)
+
+        assert [len(patch['info']['entries']) for patch in patches] == [10, 10, 7]
+        assert patches[0]['partial'] is True
+        assert 'partial' not in patches[1]
+        assert patches[2]['partial'] is None
+
+        state: JsonObject = {}
+        for patch in patches:
+            state = json_merge_patch(state, patch)
+        info = get_dict(state, 'info')
+        assert 'partial' not in state
+        assert get_str(info, 'type') == 'dir'
+        entries = get_dict(info, 'entries')
+        assert {name: get_str(get_dict(entries, name), 'type') for name in entries} == expected
+
+
+@pytest.mark.asyncio
+async def test_fsinfo_chunked_watch(transport: MockTransport, tmp_path: Path,
+                                    monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(FsInfoChannel, 'ENTRIES_CHUNK_SIZE', 10)
+    for i in range(24):
+        (tmp_path / f'file{i}').touch()
+
+    # Hold up the initial state after its first chunk
+    release = threading.Event()
+    chunks = 0
+    real_read_entries = FsInfoChannel.read_entries
+
+    def read_entries(self: FsInfoChannel, *args: Any) -> Any:
+        nonlocal chunks
+        chunks += 1
+        if chunks == 2:
+            release.wait()
+        return real_read_entries(self, *args)
+
+    monkeypatch.setattr(FsInfoChannel, 'read_entries', read_entries)
+
+    try:
+        ch = await transport.check_open('fsinfo', path=str(tmp_path), attrs=['type'], fnmatch='*', watch=True)
+        first = await transport.next_msg(ch)
+        assert first['partial'] is True
+
+        # Changes during the initial state get held back until it's complete
+        (tmp_path / 'new').touch()
+        await transport.assert_empty()
+        await asyncio.sleep(0.2)
+        await transport.assert_empty()
+    finally:
+        release.set()
+
+    patches = [await transport.next_msg(ch)]
+    while patches[-1].get('partial', False) is not None:
+        patches.append(await transport.next_msg(ch))
+    update = await transport.next_msg(ch)
+    assert 'partial' not in update
+    assert update['info']['entries']['new'] == {'type': 'reg'}
+
+    await transport.check_close(ch)
+
+
+@pytest.mark.asyncio
+async def test_path_watches_shared(transport: MockTransport, tmp_path: Path) -> None:
+    n_watches = path_watches.get_n_watches()
+    n_listeners = path_watches.get_n_listeners()
+
+    watch1 = await transport.check_open('fswatch1', path=str(tmp_path))
+    watch2 = await transport.check_open('fswatch1', path=str(tmp_path))
+    client = await FsInfoClient.open(transport, tmp_path, ['type'], fnmatch='', watch=True)
+    assert await client.next_state() == {'info': {'type': 'dir'}}
+
+    # one PathWatch for all three of them
+    assert path_watches.get_n_watches() == n_watches + 1
+    assert path_watches.get_n_listeners() == n_listeners + 3
+
+    # both get the event
+    (tmp_path / 'dir').mkdir()
+    for channel in (watch1, watch2):
+        msg = await transport.next_msg(channel)
+        assert msg['event'] == 'created'
+        assert msg['path'] == str(tmp_path / 'dir')
+
+    await transport.check_close(watch1)
+    assert path_watches.get_n_listeners() == n_listeners + 2
+    await transport.check_close(watch2)
+    await client.close()
+    assert path_watches.get_n_watches() == n_watches
+    assert path_watches.get_n_listeners() == n_listeners
+
+
 @pytest.mark.asyncio
 async def test_fsinfo(transport: MockTransport, fsinfo_test_cases: 'dict[Path, JsonObject]') -> None:
     for path, expected_state in fsinfo_test_cases.items():
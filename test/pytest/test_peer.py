@@ -72,6 +72,25 @@ async def test_init_failure(rule, init_type, monkeypatch, transport):
     await transport.check_open('test', problem='protocol-error')
 
 
+@pytest.mark.asyncio
+async def test_relay_data(transport, rule):
+    # The first frame arrives while the peer is still starting up
+    channel = transport.send_open('test')
+    transport.send_data(channel, b'early')
+    await transport.assert_msg('', command='ready', channel=channel)
+    await transport.assert_data(channel, b'early')
+
+    # ...and the rest get relayed directly, in both directions
+    blocks = [b'%d\n' % i * 1000 for i in range(100)]
+    for block in blocks:
+        transport.send_data(channel, block)
+    for block in blocks:
+        await transport.assert_data(channel, block)
+
+    rule.peer.close()
+    await transport.assert_msg('', command='close', channel=channel, problem='terminated')
+
+
 # this doesn't use await, but requires an event loop
 @pytest.mark.asyncio
 async def test_immediate_shutdown(rule):  # noqa: RUF029
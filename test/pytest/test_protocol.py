@@ -0,0 +1,166 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from cockpit.jsonutil import JsonObject
+from cockpit.protocol import CockpitProtocol, CockpitProtocolError
+from cockpit.transports import StdioTransport
+
+
+def make_frame(channel: str, data: bytes) -> bytes:
+    msg = channel.encode('ascii') + b'\n' + data
+    return str(len(msg)).encode('ascii') + b'\n' + msg
+
+
+class Protocol(CockpitProtocol):
+    def __init__(self) -> None:
+        self.frames: 'list[tuple[str, bytes]]' = []
+        self.controls: 'list[JsonObject]' = []
+        self.exc: 'Exception | None' = None
+        self.eof = False
+
+    def channel_data_received(self, channel: str, data: bytes) -> None:
+        assert isinstance(data, bytes)
+        self.frames.append((channel, data))
+
+    def channel_control_received(self, channel: str, command: str, message: JsonObject) -> None:
+        self.controls.append(message)
+
+    def transport_control_received(self, command: str, message: JsonObject) -> None:
+        self.controls.append(message)
+
+    def do_closed(self, exc: 'Exception | None') -> None:
+        self.exc = exc
+
+    def eof_received(self) -> bool:
+        self.eof = True
+        return False
+
+
+FRAMES = [
+    ('', json.dumps({'command': 'init', 'version': 1}).encode()),
+    ('a', b''),
+    ('b', b'x'),
+    ('', json.dumps({'command': 'ping', 'channel': 'b'}).encode()),
+    ('c', bytes(range(256)) * 4),
+    ('d', b'y' * (CockpitProtocol.min_buffer_size + 1)),
+    ('e', b'z' * (CockpitProtocol.max_buffer_size * 3)),
+    ('f', b'\n\n\n'),
+]
+STREAM = b''.join(make_frame(channel, data) for channel, data in FRAMES)
+EXPECTED = [frame for frame in FRAMES if frame[0]]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096, 65536, len(STREAM)])
+def test_chunked(chunk_size: int) -> None:
+    protocol = Protocol()
+    for start in range(0, len(STREAM), chunk_size):
+        protocol.data_received(STREAM[start:start + chunk_size])
+
+    assert protocol.frames == EXPECTED
+    assert len(protocol.controls) == 2
+    assert protocol.exc is None
+
+    # we're back to a small buffer after the large frames
+    assert len(protocol.get_buffer()) <= CockpitProtocol.max_buffer_size
+
+
+def test_buffer_sized_for_large_frame() -> None:
+    protocol = Protocol()
+    data = b'x' * (CockpitProtocol.max_buffer_size * 2)
+    frame = make_frame('big', data)
+
+    # Send just the header: the next buffer should fit the entire frame
+    protocol.data_received(frame[:20])
+    assert len(protocol.get_buffer()) == len(frame) - 20
+    protocol.data_received(frame[20:])
+    assert protocol.frames == [('big', data)]
+
+
+@pytest.mark.parametrize('garbage', [b'abc\n', b'12345678901234\n'])
+def test_bad_size(garbage: bytes) -> None:
+    protocol = Protocol()
+    protocol.data_received(garbage + b'whatever')
+    assert isinstance(protocol.exc, CockpitProtocolError)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('read', ['readv', 'read'])
+async def test_stdio_transport(monkeypatch: pytest.MonkeyPatch, read: str) -> None:
+    if read == 'read':
+        # as on Pythons without os.readv()
+        monkeypatch.delattr(os, 'readv')
+    loop = asyncio.get_running_loop()
+    protocol = Protocol()
+    our_stdin, their_stdin = os.pipe()
+    their_stdout, our_stdout = os.pipe()
+    transport = StdioTransport(loop, protocol, stdin=our_stdin, stdout=our_stdout)
+
+    try:
+        os.set_blocking(their_stdin, False)
+        view = memoryview(STREAM)
+        while view:
+            try:
+                view = view[os.write(their_stdin, view):]
+            except BlockingIOError:
+                await asyncio.sleep(0.01)
+        os.close(their_stdin)
+
+        while not protocol.eof:
+            await asyncio.sleep(0.01)
+        assert protocol.frames == EXPECTED
+        assert transport.is_closing()
+    finally:
+        os.close(our_stdin)
+        os.close(our_stdout)
+        os.close(their_stdout)
+
+
+@pytest.mark.asyncio
+async def test_control_overtakes_data() -> None:
+    loop = asyncio.get_running_loop()
+    protocol = Protocol()
+    our_stdin, their_stdin = os.pipe()
+    their_stdout, our_stdout = os.pipe()
+    transport = StdioTransport(loop, protocol, stdin=our_stdin, stdout=our_stdout)
+
+    try:
+        # Saturate the pipe and queue up a lot of data behind it
+        block = b'x' * 16 * 1024
+        for _ in range(100):
+            protocol.write_channel_data('a', block)
+        await asyncio.sleep(0)
+        for _ in range(100):
+            protocol.write_channel_data('a', block)
+        queued = transport.get_write_buffer_size()
+        assert queued > 1024 * 1024
+
+        # A ping stays behind the data of its own channel, but a pong for
+        # another channel goes ahead of it
+        protocol.write_control(command='ping', channel='a', sequence=200 * len(block))
+        protocol.write_control(command='pong', channel='b')
+
+        # Read everything back, up to the ping
+        os.set_blocking(their_stdout, False)
+        output = b''
+        while b'"ping"' not in output:
+            try:
+                output += os.read(their_stdout, 1024 * 1024)
+            except BlockingIOError:
+                await asyncio.sleep(0.01)
+
+        # The pong only had to wait for what was already in the pipe
+        in_pipe = 200 * len(make_frame('a', block)) - queued
+        assert output.index(b'"pong"') < in_pipe + len(block)
+
+        # Everything else arrives in order
+        reader = Protocol()
+        reader.data_received(output)
+        assert reader.frames == [('a', block)] * 200
+        assert [message['command'] for message in reader.controls] == ['pong', 'ping']
+    finally:
+        transport.abort()
+        for fd in (our_stdin, their_stdin, their_stdout, our_stdout):
+            os.close(fd)
@@ -4,9 +4,13 @@
 
 
 import collections
+import errno
 import multiprocessing
 import numbers
 import os
+import resource
+import shutil
+from pathlib import Path
 
 import pytest
 
@@ -105,6 +109,164 @@ def test_cgroup_descriptions():
     get_checked_samples(cockpit.samples.CGroupSampler())
 
 
+@pytest.fixture
+def cgroup_mock(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(cockpit.samples, 'CGROUP_PATH', str(tmp_path))
+    (tmp_path / 'cgroup.controllers').write_text('cpu memory\n')
+    return tmp_path
+
+
+def make_cgroup(path: Path, memory: int) -> None:
+    path.mkdir()
+    (path / 'memory.current').write_text(f'{memory}\n')
+    (path / 'memory.max').write_text('max\n')
+    (path / 'cpu.stat').write_text('usage_usec 5000\nuser_usec 3000\n')
+
+
+@pytest.mark.parametrize('mode', ['inotify', 'rescan', 'no-fds'])
+def test_cgroup_index(cgroup_mock: Path, monkeypatch: pytest.MonkeyPatch, mode: str) -> None:
+    if mode == 'rescan':
+        def no_inotify() -> None:
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        monkeypatch.setattr(cockpit.samples, 'Inotify', no_inotify)
+    elif mode == 'no-fds':
+        monkeypatch.setattr(resource, 'getrlimit', lambda _: (8, 8))
+
+    make_cgroup(cgroup_mock / 'system.slice', 1000)
+    make_cgroup(cgroup_mock / 'system.slice' / 'foo.service', 100)
+    make_cgroup(cgroup_mock / 'user.slice', 2000)
+
+    sampler = cockpit.samples.CGroupSampler()
+    samples = get_checked_samples(sampler)
+    assert samples['cgroup.memory.usage'] == {
+        'system.slice': 1000, 'system.slice/foo.service': 100, 'user.slice': 2000
+    }
+    assert samples['cgroup.memory.limit'] == dict.fromkeys(samples['cgroup.memory.usage'])
+    assert samples['cgroup.cpu.usage'] == dict.fromkeys(samples['cgroup.memory.usage'], 5.0)
+
+    # values get read again, and the tree is kept up to date
+    (cgroup_mock / 'user.slice' / 'memory.current').write_text('3000\n')
+    make_cgroup(cgroup_mock / 'user.slice' / 'user-1000.slice', 500)
+    shutil.rmtree(cgroup_mock / 'system.slice')
+    samples = get_checked_samples(sampler)
+    assert samples['cgroup.memory.usage'] == {'user.slice': 3000, 'user.slice/user-1000.slice': 500}
+
+    # files which appear later get noticed, after a while
+    (cgroup_mock / 'user.slice' / 'cpu.weight').write_text('100\n')
+    for _ in range(cockpit.samples.CGroupIndex.RECHECK_INTERVAL):
+        samples = get_checked_samples(sampler)
+    assert samples['cgroup.cpu.shares'] == {'user.slice': 100, 'user.slice/user-1000.slice': None}
+
+    sampler.close()
+    assert cockpit.samples.CGroupIndex.n_fds == 0
+
+
+def test_raise_nofile_limit(monkeypatch: pytest.MonkeyPatch) -> None:
+    limits = [(1024, 65536)]
+    monkeypatch.setattr(resource, 'getrlimit', lambda _: limits[-1])
+    monkeypatch.setattr(resource, 'setrlimit', lambda _, limit: limits.append(limit))
+    assert cockpit.samples.raise_nofile_limit() == 65536
+    assert limits == [(1024, 65536), (65536, 65536)]
+    assert cockpit.samples.raise_nofile_limit() == 65536
+    assert len(limits) == 2
+
+    def fail(*_args: object) -> None:
+        raise ValueError('not allowed')
+    monkeypatch.setattr(resource, 'setrlimit', fail)
+    limits.append((1024, 4096))
+    assert cockpit.samples.raise_nofile_limit() == 1024
+
+
+@pytest.fixture
+def proc_mock(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(cockpit.samples, 'PROC_PATH', str(tmp_path))
+    (tmp_path / 'net').mkdir()
+    return tmp_path
+
+
+@pytest.mark.parametrize('read', ['preadv', 'pread'])
+def test_proc_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, read: str) -> None:
+    if read == 'pread':
+        monkeypatch.delattr(os, 'preadv')
+
+    (tmp_path / 'file').write_bytes(b'x' * 100)
+    procfile = cockpit.samples.ProcFile(str(tmp_path / 'file'), size=16)
+    assert procfile.read() == b'x' * 100
+    assert len(procfile.buffer) == 128
+
+    # same file, read again from the start
+    (tmp_path / 'file').write_bytes(b'y' * 10)
+    assert procfile.read() == b'y' * 10
+
+    assert procfile.decode([b'a', b'b']) == ['a', 'b']
+    names = procfile.decode([b'a', b'b'])
+    assert procfile.decode([b'a', b'b']) is names
+
+    procfile.close()
+    assert procfile.fd is None
+
+
+def test_proc_samplers(proc_mock: Path) -> None:
+    (proc_mock / 'stat').write_text(
+        'cpu  400 40 200 1000 20 0 0 0 0 0\n'
+        'cpu0 100 10 50 250 5 0 0 0 0 0\n'
+        'cpu1 300 30 150 750 15 0 0 0 0 0\n'
+        'intr 1 2 3\n'
+    )
+    (proc_mock / 'meminfo').write_text(
+        'MemTotal:        1000 kB\nMemFree:          200 kB\nMemAvailable:     600 kB\nBuffers:           10 kB\n'
+        'Cached:           90 kB\nActive(anon):      20 kB\nSwapTotal:        100 kB\nSwapFree:          40 kB\n'
+        'HugePages_Total:       0\n'
+    )
+    (proc_mock / 'diskstats').write_text(
+        '   8       0 sda 1 0 10 0 2 0 20 0 0 0 0 0 0 0 0 0 0\n'
+        '   8       1 sda1 1 0 8 0 2 0 16 0 0 0 0 0 0 0 0 0 0\n'
+        ' 259       0 nvme0n1 1 0 100 0 2 0 200 0 0 0 0 0 0 0 0 0 0\n'
+        ' 259       1 nvme0n1p1 1 0 80 0 2 0 160 0 0 0 0 0 0 0 0 0 0\n'
+        ' 253       0 dm-0 1 0 50 0 2 0 50 0 0 0 0 0 0 0 0 0 0\n'
+        '   9       0 md0 1 0 50 0 2 0 50 0 0 0 0 0 0 0 0 0 0\n'
+    )
+    (proc_mock / 'net' / 'dev').write_text(
+        'Inter-|   Receive                                                |  Transmit\n'
+        ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls\n'
+        '    lo:     100       1    0    0    0     0          0         0      100       1    0    0    0     0\n'
+        '  eth0:123456789012 5    0    0    0     0          0         0     2000       6    0    0    0     0\n'
+    )
+
+    samples = get_checked_samples(cockpit.samples.CPUSampler())
+    ms = cockpit.samples.MS_PER_JIFFY
+    assert samples['cpu.basic.user'] == 400 * ms
+    assert samples['cpu.core.iowait'] == {'0': 5 * ms, '1': 15 * ms}
+
+    samples = get_checked_samples(cockpit.samples.MemorySampler())
+    assert samples == {
+        'memory.free': 200 * 1024,
+        'memory.used': 400 * 1024,
+        'memory.cached': 100 * 1024,
+        'memory.swap-used': 60 * 1024,
+    }
+
+    sampler = cockpit.samples.DiskSampler()
+    samples = get_checked_samples(sampler)
+    assert samples['disk.dev.read'] == {'sda': 10 * 512, 'nvme0n1': 100 * 512}
+    assert samples['disk.all.written'] == 220 * 512
+
+    # a new disk, and new values
+    with open(proc_mock / 'diskstats', 'a') as diskstats:
+        diskstats.write('   8      16 sdb 1 0 1 0 2 0 2 0 0 0 0 0 0 0 0 0 0\n')
+    samples = get_checked_samples(sampler)
+    assert samples['disk.dev.read'] == {'sda': 10 * 512, 'nvme0n1': 100 * 512, 'sdb': 512}
+    sampler.close()
+
+    samples = get_checked_samples(cockpit.samples.BlockSampler())
+    assert samples['block.device.written']['dm-0'] == 50 * 512
+    assert len(samples['block.device.read']) == 7
+
+    samples = get_checked_samples(cockpit.samples.NetworkSampler())
+    assert samples['network.interface.rx'] == {'lo': 100, 'eth0': 123456789012}
+    assert samples['network.interface.tx'] == {'lo': 100, 'eth0': 2000}
+
+
 def test_temperature_descriptions():
     samples = collections.defaultdict(dict)
     cockpit.samples.CPUTemperatureSampler().sample(samples)
@@ -145,3 +307,118 @@ def test_cgroup_disk_io():
     for cgroup in samples['disk.cgroup.read']:
         assert samples['disk.cgroup.read'][cgroup] >= 0
         assert samples['disk.cgroup.written'][cgroup] >= 0
+
+
+def test_cgroup_disk_io_v2(cgroup_mock: Path) -> None:
+    make_cgroup(cgroup_mock / 'system.slice', 1000)
+    make_cgroup(cgroup_mock / 'system.slice' / 'foo.service', 100)
+    make_cgroup(cgroup_mock / 'init.scope', 100)
+    (cgroup_mock / 'system.slice' / 'io.stat').write_text(
+        '8:0 rbytes=1000 wbytes=2000 rios=1 wios=2 dbytes=0 dios=0\n'
+        '253:0 rbytes=100 wbytes=200 rios=1 wios=2 dbytes=0 dios=0\n'
+    )
+    (cgroup_mock / 'system.slice' / 'foo.service' / 'io.stat').write_text('')
+    # no io.stat in init.scope: the io controller isn't enabled for it
+
+    # this shares the index with CGroupSampler
+    cgroup_sampler = cockpit.samples.CGroupSampler()
+    get_checked_samples(cgroup_sampler)
+    sampler = cockpit.samples.CGroupDiskIO()
+    samples = get_checked_samples(sampler)
+    assert samples['disk.cgroup.read'] == {'system.slice': 1100, 'system.slice/foo.service': 0}
+    assert samples['disk.cgroup.written'] == {'system.slice': 2200, 'system.slice/foo.service': 0}
+    assert len(cockpit.samples.cgroup_indexes) == 1
+
+    # system.slice's totals include foo.service's
+    (cgroup_mock / 'system.slice' / 'io.stat').write_text(
+        '8:0 rbytes=1010 wbytes=2020 rios=2 wios=3 dbytes=0 dios=0\n'
+        '253:0 rbytes=100 wbytes=200 rios=1 wios=2 dbytes=0 dios=0\n'
+    )
+    (cgroup_mock / 'system.slice' / 'foo.service' / 'io.stat').write_text(
+        '8:0 rbytes=10 wbytes=20 rios=1 wios=2 dbytes=0 dios=0\n'
+    )
+    samples = get_checked_samples(sampler)
+    assert samples['disk.cgroup.read'] == {'system.slice': 1100, 'system.slice/foo.service': 10}
+    assert samples['disk.cgroup.written'] == {'system.slice': 2200, 'system.slice/foo.service': 20}
+
+    sampler.close()
+    cgroup_sampler.close()
+    assert cockpit.samples.cgroup_indexes == {}
+    assert cockpit.samples.CGroupIndex.n_fds == 0
+
+
+def test_cgroup_disk_io_nested(cgroup_mock: Path) -> None:
+    def write_io_stat(path: str, read: int, written: int) -> None:
+        (cgroup_mock / path / 'io.stat').write_text(
+            f'8:0 rbytes={read} wbytes={written} rios=1 wios=1 dbytes=0 dios=0\n'
+        )
+
+    def make_io_cgroup(path: str, read: int, written: int) -> None:
+        make_cgroup(cgroup_mock / path, 0)
+        write_io_stat(path, read, written)
+
+    # the totals of each cgroup include everything below it
+    make_io_cgroup('user.slice', 1000, 100)
+    make_io_cgroup('user.slice/user-1000.slice', 700, 70)
+    make_io_cgroup('user.slice/user-1000.slice/session-1.scope', 300, 30)
+    make_io_cgroup('user.slice/user-1000.slice/user@1000.service', 400, 40)
+    make_io_cgroup('user.slice/user-1001.slice', 200, 20)
+
+    sampler = cockpit.samples.CGroupDiskIO()
+    samples = get_checked_samples(sampler)
+    assert samples['disk.cgroup.read'] == {
+        'user.slice': 100,
+        'user.slice/user-1000.slice': 0,
+        'user.slice/user-1000.slice/session-1.scope': 300,
+        'user.slice/user-1000.slice/user@1000.service': 400,
+        'user.slice/user-1001.slice': 200,
+    }
+    assert samples['disk.cgroup.written'] == {
+        'user.slice': 10,
+        'user.slice/user-1000.slice': 0,
+        'user.slice/user-1000.slice/session-1.scope': 30,
+        'user.slice/user-1000.slice/user@1000.service': 40,
+        'user.slice/user-1001.slice': 20,
+    }
+    # nothing gets counted twice
+    assert sum(samples['disk.cgroup.read'].values()) == 1000
+
+    # the I/O of removed children stays in their parent's totals, but
+    # doesn't become the parent's own
+    shutil.rmtree(cgroup_mock / 'user.slice/user-1000.slice/session-1.scope')
+    samples = get_checked_samples(sampler)
+    assert samples['disk.cgroup.read']['user.slice/user-1000.slice'] == 0
+    assert samples['disk.cgroup.read']['user.slice'] == 100
+
+    # ... also once its parent does some I/O of its own
+    write_io_stat('user.slice', 1050, 105)
+    write_io_stat('user.slice/user-1000.slice', 750, 75)
+    samples = get_checked_samples(sampler)
+    assert samples['disk.cgroup.read']['user.slice/user-1000.slice'] == 50
+    assert samples['disk.cgroup.written']['user.slice/user-1000.slice'] == 5
+    assert samples['disk.cgroup.read']['user.slice'] == 100
+
+    # the removed child's I/O moves up along with its parent's
+    shutil.rmtree(cgroup_mock / 'user.slice/user-1000.slice')
+    samples = get_checked_samples(sampler)
+    assert samples['disk.cgroup.read'] == {
+        'user.slice': 100,
+        'user.slice/user-1001.slice': 200,
+    }
+
+    # the counters don't go backwards if a child's totals get ahead of its
+    # parent's, when its I/O happens between the two reads
+    write_io_stat('user.slice/user-1001.slice', 260, 26)
+    samples = get_checked_samples(sampler)
+    assert samples['disk.cgroup.read'] == {
+        'user.slice': 100,
+        'user.slice/user-1001.slice': 260,
+    }
+    write_io_stat('user.slice', 1120, 112)
+    samples = get_checked_samples(sampler)
+    assert samples['disk.cgroup.read'] == {
+        'user.slice': 110,
+        'user.slice/user-1001.slice': 260,
+    }
+
+    sampler.close()
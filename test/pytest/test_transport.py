@@ -48,6 +48,9 @@ class Protocol(cockpit.transports.SubprocessProtocol):
     def pause_writing(self) -> None:
         self.paused = True
 
+    def resume_writing(self) -> None:
+        self.paused = False
+
     def write_until_backlogged(self) -> None:
         while not self.paused:
             self.write(b'a' * 4096)
@@ -216,6 +219,83 @@ class TestStdio:
             while not protocol.eof:
                 await asyncio.sleep(0.1)
 
+    @pytest.mark.asyncio
+    async def test_write_buffer_limits(self):
+        loop = asyncio.get_running_loop()
+        protocol = Protocol()
+        stdin, their_stdin = os.pipe()
+        their_stdout, stdout = os.pipe()
+        transport = cockpit.transports.StdioTransport(loop, protocol, stdin=stdin, stdout=stdout)
+
+        try:
+            assert transport.get_write_buffer_limits() == (256 * 1024, 1024 * 1024)
+            transport.set_write_buffer_limits(high=1000)
+            assert transport.get_write_buffer_limits() == (250, 1000)
+            transport.set_write_buffer_limits(low=1000)
+            assert transport.get_write_buffer_limits() == (1000, 4000)
+            with pytest.raises(ValueError):
+                transport.set_write_buffer_limits(high=1000, low=2000)
+
+            high, low = 256 * 1024, 128 * 1024
+            transport.set_write_buffer_limits(high, low)
+            assert transport.get_write_buffer_limits() == (low, high)
+
+            # Fill the pipe, then keep going until the protocol gets paused
+            chunk = b'x' * 32 * 1024
+            while not protocol.paused:
+                protocol.write(chunk)
+                await asyncio.sleep(0)
+            assert high < transport.get_write_buffer_size() <= high + len(chunk)
+
+            # Drain the pipe until we get resumed
+            os.set_blocking(their_stdout, False)
+            while protocol.paused:
+                with contextlib.suppress(BlockingIOError):
+                    os.read(their_stdout, 4096)
+                await asyncio.sleep(0)
+            assert transport.get_write_buffer_size() <= low
+            assert transport.get_write_buffer_size() > 0
+        finally:
+            transport.abort()
+            for fd in (stdin, their_stdin, their_stdout, stdout):
+                os.close(fd)
+
+    @pytest.mark.asyncio
+    async def test_urgent_messages(self):
+        loop = asyncio.get_running_loop()
+        protocol = Protocol()
+        stdin, their_stdin = os.pipe()
+        their_stdout, stdout = os.pipe()
+        transport = cockpit.transports.StdioTransport(loop, protocol, stdin=stdin, stdout=stdout)
+
+        try:
+            # This gets partially written, so the rest needs to go first
+            transport.write(b'.' * 1024 * 1024)
+            transport.write_message([b'A1'], 'a')
+            transport.write_message([b'B', b'1'], 'b')
+            # Urgent messages stay behind their own stream...
+            transport.write_message([b'!a'], 'a', urgent=True)
+            # ... but overtake the others, and stay in order among themselves
+            transport.write_message([b'!', b'c'], 'c', urgent=True)
+            transport.write_message([b'!d'], 'd', urgent=True)
+            # Nothing overtakes a message without a stream
+            transport.write(b'X')
+            transport.write_message([b'!e'], 'e', urgent=True)
+
+            expected = b'.' * 1024 * 1024 + b'!c!dA1!aB1X!e'
+            os.set_blocking(their_stdout, False)
+            output = b''
+            while len(output) < len(expected):
+                try:
+                    output += os.read(their_stdout, 1024 * 1024)
+                except BlockingIOError:
+                    await asyncio.sleep(0.01)
+            assert output == expected
+        finally:
+            transport.abort()
+            for fd in (stdin, their_stdin, their_stdout, stdout):
+                os.close(fd)
+
 
 class TestSubprocessTransport:
     def subprocess(self, args, **kwargs: Any) -> Tuple[Protocol, cockpit.transports.SubprocessTransport]:
@@ -466,6 +546,9 @@ class TestSubprocessTransport:
 
         protocol.write(b'abcd')
         assert protocol.transport
+        # writes are corked until the next mainloop iteration
+        assert protocol.transport.get_write_buffer_size() == 4
+        await asyncio.sleep(0)
         assert protocol.transport.get_write_buffer_size() == 0
         protocol.transport.close()
         # make sure the connection_lost handler isn't called immediately
@@ -476,6 +559,52 @@ class TestSubprocessTransport:
         # we have another ref on the transport
         transport.close()  # should be idempotent
 
+    @pytest.mark.asyncio
+    async def test_corked_writes(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        writev_calls = 0
+        real_writev = os.writev
+
+        def writev(fd: int, buffers: 'list[bytes]') -> int:
+            nonlocal writev_calls
+            writev_calls += 1
+            return real_writev(fd, buffers)
+
+        monkeypatch.setattr(os, 'writev', writev)
+
+        protocol, transport = self.subprocess(['cat'])
+        protocol.output = []
+
+        # Lots of small writes in one iteration result in a single syscall
+        for i in range(2000):
+            protocol.write(b'%d\n' % i)
+        transport.writelines([b'x', memoryview(b'yz'), bytearray(b'\n')])
+        assert transport.get_write_buffer_size() == protocol.sent + 4
+        assert writev_calls == 0
+
+        await asyncio.sleep(0)
+        assert writev_calls == 2  # more than IOV_MAX buffers
+        assert transport.get_write_buffer_size() == 0
+
+        expected = b''.join(b'%d\n' % i for i in range(2000)) + b'xyz\n'
+        while protocol.get_output() != expected:
+            await asyncio.sleep(0.1)
+
+        transport.close()
+
+    @pytest.mark.asyncio
+    async def test_write_mutable(self) -> None:
+        protocol, transport = self.subprocess(['cat'])
+        protocol.output = []
+
+        # Mutable buffers are copied when queued, so changing them afterwards is fine
+        buffer = bytearray(b'abc\n')
+        transport.writelines([buffer, memoryview(buffer), memoryview(b'def\n')[:2]])
+        buffer[:] = b'xxxx'
+        while protocol.get_output() != b'abc\nabc\nde':
+            await asyncio.sleep(0.1)
+
+        transport.close()
+
     @pytest.mark.asyncio
     async def test_flow_control(self) -> None:
         protocol, transport = self.subprocess(['cat'])